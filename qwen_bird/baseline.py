@@ -1,150 +1,380 @@
 # Test qwen2.5VL 2b model on the Caltech-UCSD Birds 200-2011 dataset
 from dataset import CUB200Dataset
 from model import QwenVLModel
+from vision_cache import VisionFeatureCache
+from result_store import ResultStore
+from server import RemoteQwenVLModel
+from evaluation import evaluate_dataset, BatchingOptions, CachingOptions, CheckpointOptions
+from checkpoint import Checkpoint, latest_timestamp
+from bucketing import image_sizes, token_counts
+from autobatch import BatchSizeTuner, DEFAULT_CACHE
+from sharding import shard_range, shard_path, shard_paths
+from profiler import Profiler
+from candidates import CandidateFilter, recall_at_k, DEFAULT_CACHE as CLASS_EMBEDDING_CACHE
+from hierarchy import cub_families, coarse_groups, group_list
 import os
+import sys
+import json
 import datetime
 import re
+import argparse
 
 # Base path configuration
 BASE_PATH = "/home/samuele.angheben/vision-reasoning/qwen_bird"
 
-def evaluate_dataset(dataset, dataset_name, output_file, prompt, model, class_names_dict, is_reasoning=False):
-    """Evaluate a dataset and save results to file"""
+# (dataset name, output file name, cropped images, reasoning prompt) of the four evaluations
+EVALUATIONS = [
+    ("Original", "original", False, False),
+    ("Original Reasoning", "original_reasoning", False, True),
+    ("Cropped", "cropped", True, False),
+    ("Cropped Reasoning", "cropped_reasoning", True, True),
+]
+
+# k of the recall@k written for --candidates
+RECALL_KS = [1, 5, 10, 20, 50]
+
+def output_files(timestamp):
+    """Predictions file of every evaluation of a run, by dataset name"""
+    return {name: f"{BASE_PATH}/outputs/predictions_{stem}_{timestamp}.txt" for name, stem, _, _ in EVALUATIONS}
+
+def merge_shards(output_file, dataset_name, num_shards):
+    """Combine the predictions of the shards of one evaluation into output_file.
+
+    Finished shards keep their checkpoint, which holds their counts and
+    generation stats. The merged file lists the samples of every shard in
+    dataset order with the running accuracy recomputed and ends with the
+    totals a single process would write (throughput summed over the shards).
+    Returns (correct, total) like evaluate_dataset.
+    """
+    states = []
+    for shard_file in shard_paths(output_file, num_shards):
+        state = Checkpoint(f"{shard_file}.checkpoint").load()
+        if state is None or not state["finished"]:
+            sys.exit(f"{shard_file} is not finished, run or resume its shard first")
+        states.append(state)
     correct = 0
     total = 0
-    
-    def normalize_text(text):
-        """Normalize text by replacing punctuation with spaces and converting to lowercase"""
-        # Replace punctuation with spaces, then normalize multiple spaces to single spaces
-        text = re.sub(r'[^a-zA-Z\s]', ' ', text.lower())
-        return ' '.join(text.split())  # Remove extra whitespace
-    
-    def extract_answer_from_tags(text):
-        """Extract text between <answer></answer> tags"""
-        match = re.search(r'<answer>(.*?)</answer>', text, re.DOTALL | re.IGNORECASE)
-        return match.group(1).strip() if match else None
-    
-    def check_accuracy(ground_truth, prediction):
-        """Check if prediction contains the ground truth with simple logic"""
-        normalized_gt = normalize_text(ground_truth)
-        normalized_pred = normalize_text(prediction)
-        
-        # Simple substring check
-        return normalized_gt in normalized_pred
 
+    def recompute_running_accuracy(match):
+        nonlocal correct, total
+        total += 1
+        correct += match.group(1) == "True"
+        return f"Correct: {match.group(1)}\nRunning accuracy: {correct / total:.4f}\n" + "-" * 40 + "\n\n"
+
+    sample_end = re.compile(r"Correct: (True|False)\nRunning accuracy: \d+\.\d{4}\n" + "-" * 40 + r"\n\n")
     with open(output_file, "w") as f:
         f.write(f"{dataset_name} Dataset Predictions - {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
         f.write("=" * 60 + "\n\n")
-        
-        for idx, sample in enumerate(dataset):
-            prediction = model.predict(sample["image"], prompt)
-            ground_truth = class_names_dict[sample['label']]
-            
-            # Extract answer from tags if using reasoning prompt
-            if is_reasoning:
-                prediction_for_check = extract_answer_from_tags(prediction)
-                # If no answer tags found, mark as incorrect
-                if prediction_for_check is None:
-                    is_correct = False
-                else:
-                    is_correct = check_accuracy(ground_truth, prediction_for_check)
-            else:
-                prediction_for_check = prediction
-                is_correct = check_accuracy(ground_truth, prediction_for_check)
-            
-            if is_correct:
-                correct += 1
-            total += 1
-            
-            current_accuracy = correct / total
-
-            print(f"Sample {idx}: Ground truth: {ground_truth}")
-            print(f"Sample {idx}: Prediction: {prediction}")
-            print(f"Sample {idx}: Correct: {is_correct}")
-            print(f"Sample {idx}: Running accuracy: {current_accuracy:.4f}")
-            print("---")
-            
-            f.write(f"Sample {idx}:\n")
-            f.write(f"Ground truth: {ground_truth}\n")
-            f.write(f"Prediction: {prediction}\n")
-            f.write(f"Correct: {is_correct}\n")
-            f.write(f"Running accuracy: {current_accuracy:.4f}\n")
-            f.write("-" * 40 + "\n\n")
-        
+        for shard_file in shard_paths(output_file, num_shards):
+            with open(shard_file) as shard:
+                # skip the 3 header lines, the samples end where the totals start
+                text = shard.read().split("\n", 3)[3]
+            f.write(sample_end.sub(recompute_running_accuracy, text[:text.rindex(f"\n{dataset_name} dataset accuracy: ")]))
+        if total != sum(state["total"] for state in states):
+            sys.exit(f"{output_file}: the shard outputs do not match their checkpoints")
+
         f.write(f"\n{dataset_name} dataset accuracy: {correct}/{total} = {correct/total:.4f}\n")
-    
+        top_k = states[0].get("top_k")
+        if top_k:
+            correct_top_k = sum(state["correct_top_k"] for state in states)
+            f.write(f"{dataset_name} dataset top-{top_k} accuracy: {correct_top_k}/{total} = {correct_top_k/total:.4f}\n")
+        stats = {key: sum(state["generation_stats"][key] for state in states) for key in states[0]["generation_stats"]}
+        f.write(f"{dataset_name} generated tokens: {stats['generated_tokens']}, "
+                f"saved by early stopping: at most {stats['tokens_saved']} ({stats['stopped_early']} sequences)\n")
+        f.write(f"{dataset_name} per sample: {stats['prompt_tokens'] / total:.1f} prompt tokens, "
+                f"{stats['generated_tokens'] / total:.1f} generated tokens\n")
+        # the shards run side by side, so their rates add up
+        rates = [state["generation_stats"] for state in states if state["generation_stats"]["seconds"]]
+        f.write(f"{dataset_name} throughput: {sum(rate['images'] / rate['seconds'] for rate in rates):.2f} images/s, "
+                f"{sum(rate['generated_tokens'] / rate['seconds'] for rate in rates):.1f} generated tokens/s "
+                f"over {num_shards} shards\n")
+        if stats["draft_tokens"]:
+            f.write(f"{dataset_name} prompt lookup: acceptance rate {stats['accepted_tokens'] / stats['draft_tokens']:.4f} "
+                    f"({stats['accepted_tokens']}/{stats['draft_tokens']} draft tokens), "
+                    f"{stats['generated_tokens'] / max(stats['decode_steps'] + stats['sequences'], 1):.2f} tokens per forward pass\n")
+    print(f"Merged {num_shards} shards into {output_file}")
     return correct, total
 
+def write_summary(summary_file, results):
+    """Print and save the accuracy of the four evaluations; results maps dataset names to (correct, total)"""
+    correct_original, total_original = results["Original"]
+    correct_original_reasoning, total_original_reasoning = results["Original Reasoning"]
+    correct_cropped, total_cropped = results["Cropped"]
+    correct_cropped_reasoning, total_cropped_reasoning = results["Cropped Reasoning"]
+
+    print(f"Original dataset accuracy: {correct_original}/{total_original} = {correct_original/total_original:.4f}")
+    print(f"Original reasoning accuracy: {correct_original_reasoning}/{total_original_reasoning} = {correct_original_reasoning/total_original_reasoning:.4f}")
+    print(f"Cropped dataset accuracy: {correct_cropped}/{total_cropped} = {correct_cropped/total_cropped:.4f}")
+    print(f"Cropped reasoning accuracy: {correct_cropped_reasoning}/{total_cropped_reasoning} = {correct_cropped_reasoning/total_cropped_reasoning:.4f}")
+
+    with open(summary_file, "w") as f:
+        f.write(f"Bird Classification Accuracy Summary\n")
+        f.write("=" * 40 + "\n\n")
+        f.write(f"Date: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        f.write(f"Model: Qwen2.5-VL-3B-Instruct\n")
+        f.write(f"Dataset: Caltech-UCSD Birds 200-2011 (test set)\n\n")
+        f.write(f"Original Dataset:\n")
+        f.write(f"  Correct: {correct_original}/{total_original}\n")
+        f.write(f"  Accuracy: {correct_original/total_original:.4f} ({correct_original/total_original*100:.2f}%)\n\n")
+        f.write(f"Original Dataset (Reasoning):\n")
+        f.write(f"  Correct: {correct_original_reasoning}/{total_original_reasoning}\n")
+        f.write(f"  Accuracy: {correct_original_reasoning/total_original_reasoning:.4f} ({correct_original_reasoning/total_original_reasoning*100:.2f}%)\n\n")
+        f.write(f"Cropped Dataset:\n")
+        f.write(f"  Correct: {correct_cropped}/{total_cropped}\n")
+        f.write(f"  Accuracy: {correct_cropped/total_cropped:.4f} ({correct_cropped/total_cropped*100:.2f}%)\n\n")
+        f.write(f"Cropped Dataset (Reasoning):\n")
+        f.write(f"  Correct: {correct_cropped_reasoning}/{total_cropped_reasoning}\n")
+        f.write(f"  Accuracy: {correct_cropped_reasoning/total_cropped_reasoning:.4f} ({correct_cropped_reasoning/total_cropped_reasoning*100:.2f}%)\n\n")
+
+    print(f"Summary saved to: {summary_file}")
+
+def write_recall(recall_file, recall):
+    """Print and save the recall@k of the candidate classes; recall maps image sets to their total and hits per k"""
+    for images, counts in recall.items():
+        for k, hits in sorted(counts["hits"].items(), key=lambda item: int(item[0])):
+            print(f"{images} candidate recall@{k}: {hits}/{counts['total']} = {hits / counts['total']:.4f}")
+    with open(recall_file, "w") as f:
+        json.dump(recall, f, indent=2)
+    print(f"Candidate recall saved to: {recall_file}")
+
+def batch_size_arg(value):
+    return value if value == "auto" else int(value)
+
+parser = argparse.ArgumentParser(description="Evaluate Qwen2.5-VL on the CUB-200-2011 test set")
+parser.add_argument("--batch-size", type=batch_size_arg, default=1,
+                    help="Number of images per generate call, or auto for the largest that fits in memory")
+parser.add_argument("--batch-size-cache", default=DEFAULT_CACHE,
+                    help="JSON file of the batch sizes found by --batch-size auto, per hardware and configuration")
+parser.add_argument("--vision-cache", default=None,
+                    help="Directory of an on-disk cache of vision-tower outputs shared across prompts and runs")
+parser.add_argument("--prefix-cache", action="store_true",
+                    help="Put the prompt before the image and reuse its KV cache across samples")
+parser.add_argument("--score-classes", action="store_true",
+                    help="Rank the class names by log-likelihood instead of generating free text")
+parser.add_argument("--constrained", action="store_true",
+                    help="Constrain generation to the class names")
+parser.add_argument("--early-stop", action="store_true",
+                    help="Stop reasoning generations right after </answer>")
+parser.add_argument("--min-pixels", type=int, default=None, help="Lower bound on the resized image area")
+parser.add_argument("--max-pixels", type=int, default=None,
+                    help="Upper bound on the resized image area (one visual token per 28x28 pixels)")
+parser.add_argument("--image-tokens", type=int, default=None,
+                    help="Resize every image to about this many visual tokens (see pixel_sweep.py)")
+parser.add_argument("--candidates", type=int, default=None, metavar="K",
+                    help="List only the K classes whose name embeddings are closest to the image's in the prompt "
+                         "(see candidates.py); recall@k of this pre-filter is saved with the outputs")
+parser.add_argument("--class-embedding-cache", default=CLASS_EMBEDDING_CACHE,
+                    help="Directory of the class-name embeddings computed for --candidates")
+parser.add_argument("--hierarchical", action="store_true",
+                    help="Ask for the bird family first (the last word of the species names, e.g. Warbler), then for "
+                         "the species of that family in the same conversation (non-reasoning evaluations only)")
+parser.add_argument("--max-families", type=int, default=16,
+                    help="Families listed with --hierarchical: the largest ones, the others merged into \"Other birds\"")
+parser.add_argument("--num-workers", type=int, default=0,
+                    help="Threads decoding and preprocessing images ahead of the model (0 runs everything inline)")
+parser.add_argument("--prefetch", type=int, default=8, help="Batches prepared ahead of the model")
+parser.add_argument("--continuous-batching", action="store_true",
+                    help="Refill finished rows with new samples during decoding (batch size = number of rows)")
+parser.add_argument("--bucketing", action="store_true",
+                    help="Batch images with similar visual token counts together (results keep the dataset order)")
+parser.add_argument("--bucket-window", type=int, default=512,
+                    help="Samples sorted by size together with --bucketing")
+parser.add_argument("--prompt-lookup", type=int, default=None, metavar="N",
+                    help="Prompt-lookup speculative decoding drafting up to N tokens copied from the prompt")
+parser.add_argument("--device", default=None,
+                    help="auto, cuda, cuda:N or cpu (default: auto when a GPU is visible, else cpu)")
+parser.add_argument("--dtype", default="auto", help="auto, bfloat16, float16 or float32 (auto is bfloat16 on CPU)")
+parser.add_argument("--quantize", choices=["int8"], default=None,
+                    help="Dynamically quantize the linear layers (CPU only)")
+parser.add_argument("--num-threads", type=int, default=None, help="CPU threads (default: all available cores)")
+parser.add_argument("--resume", nargs="?", const="latest", default=None, metavar="TIMESTAMP",
+                    help="Continue an interrupted run (default: the latest one) from its checkpoints")
+parser.add_argument("--checkpoint-interval", type=float, default=60.0,
+                    help="Seconds between checkpoints of the evaluation progress")
+parser.add_argument("--result-store", default=None,
+                    help="SQLite file memoizing generations across runs (greedy results, and sampled ones with a seed)")
+parser.add_argument("--server", default=None,
+                    help="URL of a running server.py (e.g. http://127.0.0.1:8765) to use instead of loading the "
+                         "model here; the model options are then those of the server")
+parser.add_argument("--profile", action="store_true",
+                    help="Record the time spent in each stage of every model call (templating, preprocessing, "
+                         "prefill, decoding, ...) and save percentiles next to the predictions")
+parser.add_argument("--num-shards", type=int, default=1,
+                    help="Split every dataset into this many contiguous shards, one per process")
+parser.add_argument("--shard-id", type=int, default=0, help="Shard evaluated by this process (0-based)")
+parser.add_argument("--run-id", default=None,
+                    help="Name shared by the shards of a run, used in the output file names instead of the start "
+                         "time (e.g. $SLURM_ARRAY_JOB_ID)")
+parser.add_argument("--merge", action="store_true",
+                    help="Combine the outputs of the --num-shards shards of --run-id instead of evaluating")
+args = parser.parse_args()
+if not 0 <= args.shard_id < args.num_shards:
+    parser.error(f"--shard-id must be in [0, {args.num_shards})")
+if args.num_shards > 1 and args.run_id is None:
+    parser.error("--num-shards needs a --run-id shared by every shard")
+if args.merge:
+    if args.run_id is None or args.num_shards == 1:
+        parser.error("--merge needs the --run-id and --num-shards of the sharded run")
+    merged_files = output_files(args.run_id)
+    write_summary(f"{BASE_PATH}/outputs/accuracy_summary_{args.run_id}.txt", {
+        name: merge_shards(output_file, name, args.num_shards) for name, output_file in merged_files.items()
+    })
+    recall_file = f"{BASE_PATH}/outputs/candidate_recall_{args.run_id}.json"
+    if os.path.exists(shard_path(recall_file, args.num_shards, 0)):
+        shard_recalls = []
+        for shard_file in shard_paths(recall_file, args.num_shards):
+            with open(shard_file) as f:
+                shard_recalls.append(json.load(f))
+        write_recall(recall_file, {
+            images: {
+                "total": sum(recall[images]["total"] for recall in shard_recalls),
+                "hits": {k: sum(recall[images]["hits"][k] for recall in shard_recalls) for k in counts["hits"]},
+            }
+            for images, counts in shard_recalls[0].items()
+        })
+    # the shards are merged, nothing is left to resume
+    for output_file in merged_files.values():
+        for shard_file in shard_paths(output_file, args.num_shards):
+            Checkpoint(f"{shard_file}.checkpoint").remove()
+    sys.exit()
+if args.server and args.continuous_batching:
+    parser.error("--continuous-batching needs the model in this process, it cannot be used with --server")
+if args.server and args.batch_size == "auto":
+    parser.error("--batch-size auto probes the model's memory, it cannot be used with --server")
+if args.server and args.bucketing:
+    parser.error("--bucketing needs the model's image processor, it cannot be used with --server")
+if args.server and args.candidates:
+    parser.error("--candidates needs the model's hidden states, it cannot be used with --server")
+if args.server and args.hierarchical:
+    parser.error("--hierarchical reuses the model's KV cache between turns, it cannot be used with --server")
+if args.hierarchical and (args.candidates or args.score_classes):
+    parser.error("--hierarchical cannot be combined with --candidates or --score-classes")
+if args.max_families < 2:
+    parser.error("--max-families must be at least 2")
+if args.candidates and args.prefix_cache:
+    parser.error("--candidates lists other classes for every image, it cannot be used with --prefix-cache")
+
 CUB200Dataset = CUB200Dataset(split='test')
 
-model = QwenVLModel()
-prompt = f"Please identify the bird species in this image. Choose from the following list of bird species:\n\n{CUB200Dataset.prompt_class_list}\n\nProvide your answer as the species name."
-reasoning_prompt = f"""You are an expert ornithologist. Carefully analyze the visual features of the bird in the image (such as color, size, beak shape, markings, and other distinctive traits). 
+vision_cache = VisionFeatureCache(args.vision_cache) if args.vision_cache and not args.server else None
+result_store = ResultStore(args.result_store) if args.result_store and not args.server else None
+profiler = Profiler() if args.profile and not args.server else None
+if args.server:
+    model = RemoteQwenVLModel(args.server, max_new_tokens=1024)
+else:
+    model = QwenVLModel(max_new_tokens=1024, vision_cache=vision_cache, min_pixels=args.min_pixels,
+                        max_pixels=args.max_pixels, image_tokens=args.image_tokens, device=args.device,
+                        dtype=args.dtype, quantize=args.quantize, num_threads=args.num_threads,
+                        result_store=result_store, profiler=profiler)
+# {class_list} is every class, or the candidate classes of each image with --candidates
+prompt_template = "Please identify the bird species in this image. Choose from the following list of bird species:\n\n{class_list}\n\nProvide your answer as the species name."
+reasoning_prompt_template = """You are an expert ornithologist. Carefully analyze the visual features of the bird in the image (such as color, size, beak shape, markings, and other distinctive traits). 
 
 Step 1: Describe the key visual features you observe.
 Step 2: Based on these features, select the most likely species from the following list:
 
-{CUB200Dataset.prompt_class_list}
+{class_list}
 
 Step 3: Clearly state your final answer by writing only the species name inside <answer></answer> tags.
 
 Begin your reasoning below:
 """
+prompt = prompt_template.format(class_list=CUB200Dataset.prompt_class_list)
+reasoning_prompt = reasoning_prompt_template.format(class_list=CUB200Dataset.prompt_class_list)
+# Two turns with --hierarchical: the family, then the species of that family
+families = coarse_groups(cub_families(CUB200Dataset.class_names_dict), args.max_families, other="Other birds")
+family_prompt = f"Please identify the bird in this image. Choose its family from the following list of bird families:\n\n{group_list(families)}\n\nProvide your answer as the family name."
+species_prompt = "Now choose the species from the following list of {group} species:\n\n{class_list}\n\nProvide your answer as the species name."
+
+if args.batch_size == "auto":
+    # worst case: the largest image, the longest prompt and a generation using the whole budget
+    largest_image = max(image_sizes(CUB200Dataset.get_dataset()), key=lambda size: model.image_token_count(*size))
+    args.batch_size = BatchSizeTuner(model, cache_path=args.batch_size_cache).batch_size(
+        reasoning_prompt, image_size=largest_image
+    )
+    print(f"Batch size: {args.batch_size}")
+
+# Options shared by every evaluation run
+eval_options = dict(score_classes=args.score_classes, constrained=args.constrained, early_stop=args.early_stop,
+                    prompt_lookup_tokens=args.prompt_lookup,
+                    caching=CachingOptions(prefix_cache=args.prefix_cache),
+                    checkpointing=CheckpointOptions(resume=args.resume is not None, interval=args.checkpoint_interval))
+batching = BatchingOptions(batch_size=args.batch_size, num_workers=args.num_workers, prefetch=args.prefetch,
+                           continuous_batching=args.continuous_batching, bucket_window=args.bucket_window)
 
 # Create output directory
 os.makedirs(f"{BASE_PATH}/outputs", exist_ok=True)
 timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+if args.run_id is not None:
+    timestamp = args.run_id
+elif args.resume == "latest":
+    timestamp = latest_timestamp(f"{BASE_PATH}/outputs")
+    if timestamp is None:
+        parser.error(f"No checkpoint to resume in {BASE_PATH}/outputs")
+elif args.resume is not None:
+    timestamp = args.resume
+print(f"Run {timestamp}")
+
+# This process evaluates one contiguous slice of every dataset
+datasets = {False: CUB200Dataset.get_dataset(), True: CUB200Dataset.get_dataset_cropped()}
+shard = shard_range(len(datasets[False]), args.num_shards, args.shard_id)
+if args.num_shards > 1:
+    print(f"Shard {args.shard_id} of {args.num_shards}: samples {shard.start} to {shard.stop - 1}")
+
+# Visual tokens per image, read from the image headers
+image_token_counts = {
+    cropped: token_counts(model, dataset)[shard.start:shard.stop] if args.bucketing else None
+    for cropped, dataset in datasets.items()
+}
+
+# Top classes of every image by embedding similarity, the only ones listed in its prompt with --candidates
+candidates = {cropped: None for cropped in datasets}
+if args.candidates:
+    candidate_filter = CandidateFilter(model, CUB200Dataset.class_names_dict, cache_dir=args.class_embedding_cache)
+    recall = {}
+    for cropped, dataset in datasets.items():
+        rankings, labels = candidate_filter.rank(dataset.select(shard), batch_size=args.batch_size)
+        candidates[cropped] = [ranking[:args.candidates] for ranking in rankings]
+        recall["Cropped" if cropped else "Original"] = {
+            "total": len(labels),
+            "hits": recall_at_k(rankings, labels, sorted(
+                {k for k in RECALL_KS + [args.candidates] if k <= len(CUB200Dataset.class_names_dict)}
+            )),
+        }
+    write_recall(shard_path(f"{BASE_PATH}/outputs/candidate_recall_{timestamp}.json", args.num_shards, args.shard_id),
+                 recall)
 
 # Evaluate both datasets
-output_file_original = f"{BASE_PATH}/outputs/predictions_original_{timestamp}.txt"
-correct_original, total_original = evaluate_dataset(
-    CUB200Dataset.get_dataset(), "Original", output_file_original, 
-    prompt, model, CUB200Dataset.class_names_dict
-)
-
-output_file_original_reasoning = f"{BASE_PATH}/outputs/predictions_original_reasoning_{timestamp}.txt"
-correct_original_reasoning, total_original_reasoning = evaluate_dataset(
-    CUB200Dataset.get_dataset(), "Original Reasoning", output_file_original_reasoning, 
-    reasoning_prompt, model, CUB200Dataset.class_names_dict, is_reasoning=True
-)
-
-output_file_cropped = f"{BASE_PATH}/outputs/predictions_cropped_{timestamp}.txt"
-correct_cropped, total_cropped = evaluate_dataset(
-    CUB200Dataset.get_dataset_cropped(), "Cropped", output_file_cropped, 
-    prompt, model, CUB200Dataset.class_names_dict
-)
-
-output_file_cropped_reasoning = f"{BASE_PATH}/outputs/predictions_cropped_reasoning_{timestamp}.txt"
-correct_cropped_reasoning, total_cropped_reasoning = evaluate_dataset(
-    CUB200Dataset.get_dataset_cropped(), "Cropped Reasoning", output_file_cropped_reasoning, 
-    reasoning_prompt, model, CUB200Dataset.class_names_dict, is_reasoning=True
-)
-
-print(f"Original dataset accuracy: {correct_original}/{total_original} = {correct_original/total_original:.4f}")
-print(f"Original reasoning accuracy: {correct_original_reasoning}/{total_original_reasoning} = {correct_original_reasoning/total_original_reasoning:.4f}")
-print(f"Cropped dataset accuracy: {correct_cropped}/{total_cropped} = {correct_cropped/total_cropped:.4f}")
-print(f"Cropped reasoning accuracy: {correct_cropped_reasoning}/{total_cropped_reasoning} = {correct_cropped_reasoning/total_cropped_reasoning:.4f}")
+results = {}
+for name, _, cropped, is_reasoning in EVALUATIONS:
+    output_file = shard_path(output_files(timestamp)[name], args.num_shards, args.shard_id)
+    if args.candidates:
+        evaluation_prompt = reasoning_prompt_template if is_reasoning else prompt_template
+    elif args.hierarchical and not is_reasoning:
+        evaluation_prompt = family_prompt
+    else:
+        evaluation_prompt = reasoning_prompt if is_reasoning else prompt
+    results[name] = evaluate_dataset(
+        datasets[cropped].select(shard), name, output_file,
+        evaluation_prompt, model, CUB200Dataset.class_names_dict,
+        is_reasoning=is_reasoning, index_offset=shard.start, candidates=candidates[cropped],
+        hierarchy=families if args.hierarchical else None, followup_prompt=species_prompt,
+        batching=batching._replace(image_token_counts=image_token_counts[cropped]), **eval_options
+    )
 
 # Save summary results
-summary_file = f"{BASE_PATH}/outputs/accuracy_summary_{timestamp}.txt"
-with open(summary_file, "w") as f:
-    f.write(f"Bird Classification Accuracy Summary\n")
-    f.write("=" * 40 + "\n\n")
-    f.write(f"Date: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-    f.write(f"Model: Qwen2.5-VL-3B-Instruct\n")
-    f.write(f"Dataset: Caltech-UCSD Birds 200-2011 (test set)\n\n")
-    f.write(f"Original Dataset:\n")
-    f.write(f"  Correct: {correct_original}/{total_original}\n")
-    f.write(f"  Accuracy: {correct_original/total_original:.4f} ({correct_original/total_original*100:.2f}%)\n\n")
-    f.write(f"Original Dataset (Reasoning):\n")
-    f.write(f"  Correct: {correct_original_reasoning}/{total_original_reasoning}\n")
-    f.write(f"  Accuracy: {correct_original_reasoning/total_original_reasoning:.4f} ({correct_original_reasoning/total_original_reasoning*100:.2f}%)\n\n")
-    f.write(f"Cropped Dataset:\n")
-    f.write(f"  Correct: {correct_cropped}/{total_cropped}\n")
-    f.write(f"  Accuracy: {correct_cropped/total_cropped:.4f} ({correct_cropped/total_cropped*100:.2f}%)\n\n")
-    f.write(f"Cropped Dataset (Reasoning):\n")
-    f.write(f"  Correct: {correct_cropped_reasoning}/{total_cropped_reasoning}\n")
-    f.write(f"  Accuracy: {correct_cropped_reasoning/total_cropped_reasoning:.4f} ({correct_cropped_reasoning/total_cropped_reasoning*100:.2f}%)\n\n")
-
-print(f"Summary saved to: {summary_file}")
+write_summary(shard_path(f"{BASE_PATH}/outputs/accuracy_summary_{timestamp}.txt", args.num_shards, args.shard_id),
+              results)
+
+# the run is complete, nothing is left to resume; shards keep their checkpoints for --merge
+if args.num_shards == 1:
+    for output_file in output_files(timestamp).values():
+        Checkpoint(f"{output_file}.checkpoint").remove()
+else:
+    print(f"Combine the shards with: --merge --num-shards {args.num_shards} --run-id {timestamp}")
+
+if vision_cache is not None:
+    print(f"Vision feature cache: {vision_cache.stats()}")
+if result_store is not None:
+    print(f"Result store: {result_store.stats()}")
 
@@ -0,0 +1,166 @@
+# CPU benchmark of QwenVLModel and evaluate_dataset on a tiny random Qwen2.5-VL, compared against a stored baseline
+from tiny_model import tiny_qwen_vl_model, synthetic_image
+from evaluation import evaluate_dataset, BatchingOptions
+from autobatch import hardware_fingerprint
+import os
+import sys
+import json
+import time
+import random
+import resource
+import datetime
+import argparse
+import tempfile
+import subprocess
+import contextlib
+
+# Base path configuration
+BASE_PATH = "/home/samuele.angheben/vision-reasoning/qwen_bird"
+
+parser = argparse.ArgumentParser(description="Benchmark predict, predict_multiple and evaluate_dataset on CPU with a "
+                                             "tiny randomly initialized Qwen2.5-VL and synthetic images")
+parser.add_argument("--image-sizes", default="224x224,448x336,640x480",
+                    help="Comma separated WIDTHxHEIGHT of the synthetic images")
+parser.add_argument("--repeats", type=int, default=10, help="Timed calls per benchmark (after one warm-up call)")
+parser.add_argument("--max-new-tokens", type=int, default=32)
+parser.add_argument("--batch-size", type=int, default=4, help="Batch size of predict_batch and evaluate_dataset")
+parser.add_argument("--num-return-sequences", type=int, default=8, help="Samples per predict_multiple call")
+parser.add_argument("--eval-samples", type=int, default=24, help="Size of the synthetic evaluate_dataset dataset")
+parser.add_argument("--num-threads", type=int, default=None, help="CPU threads (default: all available cores)")
+parser.add_argument("--seed", type=int, default=0, help="Seed of the model weights and the synthetic data")
+parser.add_argument("--history", default=f"{BASE_PATH}/outputs/benchmark_history.json",
+                    help="JSON file every run is appended to")
+parser.add_argument("--baseline", default=f"{BASE_PATH}/outputs/benchmark_baseline.json",
+                    help="JSON file of the run to compare against")
+parser.add_argument("--save-baseline", action="store_true", help="Make this run the new baseline")
+parser.add_argument("--tolerance", type=float, default=0.1,
+                    help="Relative slowdown of a latency or throughput counted as a regression")
+parser.add_argument("--check", action="store_true", help="Exit with status 1 when a regression is found")
+args = parser.parse_args()
+
+image_sizes = [tuple(int(side) for side in size.split("x")) for size in args.image_sizes.split(",")]
+model = tiny_qwen_vl_model(max_new_tokens=args.max_new_tokens, seed=args.seed, num_threads=args.num_threads)
+prompt = "Please identify the bird species in this image. Provide your answer as the species name."
+rng = random.Random(args.seed)
+
+def latency_ms(seconds):
+    """Percentiles of a list of call durations, in milliseconds"""
+    ms = sorted(1000 * second for second in seconds)
+    return {
+        "mean": sum(ms) / len(ms),
+        "p50": ms[len(ms) // 2],
+        "p90": ms[min(len(ms) - 1, int(0.9 * len(ms)))],
+        "p99": ms[min(len(ms) - 1, int(0.99 * len(ms)))],
+    }
+
+def peak_rss_mb():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def measure(name, call, images_per_call):
+    """Time repeats calls after a warm-up one; throughput counts images and generated tokens"""
+    call()
+    model.reset_generation_stats()
+    seconds = []
+    for _ in range(args.repeats):
+        begin = time.perf_counter()
+        call()
+        seconds.append(time.perf_counter() - begin)
+    total = sum(seconds)
+    result = {
+        "latency_ms": latency_ms(seconds),
+        "images_per_second": images_per_call * args.repeats / total,
+        "tokens_per_second": model.generation_stats["generated_tokens"] / total,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print(f"{name}: p50 {result['latency_ms']['p50']:.1f} ms, {result['images_per_second']:.2f} images/s, "
+          f"{result['tokens_per_second']:.1f} tokens/s")
+    return result
+
+results = {}
+for width, height in image_sizes:
+    image = synthetic_image(width, height, seed=args.seed)
+    results[f"predict_{width}x{height}"] = measure(
+        f"predict {width}x{height}", lambda: model.predict(image, prompt), 1
+    )
+
+batch = [synthetic_image(*rng.choice(image_sizes), seed=args.seed + i) for i in range(args.batch_size)]
+results["predict_batch"] = measure(
+    f"predict_batch x{args.batch_size}",
+    lambda: model.predict_batch(batch, prompt, batch_size=args.batch_size), args.batch_size
+)
+
+image = synthetic_image(*image_sizes[0], seed=args.seed)
+results["predict_multiple"] = measure(
+    f"predict_multiple x{args.num_return_sequences}",
+    lambda: model.predict_multiple(image, prompt, num_return_sequences=args.num_return_sequences,
+                                   max_new_tokens=args.max_new_tokens, seed=args.seed),
+    1
+)
+
+class_names_dict = {0: "Black footed Albatross", 1: "Laysan Albatross", 2: "Crested Auklet"}
+dataset = [
+    {"image": synthetic_image(*rng.choice(image_sizes), seed=args.seed + i), "label": i % len(class_names_dict)}
+    for i in range(args.eval_samples)
+]
+with tempfile.TemporaryDirectory() as output_dir:
+    def evaluate():
+        # its per-sample printing is not part of the benchmark
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            evaluate_dataset(dataset, "Benchmark", os.path.join(output_dir, "predictions.txt"), prompt, model,
+                             class_names_dict, batching=BatchingOptions(batch_size=args.batch_size))
+    results["evaluate_dataset"] = measure(f"evaluate_dataset ({args.eval_samples} samples)", evaluate,
+                                          args.eval_samples)
+
+try:
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+except OSError:
+    commit = None
+run = {
+    "timestamp": datetime.datetime.now().strftime("%Y%m%d_%H%M%S"),
+    "commit": commit,
+    "hardware": hardware_fingerprint(model),
+    "config": {key: value for key, value in vars(args).items()
+               if key not in ("history", "baseline", "save_baseline", "tolerance", "check")},
+    "results": results,
+}
+
+# Compare with the baseline: p50 latency must not grow and throughput must not drop by more than the tolerance
+regressions = []
+if os.path.exists(args.baseline):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["hardware"] != run["hardware"] or baseline["config"] != run["config"]:
+        print("Warning: the baseline was measured on other hardware or with other options")
+    print(f"Compared with the baseline of {baseline['timestamp']} (commit {baseline['commit']}):")
+    for name, result in results.items():
+        if name not in baseline["results"]:
+            continue
+        reference = baseline["results"][name]
+        latency = result["latency_ms"]["p50"] / reference["latency_ms"]["p50"]
+        throughput = result["images_per_second"] / reference["images_per_second"]
+        regressed = latency > 1 + args.tolerance or throughput < 1 - args.tolerance
+        if regressed:
+            regressions.append(name)
+        print(f"  {name}: p50 latency x{latency:.2f}, throughput x{throughput:.2f}"
+              f"{'  REGRESSION' if regressed else ''}")
+    run["baseline"] = {"timestamp": baseline["timestamp"], "commit": baseline["commit"], "regressions": regressions}
+
+os.makedirs(os.path.dirname(args.history) or ".", exist_ok=True)
+history = []
+if os.path.exists(args.history):
+    with open(args.history) as f:
+        history = json.load(f)
+history.append(run)
+with open(args.history, "w") as f:
+    json.dump(history, f, indent=2)
+print(f"Appended to {args.history} ({len(history)} runs)")
+if args.save_baseline:
+    os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+    with open(args.baseline, "w") as f:
+        json.dump(run, f, indent=2)
+    print(f"Saved baseline to {args.baseline}")
+
+if args.check and regressions:
+    sys.exit(1)
@@ -0,0 +1,60 @@
+import os
+import re
+import json
+import time
+
+
+class Checkpoint:
+    """Progress of a long run in a JSON file, replaced atomically.
+
+    save() writes a temporary file, fsyncs it and renames it over the previous
+    checkpoint, so a job killed at any moment leaves either the old or the new
+    one. due() tells whether interval seconds have passed since the last save.
+    Outputs written alongside (see sync_file) should be synced before saving,
+    so that the checkpoint never points past what is on disk.
+    """
+    def __init__(self, path, interval=60.0):
+        self.path = path
+        self.interval = interval
+        self._last_save = time.monotonic()
+
+    def load(self):
+        """The last saved state, or None if there is none"""
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def due(self):
+        return time.monotonic() - self._last_save >= self.interval
+
+    def save(self, state):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+            sync_file(f)
+        os.replace(tmp_path, self.path)
+        self._last_save = time.monotonic()
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def sync_file(f):
+    """Flush an open file all the way to disk"""
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def latest_timestamp(directory, suffix=".checkpoint"):
+    """Run timestamp (YYYYmmdd_HHMMSS) in the name of the newest checkpoint in directory, or None"""
+    timestamps = [
+        match.group(0)
+        for filename in os.listdir(directory) if filename.endswith(suffix)
+        for match in [re.search(r"\d{8}_\d{6}", filename)] if match
+    ] if os.path.isdir(directory) else []
+    return max(timestamps, default=None)
@@ -0,0 +1,62 @@
+import json
+
+
+def cub_families(class_names_dict):
+    """CUB-200 species grouped by the family word ending their name (e.g. every "... Warbler").
+
+    Returns {group name: [class indices]} in class order.
+    """
+    groups = {}
+    for index in range(len(class_names_dict)):
+        groups.setdefault(class_names_dict[index].split()[-1], []).append(index)
+    return groups
+
+
+def taxonomy_groups(taxonomy, class_names, level="Level 2"):
+    """Classes grouped by the label of one level of a taxonomy.
+
+    taxonomy maps every class name to {"Level 1": {"label": ...}, ...}, as
+    hierarchical_datasets/caltech_hierarchical.json and
+    Flowers102.hierarchy_class do.
+    """
+    groups = {}
+    for index, name in enumerate(class_names):
+        groups.setdefault(taxonomy[name][level]["label"], []).append(index)
+    return groups
+
+
+def named_groups(members, class_names):
+    """Classes grouped by a {group name: [class names]} dict such as Flowers102.subclasses.
+
+    Underscores in the group names become spaces, as they are shown to the
+    model.
+    """
+    index = {name: i for i, name in enumerate(class_names)}
+    return {group.replace("_", " "): sorted(index[name] for name in names) for group, names in members.items()}
+
+
+def coarse_groups(groups, max_groups, other="Other"):
+    """At most max_groups groups: the max_groups - 1 largest ones, the others merged into a group named other.
+
+    The kept groups stay in their order (the earlier one wins ties in size)
+    and the merged group comes last, with its classes in class order.
+    """
+    if len(groups) <= max_groups:
+        return dict(groups)
+    if max_groups < 2:
+        raise ValueError("max_groups must be at least 2")
+    names = list(groups)
+    kept = set(sorted(names, key=lambda name: (-len(groups[name]), names.index(name)))[:max_groups - 1])
+    merged = {name: members for name, members in groups.items() if name in kept}
+    merged[other] = sorted(index for name in names if name not in kept for index in groups[name])
+    return merged
+
+
+def load_taxonomy(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def group_list(groups):
+    """Numbered list of the group names, in the format of CUB200Dataset.prompt_class_list"""
+    return "\n".join(f"{i + 1}. {group}" for i, group in enumerate(groups))
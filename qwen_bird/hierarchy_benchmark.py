@@ -0,0 +1,122 @@
+# Coarse-to-fine (--hierarchical) vs. flat closed-set prompting on CUB-200, Caltech101 or Flowers102
+from dataset import CUB200Dataset
+from model import QwenVLModel
+from evaluation import evaluate_dataset
+from candidates import class_list
+from hierarchy import cub_families, taxonomy_groups, named_groups, coarse_groups, load_taxonomy, group_list
+import os
+import sys
+import json
+import random
+import datetime
+import argparse
+
+# Base path configuration
+BASE_PATH = "/home/samuele.angheben/vision-reasoning/qwen_bird"
+DATASET_PATH = "/home/samuele.angheben/datasets"
+HIERARCHY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "hierarchical_datasets")
+
+# Caltech101 with its test split, then Flowers102 and the taxonomies
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "qwen_caltech_set"))
+sys.path.append(HIERARCHY_PATH)
+
+# (object, class, classes, group, groups, merged group) as the prompts name them
+WORDS = {
+    "cub": ("bird", "species", "species", "family", "families", "Other birds"),
+    "caltech101": ("object", "category", "categories", "kind", "kinds", "Other objects"),
+    "flowers102": ("flower", "flower", "flowers", "type", "types", "Other flowers"),
+}
+
+parser = argparse.ArgumentParser(description="Compare flat and coarse-to-fine prompting on a subset of a test split")
+parser.add_argument("--dataset", choices=list(WORDS), default="cub")
+parser.add_argument("--num-samples", type=int, default=200)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--max-groups", type=int, default=16,
+                    help="Coarse groups listed in the first turn: the largest ones, the others merged into one")
+parser.add_argument("--level", default="Level 1", help="Level of caltech_hierarchical.json grouping Caltech101")
+parser.add_argument("--constrained", action="store_true", help="Constrain every answer to the listed names")
+parser.add_argument("--max-new-tokens", type=int, default=64)
+args = parser.parse_args()
+if args.max_groups < 2:
+    parser.error("--max-groups must be at least 2")
+
+class LabeledImages:
+    """Some samples of a dataset of (image, label) tuples as the {"image", "label"} dicts evaluate_dataset reads"""
+    def __init__(self, dataset, indices):
+        self.dataset = dataset
+        self.indices = list(indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        image, label = self.dataset[self.indices[i]]
+        return {"image": image, "label": label}
+
+def sample_indices(size):
+    return sorted(random.Random(args.seed).sample(range(size), min(args.num_samples, size)))
+
+obj, class_word, classes_word, group_word, groups_word, other = WORDS[args.dataset]
+if args.dataset == "cub":
+    CUB200Dataset = CUB200Dataset(split='test')
+    class_names_dict = CUB200Dataset.class_names_dict
+    groups = cub_families(class_names_dict)
+    dataset = CUB200Dataset.get_dataset()
+    samples = dataset.select(sample_indices(len(dataset)))
+elif args.dataset == "caltech101":
+    from caltech101 import Caltech101
+    dataset = Caltech101(root=DATASET_PATH, download=True, split='test', transform=None)
+    class_names_dict = {i: cat.replace('_', ' ') for i, cat in enumerate(dataset.categories)}
+    groups = taxonomy_groups(load_taxonomy(os.path.join(HIERARCHY_PATH, "caltech_hierarchical.json")),
+                             dataset.categories, level=args.level)
+    samples = LabeledImages(dataset, sample_indices(len(dataset)))
+else:
+    from flower102 import Flowers102
+    dataset = Flowers102(root=DATASET_PATH, split='test', download=True)
+    class_names_dict = dict(enumerate(Flowers102.classes))
+    groups = named_groups(Flowers102.subclasses, Flowers102.classes)
+    samples = LabeledImages(dataset, sample_indices(len(dataset)))
+groups = coarse_groups(groups, args.max_groups, other=other)
+print(f"{len(groups)} groups: {', '.join(f'{name} ({len(members)})' for name, members in groups.items())}")
+
+flat_prompt = (f"Please identify the {obj} in this image. Choose from the following list of {classes_word}:\n\n"
+               f"{class_list(class_names_dict, range(len(class_names_dict)))}\n\n"
+               f"Provide your answer as the {class_word} name.")
+group_prompt = (f"Please identify the {obj} in this image. Choose its {group_word} from the following list of "
+                f"{groups_word}:\n\n{group_list(groups)}\n\nProvide your answer as the {group_word} name.")
+followup_prompt = (f"Now choose the {class_word} from the following list of {{group}} {classes_word}:\n\n"
+                   f"{{class_list}}\n\nProvide your answer as the {class_word} name.")
+
+model = QwenVLModel(max_new_tokens=args.max_new_tokens)
+
+os.makedirs(f"{BASE_PATH}/outputs", exist_ok=True)
+timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+result = {"dataset": args.dataset, "num_samples": len(samples),
+          "groups": {name: len(members) for name, members in groups.items()}}
+# one sample at a time in both modes, so that every answer costs one prefill and a decode step per further token
+for mode, prompt, hierarchy in [("flat", flat_prompt, None), ("hierarchical", group_prompt, groups)]:
+    correct, total = evaluate_dataset(
+        samples, f"{args.dataset} {mode}", f"{BASE_PATH}/outputs/hierarchy_{args.dataset}_{mode}_{timestamp}.txt",
+        prompt, model, class_names_dict, constrained=args.constrained, hierarchy=hierarchy,
+        followup_prompt=followup_prompt
+    )
+    stats = model.generation_stats
+    result[mode] = {
+        "accuracy": correct / total,
+        "prompt_tokens_per_sample": stats["prompt_tokens"] / total,
+        "generated_tokens_per_sample": stats["generated_tokens"] / total,
+        # the prefill of every turn produces its first token
+        "prefills_per_sample": stats["sequences"] / total,
+        "decode_steps_per_sample": (stats["generated_tokens"] - stats["sequences"]) / total,
+        "ms_per_sample": 1000 * stats["seconds"] / total,
+    }
+# hierarchical / flat
+result["ratios"] = {key: result["hierarchical"][key] / result["flat"][key]
+                    for key in ("prompt_tokens_per_sample", "decode_steps_per_sample", "ms_per_sample")
+                    if result["flat"][key]}
+print(json.dumps(result, indent=2))
+
+output_file = f"{BASE_PATH}/outputs/hierarchy_{args.dataset}_{timestamp}.json"
+with open(output_file, "w") as f:
+    json.dump(result, f, indent=2)
+print(f"Saved benchmark results to {output_file}")
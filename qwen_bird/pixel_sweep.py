@@ -0,0 +1,101 @@
+# Accuracy vs. speed of Qwen2.5-VL on CUB-200 at several visual token budgets
+from dataset import CUB200Dataset
+from model import QwenVLModel
+import os
+import re
+import json
+import time
+import random
+import datetime
+import argparse
+from collections import defaultdict
+
+# Base path configuration
+BASE_PATH = "/home/samuele.angheben/vision-reasoning/qwen_bird"
+
+parser = argparse.ArgumentParser(description="Sweep the visual token budget on a stratified subset of the CUB-200 test split")
+parser.add_argument("--budgets", default="none,64,128,256,512,1024",
+                    help="Comma separated visual token budgets per image, 'none' keeps the processor default")
+parser.add_argument("--fixed-tokens", action="store_true",
+                    help="Resize every image to about the budget instead of using it as an upper bound")
+parser.add_argument("--per-class", type=int, default=2, help="Images sampled from each class")
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--batch-size", type=int, default=1, help="Number of images per generate call")
+parser.add_argument("--constrained", action="store_true",
+                    help="Constrain generation to the class names")
+args = parser.parse_args()
+
+CUB200Dataset = CUB200Dataset(split='test')
+class_names_dict = CUB200Dataset.class_names_dict
+class_names = [class_names_dict[i] for i in range(len(class_names_dict))]
+
+# Stratified subset: the same per_class images of every class for all budgets
+indices_by_label = defaultdict(list)
+for idx, label in enumerate(CUB200Dataset.get_dataset()["label"]):
+    indices_by_label[label].append(idx)
+rng = random.Random(args.seed)
+subset_indices = sorted(
+    idx for indices in indices_by_label.values() for idx in rng.sample(indices, min(args.per_class, len(indices)))
+)
+subset = CUB200Dataset.get_dataset().select(subset_indices)
+images = [sample["image"] for sample in subset]
+ground_truths = [class_names_dict[sample["label"]] for sample in subset]
+print(f"Sweeping {len(images)} images ({args.per_class} per class)")
+
+model = QwenVLModel()
+prompt = f"Please identify the bird species in this image. Choose from the following list of bird species:\n\n{CUB200Dataset.prompt_class_list}\n\nProvide your answer as the species name."
+labels = class_names if args.constrained else None
+default_budget = dict(min_pixels=model.processor.image_processor.size["shortest_edge"],
+                      max_pixels=model.processor.image_processor.size["longest_edge"])
+
+def normalize_text(text):
+    """Normalize text by replacing punctuation with spaces and converting to lowercase"""
+    text = re.sub(r'[^a-zA-Z\s]', ' ', text.lower())
+    return ' '.join(text.split())
+
+results = []
+for budget in args.budgets.split(","):
+    if budget == "none":
+        model.set_image_budget(**default_budget)
+    elif args.fixed_tokens:
+        model.set_image_budget(image_tokens=int(budget))
+    else:
+        model.set_image_budget(max_pixels=int(budget) * model.pixels_per_token())
+
+    # Prefill latency: a single forward pass over the prompt and image tokens
+    prefill_seconds = 0.0
+    for start in range(0, len(images), args.batch_size):
+        batch = images[start:start + args.batch_size]
+        begin = time.perf_counter()
+        model.predict_batch(batch, prompt, batch_size=args.batch_size, max_new_tokens=1)
+        prefill_seconds += time.perf_counter() - begin
+
+    model.reset_generation_stats()
+    begin = time.perf_counter()
+    predictions = model.predict_batch(images, prompt, batch_size=args.batch_size, labels=labels)
+    total_seconds = time.perf_counter() - begin
+    correct = sum(
+        normalize_text(ground_truth) in normalize_text(prediction)
+        for ground_truth, prediction in zip(ground_truths, predictions)
+    )
+    stats = model.generation_stats
+    result = {
+        "budget": budget,
+        "fixed_tokens": args.fixed_tokens,
+        "min_pixels": model.min_pixels,
+        "max_pixels": model.max_pixels,
+        "accuracy": correct / len(images),
+        "tokens_per_image": stats["image_tokens"] / stats["images"],
+        "prefill_ms_per_image": 1000 * prefill_seconds / len(images),
+        "total_ms_per_image": 1000 * total_seconds / len(images),
+    }
+    results.append(result)
+    print(f"budget={budget}: accuracy={result['accuracy']:.4f} tokens/image={result['tokens_per_image']:.1f} "
+          f"prefill={result['prefill_ms_per_image']:.1f}ms/image total={result['total_ms_per_image']:.1f}ms/image")
+
+os.makedirs(f"{BASE_PATH}/outputs", exist_ok=True)
+timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+output_file = f"{BASE_PATH}/outputs/pixel_sweep_{timestamp}.json"
+with open(output_file, "w") as f:
+    json.dump({"per_class": args.per_class, "seed": args.seed, "num_images": len(images), "results": results}, f, indent=2)
+print(f"Saved sweep results to {output_file}")
@@ -0,0 +1,127 @@
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+import torch
+
+
+class Profiler:
+    """Per-stage wall time, token counts and peak memory of QwenVLModel calls.
+
+    Pass one to QwenVLModel(profiler=...). Every prepare_batch, generate and
+    sampling call becomes a record with the seconds spent in each of its
+    stages (vision_info, image_processor, splice_tokens, to_device,
+    prefill, decode, batch_decode, ...), its visual, prompt and generated token counts
+    and the peak memory (GPU allocator when on CUDA, else the peak resident
+    set of the process). GPU stages are synchronized before they are timed,
+    so profiling slows asynchronous GPU work down a little; without a
+    profiler the model does not time anything.
+
+    summary() aggregates the records of a run into percentiles per call kind
+    and stage, save() writes both as JSON.
+    """
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def reset(self):
+        with self._lock:
+            self.records = []
+
+    @contextmanager
+    def call(self, kind):
+        """Open the record of one call on this thread; calls nested in it add to it"""
+        if getattr(self._local, "record", None) is not None:
+            yield self._local.record
+            return
+        record = {"kind": kind, "seconds": 0.0, "stages": {}, "tokens": {}}
+        self._local.record = record
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        begin = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - begin
+            record["peak_memory_bytes"] = _peak_memory()
+            self._local.record = None
+            with self._lock:
+                self.records.append(record)
+
+    @contextmanager
+    def stage(self, name, synchronize=False):
+        """Time a stage of the current call; synchronize waits for the GPU work it queued"""
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            if synchronize and torch.cuda.is_available():
+                torch.cuda.synchronize()
+            self.add_seconds(name, time.perf_counter() - begin)
+
+    def add_seconds(self, name, seconds):
+        record = getattr(self._local, "record", None)
+        if record is not None:
+            record["stages"][name] = record["stages"].get(name, 0.0) + seconds
+
+    def count(self, name, tokens):
+        """Add to a token count (visual, prompt, generated) of the current call"""
+        record = getattr(self._local, "record", None)
+        if record is not None:
+            record["tokens"][name] = record["tokens"].get(name, 0) + int(tokens)
+
+    def summary(self):
+        """Percentiles of the call and stage times, token counts and peak memory, per call kind"""
+        with self._lock:
+            records = list(self.records)
+        summary = {}
+        for kind in sorted({record["kind"] for record in records}):
+            calls = [record for record in records if record["kind"] == kind]
+            stages = sorted({stage for record in calls for stage in record["stages"]})
+            tokens = sorted({name for record in calls for name in record["tokens"]})
+            summary[kind] = {
+                "calls": len(calls),
+                "seconds": _percentiles([record["seconds"] for record in calls]),
+                "stages": {
+                    stage: _percentiles([record["stages"][stage] for record in calls if stage in record["stages"]])
+                    for stage in stages
+                },
+                "tokens": {name: _percentiles([record["tokens"].get(name, 0) for record in calls]) for name in tokens},
+                "peak_memory_bytes": max(record["peak_memory_bytes"] for record in calls),
+            }
+        return summary
+
+    def save(self, path):
+        with self._lock:
+            records = list(self.records)
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "records": records}, f, indent=2)
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def percentile(q):
+        # nearest rank
+        return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+    return {
+        "count": len(values),
+        "total": sum(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": values[-1],
+    }
+
+
+def _peak_memory():
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated()
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,61 @@
+# Speed of prompt-lookup speculative decoding vs. plain greedy decoding on the CUB-200 closed-set prompt
+from dataset import CUB200Dataset
+from model import QwenVLModel
+import os
+import json
+import time
+import random
+import datetime
+import argparse
+
+# Base path configuration
+BASE_PATH = "/home/samuele.angheben/vision-reasoning/qwen_bird"
+
+parser = argparse.ArgumentParser(description="Compare prompt-lookup and greedy decoding on a subset of the CUB-200 test split")
+parser.add_argument("--num-samples", type=int, default=200)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--draft-tokens", type=int, default=10, help="Maximum number of drafted tokens per step")
+parser.add_argument("--max-new-tokens", type=int, default=64)
+args = parser.parse_args()
+
+CUB200Dataset = CUB200Dataset(split='test')
+dataset = CUB200Dataset.get_dataset()
+indices = sorted(random.Random(args.seed).sample(range(len(dataset)), min(args.num_samples, len(dataset))))
+images = [sample["image"] for sample in dataset.select(indices)]
+
+model = QwenVLModel(max_new_tokens=args.max_new_tokens)
+prompt = f"Please identify the bird species in this image. Choose from the following list of bird species:\n\n{CUB200Dataset.prompt_class_list}\n\nProvide your answer as the species name."
+
+# Warm up so that neither run pays for one-time initialization
+model.predict(images[0], prompt)
+
+model.reset_generation_stats()
+begin = time.perf_counter()
+greedy = model.predict_batch(images, prompt, batch_size=1)
+greedy_seconds = time.perf_counter() - begin
+
+model.reset_generation_stats()
+begin = time.perf_counter()
+lookup = model.predict_batch(images, prompt, prompt_lookup_tokens=args.draft_tokens)
+lookup_seconds = time.perf_counter() - begin
+stats = model.generation_stats
+
+result = {
+    "num_samples": len(images),
+    "draft_tokens": args.draft_tokens,
+    "acceptance_rate": stats["accepted_tokens"] / stats["draft_tokens"] if stats["draft_tokens"] else 0.0,
+    # the prefill of every sample produces its first token
+    "tokens_per_forward_pass": stats["generated_tokens"] / (stats["decode_steps"] + stats["sequences"]),
+    "greedy_ms_per_sample": 1000 * greedy_seconds / len(images),
+    "prompt_lookup_ms_per_sample": 1000 * lookup_seconds / len(images),
+    "speedup": greedy_seconds / lookup_seconds,
+    "identical_outputs": sum(a == b for a, b in zip(greedy, lookup)),
+}
+print(json.dumps(result, indent=2))
+
+os.makedirs(f"{BASE_PATH}/outputs", exist_ok=True)
+timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+output_file = f"{BASE_PATH}/outputs/prompt_lookup_{timestamp}.json"
+with open(output_file, "w") as f:
+    json.dump(result, f, indent=2)
+print(f"Saved benchmark results to {output_file}")
@@ -0,0 +1,393 @@
+# Keep Qwen2.5-VL loaded in one process and serve it to the evaluation scripts (see their --server flag)
+import io
+import json
+import time
+import queue
+import base64
+import argparse
+import itertools
+import threading
+import urllib.error
+import urllib.request
+from collections import deque, namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+from model import QwenVLModel, _round_seed
+
+# prepare_batch of RemoteQwenVLModel: the encoded images and their prompts
+RemoteBatch = namedtuple("RemoteBatch", ["images", "prompts", "prefix"])
+
+METHODS = ("predict_batch", "predict_multiple", "score_classes")
+
+
+def _encode_image(image):
+    """JSON form of an image: paths and URLs are sent as is, PIL images as PNG"""
+    if isinstance(image, str):
+        return {"path": image}
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return {"png": base64.b64encode(buffer.getvalue()).decode("ascii")}
+
+
+def _decode_image(data):
+    if "path" in data:
+        return data["path"]
+    return Image.open(io.BytesIO(base64.b64decode(data["png"]))).convert("RGB")
+
+
+class _Call:
+    """One client request waiting for the model thread"""
+    def __init__(self, method, images, kwargs):
+        self.method = method
+        self.images = images
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.stats = None
+        self.done = threading.Event()
+
+    def merge_key(self):
+        """predict_batch calls with the same key can share a batch"""
+        kwargs = self.kwargs
+        labels = tuple(kwargs["labels"]) if kwargs.get("labels") is not None else None
+        return kwargs.get("prefix"), labels, kwargs.get("dedupe_images"), kwargs.get("prompt_lookup_tokens")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/stats":
+            self._reply(404, {"error": f"Unknown path {self.path}"})
+            return
+        self._reply(200, self.server.model_server.stats())
+
+    def do_POST(self):
+        if self.path != "/call":
+            self._reply(404, {"error": f"Unknown path {self.path}"})
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if request["method"] not in METHODS:
+            self._reply(400, {"error": f"Unsupported method {request['method']}"})
+            return
+        # images are decoded on the connection thread, in parallel with the model
+        call = _Call(request["method"], [_decode_image(image) for image in request["images"]], request["kwargs"])
+        self.server.model_server.submit(call)
+        if call.error is not None:
+            self._reply(500, {"error": call.error})
+        else:
+            self._reply(200, {"result": call.result, "stats": call.stats})
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ModelServer:
+    """Serve one warm QwenVLModel to several client processes over localhost HTTP.
+
+    Clients (see RemoteQwenVLModel) POST calls to /call and GET /stats reports
+    the server counters. Connections are handled on their own threads, but all
+    model work runs on a single thread in arrival order. predict_batch calls
+    that arrive within max_wait seconds of each other and share prefix, labels
+    and decoding mode are merged into one predict_batch of at most
+    max_batch_size images, so several clients running with batch size 1 still
+    fill a batch. Every reply carries the call's share of generation_stats.
+
+    Any QwenVLModel works, including a tiny randomly initialized one on CPU.
+    """
+    def __init__(self, model, host="127.0.0.1", port=8765, max_batch_size=8, max_wait=0.01):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._held = deque()  # calls taken off the queue that did not fit in the last batch
+        self.calls = 0
+        self.model_calls = 0
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.model_server = self
+        self.address = self.httpd.server_address
+        self._threads = []
+
+    def submit(self, call):
+        """Queue a call and wait until the model thread is done with it"""
+        self._queue.put(call)
+        call.done.wait()
+        return call
+
+    def serve_forever(self):
+        """Answer connections in the background and run the model on the calling thread"""
+        http_thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        http_thread.start()
+        try:
+            self._run_model()
+        finally:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+    def start(self):
+        """Run both the connections and the model in background threads"""
+        self._threads = [
+            threading.Thread(target=self.httpd.serve_forever, daemon=True),
+            threading.Thread(target=self._run_model, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def shutdown(self):
+        self._queue.put(None)
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        stats = {
+            "calls": self.calls,
+            "model_calls": self.model_calls,
+            "calls_per_model_call": self.calls / self.model_calls if self.model_calls else 0.0,
+            "generation_stats": self.model.generation_stats,
+        }
+        stats.update(self.model.throughput())
+        return stats
+
+    def _next_call(self, timeout=None):
+        if self._held:
+            return self._held.popleft()
+        return self._queue.get(timeout=timeout)
+
+    def _run_model(self):
+        while True:
+            call = self._next_call()
+            if call is None:
+                return
+            calls = self._gather(call) if call.method == "predict_batch" else [call]
+            self._execute(calls)
+
+    def _gather(self, first):
+        """Collect the predict_batch calls that can join first in one batch"""
+        calls, num_images = [first], len(first.images)
+        key = first.merge_key()
+        deadline = time.perf_counter() + self.max_wait
+        skipped = []
+        while num_images < self.max_batch_size:
+            try:
+                call = self._next_call(timeout=max(deadline - time.perf_counter(), 0.0))
+            except queue.Empty:
+                break
+            if call is None:
+                skipped.append(call)
+                break
+            if (call.method != "predict_batch" or call.merge_key() != key
+                    or num_images + len(call.images) > self.max_batch_size):
+                skipped.append(call)
+                continue
+            calls.append(call)
+            num_images += len(call.images)
+        self._held.extendleft(reversed(skipped))
+        return calls
+
+    def _execute(self, calls):
+        before = dict(self.model.generation_stats)
+        try:
+            if calls[0].method == "predict_batch":
+                results = self._predict_batch(calls)
+            elif calls[0].method == "predict_multiple":
+                results = [self.model.predict_multiple(calls[0].images[0], **calls[0].kwargs)]
+            else:
+                results = [self.model.score_classes(calls[0].images[0], **calls[0].kwargs)]
+        except Exception as error:
+            for call in calls:
+                call.error = f"{type(error).__name__}: {error}"
+                call.done.set()
+            return
+        self.calls += len(calls)
+        self.model_calls += 1
+        # merged calls split the stats of the batch by their number of images
+        total = sum(len(call.images) for call in calls)
+        delta = {key: self.model.generation_stats[key] - before[key] for key in before}
+        for call, result in zip(calls, results):
+            share = len(call.images) / total
+            call.result = result
+            call.stats = {key: value * share if isinstance(value, float) else round(value * share)
+                          for key, value in delta.items()}
+            call.done.set()
+
+    def _predict_batch(self, calls):
+        options = dict(calls[0].kwargs)
+        prompts, budgets, stop_strings = [], [], []
+        for call in calls:
+            prompts.extend(call.kwargs["prompts"])
+            budgets.extend(call.kwargs["max_new_tokens"])
+            stop_strings.extend(call.kwargs["stop_strings"])
+        for key in ("prompts", "max_new_tokens", "stop_strings"):
+            del options[key]
+        outputs = self.model.predict_batch(
+            [image for call in calls for image in call.images], prompts, batch_size=self.max_batch_size,
+            max_new_tokens=budgets, stop_strings=stop_strings, **options
+        )
+        results, start = [], 0
+        for call in calls:
+            results.append(outputs[start:start + len(call.images)])
+            start += len(call.images)
+        return results
+
+
+class RemoteQwenVLModel:
+    """Stand-in for QwenVLModel in the evaluation scripts that sends the work to a ModelServer.
+
+    prepare_batch only encodes the images, so it still runs in the pipeline
+    workers, and generation_stats / throughput count this client's share of
+    the server work. The image budget, vision cache and device are options
+    of the server; ContinuousBatcher and set_image_budget need the model
+    in-process. predict_multiple_rounds prefills the image again every round.
+    """
+    # the counters are the same as the in-process model's
+    reset_generation_stats = QwenVLModel.reset_generation_stats
+    throughput = QwenVLModel.throughput
+
+    def __init__(self, url="http://127.0.0.1:8765", max_new_tokens=64, timeout=None):
+        self.url = url.rstrip("/")
+        self.max_new_tokens = max_new_tokens
+        self.timeout = timeout
+        self.vision_cache = None
+        self.reset_generation_stats()
+
+    def _call(self, method, images, **kwargs):
+        request = urllib.request.Request(
+            f"{self.url}/call", data=json.dumps({"method": method, "images": images, "kwargs": kwargs}).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                reply = json.load(response)
+        except urllib.error.HTTPError as error:
+            raise RuntimeError(f"Model server error: {json.load(error).get('error')}") from None
+        for key, value in reply["stats"].items():
+            self.generation_stats[key] = self.generation_stats.get(key, 0) + value
+        return reply["result"]
+
+    def server_stats(self):
+        with urllib.request.urlopen(f"{self.url}/stats", timeout=self.timeout) as response:
+            return json.load(response)
+
+    def prepare_batch(self, images, prompts, prefix=None):
+        images = list(images)
+        if isinstance(prompts, str):
+            prompts = [prompts] * len(images)
+        return RemoteBatch([_encode_image(image) for image in images], list(prompts), prefix)
+
+    def predict(self, image, prompt, max_new_tokens=None, prefix=None, labels=None, stop_strings=None,
+                prompt_lookup_tokens=None):
+        return self.predict_batch(
+            [image], [prompt], batch_size=1, max_new_tokens=max_new_tokens, prefix=prefix, labels=labels,
+            stop_strings=stop_strings, prompt_lookup_tokens=prompt_lookup_tokens
+        )[0]
+
+    def predict_batch(self, images, prompts, batch_size=8, max_new_tokens=None, prefix=None, labels=None,
+                      dedupe_images=False, stop_strings=None, prompt_lookup_tokens=None):
+        """QwenVLModel.predict_batch, one request per batch_size images"""
+        images = list(images)
+        if isinstance(prompts, str):
+            prompts = [prompts] * len(images)
+        budgets, stop_strings = self._plan(len(images), max_new_tokens, stop_strings)
+        outputs = []
+        for start in range(0, len(images), batch_size):
+            outputs.extend(self.predict_prepared(
+                self.prepare_batch(images[start:start + batch_size], prompts[start:start + batch_size], prefix),
+                budgets[start:start + batch_size], labels, dedupe_images, stop_strings[start:start + batch_size],
+                prompt_lookup_tokens
+            ))
+        return outputs
+
+    def predict_prepared(self, prepared, max_new_tokens=None, labels=None, dedupe_images=False, stop_strings=None,
+                         prompt_lookup_tokens=None):
+        budgets, stop_strings = self._plan(len(prepared.images), max_new_tokens, stop_strings)
+        return self._call(
+            "predict_batch", prepared.images, prompts=prepared.prompts, max_new_tokens=budgets,
+            stop_strings=stop_strings, prefix=prepared.prefix, labels=None if labels is None else list(labels),
+            dedupe_images=dedupe_images, prompt_lookup_tokens=prompt_lookup_tokens
+        )
+
+    def _plan(self, num_prompts, max_new_tokens, stop_strings):
+        """Per-prompt token budgets and stop strings, so that requests can be merged on the server"""
+        if max_new_tokens is None:
+            max_new_tokens = self.max_new_tokens
+        budgets = [max_new_tokens] * num_prompts if isinstance(max_new_tokens, int) else list(max_new_tokens)
+        if not stop_strings or isinstance(stop_strings[0], str):
+            stop_strings = [stop_strings] * num_prompts
+        return budgets, list(stop_strings)
+
+    def predict_multiple(self, image, prompt, **kwargs):
+        return self.predict_multiple_prepared(self.prepare_batch([image], [prompt]), **kwargs)
+
+    def predict_multiple_prepared(self, prepared, do_sample=True, top_k=50, top_p=0.9, temperature=1.3,
+                                  num_return_sequences=10, max_new_tokens=256, stop_strings=None,
+                                  max_sample_memory=None, seed=None):
+        return self._call(
+            "predict_multiple", prepared.images, prompt=prepared.prompts[0], do_sample=do_sample, top_k=top_k,
+            top_p=top_p, temperature=temperature, num_return_sequences=num_return_sequences,
+            max_new_tokens=max_new_tokens, stop_strings=stop_strings, max_sample_memory=max_sample_memory, seed=seed
+        )
+
+    def predict_multiple_rounds(self, prepared, round_size=10, seed=None, **kwargs):
+        for round_index in itertools.count():
+            # the seed of each round is the one QwenVLModel.predict_multiple_rounds uses
+            yield self.predict_multiple_prepared(
+                prepared, num_return_sequences=round_size, seed=_round_seed(seed, round_index), **kwargs
+            )
+
+    def score_classes(self, image, prompt, class_names, length_normalize=False, max_tree_tokens=1024):
+        scores = self._call(
+            "score_classes", [_encode_image(image)], prompt=prompt, class_names=list(class_names),
+            length_normalize=length_normalize, max_tree_tokens=max_tree_tokens
+        )
+        return [tuple(score) for score in scores]
+
+
+if __name__ == "__main__":
+    from vision_cache import VisionFeatureCache
+    from result_store import ResultStore
+
+    parser = argparse.ArgumentParser(description="Serve a warm Qwen2.5-VL model to the scripts' --server mode")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--model-name", default="Qwen/Qwen2.5-VL-3B-Instruct")
+    parser.add_argument("--max-batch-size", type=int, default=8,
+                        help="Images per generate call when merging requests of several clients")
+    parser.add_argument("--max-wait-ms", type=float, default=10.0,
+                        help="How long a request waits for others to share its batch")
+    parser.add_argument("--vision-cache", default=None,
+                        help="Directory of the on-disk cache of visual features (disabled if not set)")
+    parser.add_argument("--result-store", default=None,
+                        help="SQLite file memoizing generations across runs (greedy results, and sampled ones "
+                             "with a seed)")
+    parser.add_argument("--min-pixels", type=int, default=None, help="Lower bound on the pixels of each image")
+    parser.add_argument("--max-pixels", type=int, default=None, help="Upper bound on the pixels of each image")
+    parser.add_argument("--image-tokens", type=int, default=None,
+                        help="Resize every image to about this many visual tokens")
+    parser.add_argument("--device", default=None,
+                        help="auto, cuda, cuda:N or cpu (default: auto when a GPU is visible, else cpu)")
+    parser.add_argument("--dtype", default="auto", help="auto, bfloat16, float16 or float32 (auto is bfloat16 on CPU)")
+    parser.add_argument("--quantize", choices=["int8"], default=None,
+                        help="Dynamically quantize the linear layers (CPU only)")
+    parser.add_argument("--num-threads", type=int, default=None, help="CPU threads (default: all available cores)")
+    args = parser.parse_args()
+
+    vision_cache = VisionFeatureCache(args.vision_cache) if args.vision_cache else None
+    result_store = ResultStore(args.result_store) if args.result_store else None
+    model = QwenVLModel(args.model_name, vision_cache=vision_cache, min_pixels=args.min_pixels,
+                        max_pixels=args.max_pixels, image_tokens=args.image_tokens, device=args.device,
+                        dtype=args.dtype, quantize=args.quantize, num_threads=args.num_threads,
+                        result_store=result_store)
+    server = ModelServer(model, args.host, args.port, max_batch_size=args.max_batch_size,
+                         max_wait=args.max_wait_ms / 1000)
+    print(f"Serving {args.model_name} on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,517 @@
+# Equivalence tests of QwenVLModel on a tiny random Qwen2.5-VL (CPU, nothing downloaded): python -m pytest qwen_bird
+import os
+import re
+import sys
+import time
+import threading
+import multiprocessing
+import pytest
+import torch
+from qwen_vl_utils import process_vision_info
+from tiny_model import tiny_qwen_vl_model, synthetic_image
+from server import ModelServer, RemoteQwenVLModel
+from scheduler import ContinuousBatcher
+from vision_cache import VisionFeatureCache
+from result_store import ResultStore
+from sharding import shard_range
+from evaluation import evaluate_dataset, BatchingOptions, CheckpointOptions
+from bucketing import bucket_batches
+from candidates import CandidateFilter, recall_at_k
+
+# the Caltech101 prompt sweep, whose other modules are copies of those here
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "qwen_caltech_set"))
+from sweep import run_sweep, save_outputs, merge_outputs
+
+IMAGE_SIZES = [(224, 224), (500, 120), (64, 64), (333, 777)]
+PROMPTS = ["Please identify the bird species in this image.", "", "héllo  wörld\n\t <answer>", "Crested Auklet"]
+PREFIX = "Choose from the following list of bird species"
+# an answer repeating the prompt, so that prompt-lookup drafts are accepted
+LOOKUP_PROMPT = "Repeat after me: Black footed Albatross, Laysan Albatross, Sooty Albatross, Crested Auklet. " * 3
+# names sharing prefixes, one of them a whole other name
+SCORED_CLASSES = ["Black footed Albatross", "Black Tern", "Laysan Albatross", "Laysan", "Crested Auklet",
+                  "Least Auklet", "Least Flycatcher"]
+EVAL_CLASSES = {0: "Black footed Albatross", 1: "Laysan Albatross", 2: "Crested Auklet"}
+SWEEP_CATEGORIES = ["Faces_easy", "Leopards", "car_side"]
+SWEEP_PROMPTS = {"prompt1": ("Identify the object. Use 1 to 3 words.", False),
+                 "prompt2": ("What is this? Answer inside <answer></answer> tags.", True)}
+
+
+@pytest.fixture(scope="module")
+def model():
+    return tiny_qwen_vl_model(max_new_tokens=16)
+
+
+@pytest.fixture(scope="module")
+def images():
+    return [synthetic_image(width, height, seed=i) for i, (width, height) in enumerate(IMAGE_SIZES)]
+
+
+@pytest.fixture(scope="module")
+def samples():
+    """A small evaluate_dataset dataset, with images of every size"""
+    return [{"image": synthetic_image(*IMAGE_SIZES[i % len(IMAGE_SIZES)], seed=i), "label": i % len(EVAL_CLASSES)}
+            for i in range(7)]
+
+
+def processor_inputs(model, images, prompts, prefix=None):
+    """Inputs of the plain path: chat template and processor(...) on the whole batch"""
+    texts, image_inputs = [], []
+    for image, prompt in zip(images, prompts):
+        messages = model._build_messages(image, prompt, prefix=prefix)
+        texts.append(model.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True))
+        image_inputs.extend(process_vision_info(messages)[0])
+    return model.processor(text=texts, images=image_inputs, videos=None, padding=True, return_tensors="pt")
+
+
+def generate_texts(model, inputs, **generate_kwargs):
+    """Answers of plain model.generate on prepared inputs"""
+    output = model.model.generate(**inputs, max_new_tokens=model.max_new_tokens, **generate_kwargs)
+    return model.processor.batch_decode(
+        output[:, inputs.input_ids.shape[1]:], skip_special_tokens=True, clean_up_tokenization_spaces=False
+    )
+
+
+@pytest.mark.parametrize("prefix", [None, PREFIX])
+@pytest.mark.parametrize("same_prompt", [False, True])
+def test_spliced_inputs_match_processor(model, images, prefix, same_prompt):
+    prompts = [PROMPTS[0]] * len(images) if same_prompt else PROMPTS
+    expected = processor_inputs(model, images, prompts, prefix)
+    # prompts are compiled once they are used again (at once for those repeated in a batch)
+    for _ in range(2):
+        spliced = model.prepare_batch(images, prompts, prefix=prefix).inputs
+        assert list(spliced.keys()) == list(expected.keys())
+        for key in ("input_ids", "attention_mask", "pixel_values", "image_grid_thw"):
+            assert spliced[key].dtype == expected[key].dtype
+            assert torch.equal(spliced[key], expected[key]), key
+    assert all(model._compiled_prompts[(prompt, prefix)] is not None for prompt in prompts)
+
+
+@pytest.mark.parametrize("budget", [{}, {"min_pixels": 16 * 28 * 28, "max_pixels": 64 * 28 * 28}])
+def test_image_grid_thw_matches_processor(images, budget):
+    model = tiny_qwen_vl_model(max_new_tokens=1, **budget)
+    expected = processor_inputs(model, images, PROMPTS).image_grid_thw.tolist()
+    assert [list(model.image_grid_thw(*image.size)) for image in images] == expected
+
+
+@pytest.mark.parametrize("batch_size", [2, 4])
+def test_predict_batch_matches_predict(model, images, batch_size):
+    expected = [model.predict(image, prompt) for image, prompt in zip(images, PROMPTS)]
+    assert model.predict_batch(images, PROMPTS, batch_size=batch_size) == expected
+
+
+def test_out_of_memory_split_keeps_row_order(model, images, monkeypatch):
+    budgets = [16, 3, 9, 5]
+    stop_strings = [None, ["|"], None, ["am"]]
+    expected = [model.predict(image, prompt, max_new_tokens=budget, stop_strings=stop)
+                for image, prompt, budget, stop in zip(images, PROMPTS, budgets, stop_strings)]
+    generate_batch = model._generate_batch
+
+    def out_of_memory(prepared, *args):
+        # only single rows fit in memory
+        if len(prepared.images) > 1:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        return generate_batch(prepared, *args)
+
+    monkeypatch.setattr(model, "_generate_batch", out_of_memory)
+    model.reset_generation_stats()
+    assert model.predict_batch(images, PROMPTS, batch_size=4, max_new_tokens=budgets,
+                               stop_strings=stop_strings) == expected
+    # 4 rows split in 2 + 2, then each pair in 1 + 1
+    assert model.generation_stats["oom_splits"] == 3
+
+
+def answer_logprob(model, image, prompt, answer):
+    """Log-likelihood of answer as the whole assistant turn, from one plain forward pass"""
+    inputs = model.prepare_batch([image], [prompt]).inputs
+    tokenizer = model.processor.tokenizer
+    answer_ids = tokenizer(answer, add_special_tokens=False).input_ids + [tokenizer.convert_tokens_to_ids("<|im_end|>")]
+    input_ids = torch.cat([inputs.input_ids, torch.tensor([answer_ids])], dim=1)
+    with torch.no_grad():
+        logits = model.model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                             pixel_values=inputs.pixel_values, image_grid_thw=inputs.image_grid_thw).logits[0]
+    logprobs = torch.log_softmax(logits[inputs.input_ids.shape[1] - 1:-1].float(), dim=-1)
+    return sum(logprobs[i, token].item() for i, token in enumerate(answer_ids)), len(answer_ids)
+
+
+@pytest.mark.parametrize("length_normalize", [False, True])
+@pytest.mark.parametrize("max_tree_tokens", [1024, 3])
+def test_score_classes_matches_brute_force(model, images, length_normalize, max_tree_tokens):
+    for image, prompt in zip(images[:2], PROMPTS[:2]):
+        expected = {}
+        for name in SCORED_CLASSES:
+            logprob, num_tokens = answer_logprob(model, image, prompt, name)
+            expected[name] = logprob / num_tokens if length_normalize else logprob
+        ranking = model.score_classes(image, prompt, SCORED_CLASSES, length_normalize=length_normalize,
+                                      max_tree_tokens=max_tree_tokens)
+        assert [name for name, _ in ranking] == sorted(expected, key=expected.get, reverse=True)
+        for name, score in ranking:
+            assert score == pytest.approx(expected[name], abs=1e-4), name
+
+
+@pytest.mark.parametrize("batch_size", [1, 4])
+@pytest.mark.parametrize("prefix", [None, PREFIX])
+def test_constrained_outputs_are_labels(model, images, batch_size, prefix):
+    predictions = model.predict_batch(images + images, PROMPTS + PROMPTS[::-1], batch_size=batch_size, prefix=prefix,
+                                      labels=SCORED_CLASSES)
+    assert all(prediction in SCORED_CLASSES for prediction in predictions), predictions
+    if prefix is None:
+        # the turns of a hierarchical conversation are constrained the same way
+        for image, prompt in zip(images, PROMPTS):
+            answers = model.predict_rounds_prepared(model.prepare_batch([image], [prompt]), labels=SCORED_CLASSES)
+            assert answers[0] in SCORED_CLASSES
+
+
+def test_rounds_match_generate(model, images):
+    # a constrained first turn, then a free and a constrained follow-up
+    first_labels = ["Albatross", "Auklet", "Tern", "Flycatcher"]
+    turns = [("Why?", None), ("Now choose the species.", SCORED_CLASSES)]
+    end_id = model.processor.tokenizer.convert_tokens_to_ids("<|im_end|>")
+
+    def next_round(answers):
+        return turns[len(answers) - 1] if len(answers) <= len(turns) else None
+
+    for image, prompt in zip(images, PROMPTS):
+        answers = model.predict_rounds(image, prompt, labels=first_labels, next_round=next_round)
+        assert answers[0] == model.predict(image, prompt, labels=first_labels)
+        assert answers[0] in first_labels and answers[2] in SCORED_CLASSES
+        # the whole conversation so far generated from scratch every turn, image included
+        inputs = model.prepare_batch([image], [prompt]).inputs
+        input_ids = inputs.input_ids
+        expected = []
+        labels = first_labels
+        while True:
+            budgets, _, trie = model._generation_plan(1, None, labels, None)
+            constraint = {} if trie is None else {
+                "prefix_allowed_tokens_fn": model._trie_constraint(trie, input_ids.shape[1])
+            }
+            sequences = model.model.generate(
+                input_ids=input_ids, attention_mask=torch.ones_like(input_ids), pixel_values=inputs.pixel_values,
+                image_grid_thw=inputs.image_grid_thw, max_new_tokens=budgets[0], **constraint
+            )
+            generated = sequences[0, input_ids.shape[1]:]
+            expected.append(model.processor.tokenizer.decode(
+                generated, skip_special_tokens=True, clean_up_tokenization_spaces=False
+            ))
+            if len(expected) > len(turns):
+                break
+            next_prompt, labels = turns[len(expected) - 1]
+            turn_ids = model._turn_ids(next_prompt)
+            if generated.numel() and generated[-1].item() == end_id and turn_ids[:1] == [end_id]:
+                turn_ids = turn_ids[1:]
+            input_ids = torch.cat([sequences, torch.tensor([turn_ids])], dim=1)
+        assert answers == expected
+
+
+def test_candidate_filter_keeps_most_similar(model, samples, tmp_path):
+    class_names_dict = dict(enumerate(SCORED_CLASSES))
+    template = "A photo of a {}."
+    candidates = CandidateFilter(model, class_names_dict, cache_dir=str(tmp_path), template=template)
+    # batches of padded images and a last partial batch
+    rankings, labels = candidates.rank(samples, batch_size=3)
+    assert labels == [sample["label"] for sample in samples]
+    # similarities of every image and class name embedded on their own
+    class_embeddings = torch.cat([model.embed_texts([template.format(name)]) for name in SCORED_CLASSES])
+    for sample, ranking in zip(samples, rankings):
+        similarity = (model.embed_images([sample["image"]]) @ class_embeddings.T)[0]
+        assert sorted(ranking) == list(range(len(SCORED_CLASSES)))
+        for k in (1, 3):
+            assert similarity[ranking[:k]].min() >= similarity[ranking[k:]].max() - 1e-4
+    # every label is kept when all classes are candidates
+    assert recall_at_k(rankings, labels, [len(SCORED_CLASSES)]) == {len(SCORED_CLASSES): len(samples)}
+    # the class embeddings are read back from the cache
+    assert torch.equal(CandidateFilter(model, class_names_dict, cache_dir=str(tmp_path), template=template)
+                       .class_embeddings, candidates.class_embeddings)
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_stop_strings_cut_generate(model, images):
+    tokenizer = model.processor.tokenizer
+    stop_strings, expected, full_texts = [], [], []
+    for image, prompt in zip(images, PROMPTS):
+        inputs = model.prepare_batch([image], [prompt]).inputs
+        generated = model.model.generate(**inputs, max_new_tokens=model.max_new_tokens, do_sample=False)
+        generated = generated[0, inputs.input_ids.shape[1]:].tolist()
+        texts = [tokenizer.decode(generated[:length], skip_special_tokens=True, clean_up_tokenization_spaces=False)
+                 for length in range(1, len(generated) + 1)]
+        # some printable text of the answer, after its first characters
+        stop = re.search(r"[ -~]+", texts[-1][2:]).group(0)
+        stop_strings.append([stop])
+        # generation ends with the token completing the stop string
+        expected.append(next(text for text in texts if stop in text))
+        full_texts.append(texts[-1])
+    assert expected != full_texts
+    model.reset_generation_stats()
+    assert model.predict_batch(images, PROMPTS, batch_size=4, stop_strings=stop_strings) == expected
+    assert model.generation_stats["stopped_early"] == len(images)
+    assert [model.predict(image, prompt, stop_strings=stop) for image, prompt, stop in
+            zip(images, PROMPTS, stop_strings)] == expected
+    assert [model.predict(image, prompt, stop_strings=stop, prompt_lookup_tokens=4) for image, prompt, stop in
+            zip(images, PROMPTS, stop_strings)] == expected
+
+
+def test_prefix_cache_matches_generate(model, images):
+    expected = []
+    for image, prompt in zip(images, PROMPTS):
+        inputs = model.prepare_batch([image], [prompt], prefix=PREFIX).inputs
+        expected.extend(generate_texts(model, inputs, do_sample=False))
+    model.clear_prefix_cache()
+    assert model.predict_batch(images, PROMPTS, prefix=PREFIX, batch_size=2) == expected
+    assert PREFIX in model._prefix_caches
+
+
+def test_prompt_lookup_matches_generate(model, images):
+    requests = [(image, LOOKUP_PROMPT) for image in images] + list(zip(images, PROMPTS))
+    expected = [generate_texts(model, model.prepare_batch([image], [prompt]).inputs, do_sample=False)[0]
+                for image, prompt in requests]
+    model.reset_generation_stats()
+    assert [model.predict(image, prompt, prompt_lookup_tokens=4) for image, prompt in requests] == expected
+    # drafts were both accepted and rejected
+    assert 0 < model.generation_stats["accepted_tokens"] < model.generation_stats["draft_tokens"]
+
+
+def test_shared_prefix_sampling_matches_generate(model, images):
+    sampling = {"top_k": 50, "top_p": 0.9, "temperature": 1.3}
+    for image, prompt in zip(images, PROMPTS):
+        inputs = model.prepare_batch([image], [prompt]).inputs
+        # the same draws of the global RNG as generate
+        torch.manual_seed(0)
+        expected = generate_texts(model, inputs, do_sample=True, num_return_sequences=6, **sampling)
+        torch.manual_seed(0)
+        samples = model.predict_multiple(image, prompt, num_return_sequences=6, max_new_tokens=model.max_new_tokens,
+                                         **sampling)
+        assert samples == expected
+        seeded = model.predict_multiple(image, prompt, num_return_sequences=6, max_new_tokens=model.max_new_tokens,
+                                        seed=1, **sampling)
+        assert model.predict_multiple(image, prompt, num_return_sequences=6, max_new_tokens=model.max_new_tokens,
+                                      seed=1, **sampling) == seeded
+        # greedy rounds share the prompt cache too
+        greedy = generate_texts(model, inputs, do_sample=False)
+        rounds = model.predict_multiple_rounds(model.prepare_batch([image], [prompt]), round_size=2, do_sample=False,
+                                               max_new_tokens=model.max_new_tokens)
+        assert [next(rounds) for _ in range(2)] == [greedy * 2] * 2
+
+
+@pytest.mark.parametrize("prefix", [None, PREFIX])
+def test_continuous_batching_matches_predict(model, images, prefix):
+    # more requests than rows, so that finished rows are refilled with prompts of other lengths
+    budgets = [16, 3, 9, 1, 12, 5, 16]
+    requests = [(images[i % len(images)], PROMPTS[(i + 1) % len(PROMPTS)], budget) for i, budget in enumerate(budgets)]
+    expected = [model.predict(image, prompt, max_new_tokens=budget, prefix=prefix)
+                for image, prompt, budget in requests]
+    batcher = ContinuousBatcher(model, max_batch_size=3)
+    results = dict(batcher.run(
+        (model.prepare_batch([image], [prompt], prefix=prefix), budget, None) for image, prompt, budget in requests
+    ))
+    assert [results[request_id] for request_id in range(len(requests))] == expected
+    assert batcher.stats()["mean_batch_size"] > 1
+
+
+@pytest.mark.parametrize("prefix", [None, PREFIX])
+def test_vision_cache_matches_predict(model, images, prefix, tmp_path):
+    expected = model.predict_batch(images, PROMPTS, prefix=prefix, batch_size=2)
+    cache = VisionFeatureCache(str(tmp_path))
+    # the same weights as the model fixture, with the vision tower outputs cached
+    cached_model = tiny_qwen_vl_model(max_new_tokens=model.max_new_tokens, vision_cache=cache)
+    assert cached_model.predict_batch(images, PROMPTS, prefix=prefix, batch_size=2) == expected
+    assert cache.stats()["misses"] == len(images) and cache.stats()["hits"] == 0
+    assert cached_model.predict_batch(images, PROMPTS, prefix=prefix, batch_size=2) == expected
+    assert cache.stats()["hits"] == len(images)
+
+
+def test_vision_cache_eviction(tmp_path):
+    grid_thw = torch.tensor([1, 4, 4])
+    entry_embeds = [torch.full((4, 64), float(i)) for i in range(4)]
+    cache = VisionFeatureCache(str(tmp_path), max_bytes=10**9)
+    cache.put("a", entry_embeds[0], grid_thw)
+    entry_bytes = cache.total_bytes
+    # room for two entries
+    cache = VisionFeatureCache(str(tmp_path), max_bytes=2 * entry_bytes + entry_bytes // 2)
+    time.sleep(0.01)
+    cache.put("b", entry_embeds[1], grid_thw)
+    time.sleep(0.01)
+    assert torch.equal(cache.get("a", grid_thw), entry_embeds[0])
+    time.sleep(0.01)
+    cache.put("c", entry_embeds[2], grid_thw)
+    assert cache.total_bytes <= cache.max_bytes
+    # "b" was the least recently used
+    assert cache.get("b") is None and cache.stats()["evictions"] == 1
+    # recency is read back from the file modification times
+    time.sleep(0.01)
+    assert cache.get("a") is not None
+    cache = VisionFeatureCache(str(tmp_path), max_bytes=cache.max_bytes)
+    assert cache.total_bytes == 2 * entry_bytes
+    cache.put("d", entry_embeds[3], grid_thw)
+    assert cache.total_bytes <= cache.max_bytes
+    assert cache.get("c") is None
+    assert torch.equal(cache.get("a"), entry_embeds[0]) and torch.equal(cache.get("d"), entry_embeds[3])
+    assert sorted(os.listdir(tmp_path)) == ["a.pt", "d.pt"]
+
+
+def test_result_store_reuses_results(model, images, tmp_path):
+    path = str(tmp_path / "results.sqlite")
+    expected = model.predict_batch(images, PROMPTS, batch_size=2)
+    stored_model = tiny_qwen_vl_model(max_new_tokens=model.max_new_tokens, result_store=ResultStore(path))
+    assert stored_model.predict_batch(images, PROMPTS, batch_size=2) == expected
+    # a later run reads the answers back without generating
+    stored_model.result_store = store = ResultStore(path)
+    stored_model.reset_generation_stats()
+    assert stored_model.predict_batch(images, PROMPTS, batch_size=2) == expected
+    assert store.stats()["hits"] == len(images) and stored_model.generation_stats["generated_tokens"] == 0
+
+    sampling = {"top_k": 50, "top_p": 0.9, "temperature": 1.3, "num_return_sequences": 4}
+    seeded = model.predict_multiple(images[0], PROMPTS[0], seed=1, **sampling)
+    assert stored_model.predict_multiple(images[0], PROMPTS[0], seed=1, **sampling) == seeded
+    assert stored_model.predict_multiple(images[0], PROMPTS[0], seed=1, **sampling) == seeded
+    assert store.stats()["hit_rate_by_kind"]["sampled"] == 0.5
+    # another seed is another result
+    assert (stored_model.predict_multiple(images[0], PROMPTS[0], seed=2, **sampling)
+            == model.predict_multiple(images[0], PROMPTS[0], seed=2, **sampling))
+    assert store.counts["sampled"] == [1, 2]
+
+
+def test_result_store_eviction(tmp_path):
+    path = str(tmp_path / "results.sqlite")
+    store = ResultStore(path)
+    store.put("a", ["a" * 100])
+    entry_bytes = store.stats()["bytes"]
+    # room for two entries
+    store = ResultStore(path, max_bytes=2 * entry_bytes + entry_bytes // 2)
+    time.sleep(0.01)
+    store.put("b", ["b" * 100])
+    # a replaced result only counts once
+    store.put("b", ["c" * 100])
+    assert store.evictions == 0
+    time.sleep(0.01)
+    assert store.get("a") == ["a" * 100]
+    time.sleep(0.01)
+    store.put("c", ["c" * 100])
+    # "b" was the least recently used
+    assert store.get("b") is None and store.evictions == 1
+    assert store.stats()["bytes"] <= store.max_bytes
+    assert store.get("a") is not None and store.get("c") is not None
+
+    store.max_bytes = float("inf")
+    for i in range(200):
+        store.put(f"filler {i}", ["x" * 4000])
+    assert store.evictions == 1
+    file_bytes = store.file_bytes()
+    freed = store.compact(max_bytes=2 * entry_bytes + entry_bytes // 2)
+    assert store.file_bytes() == file_bytes - freed < 64 * 1024
+    assert store.stats()["entries"] == 1 and store.get("filler 199") == ["x" * 4000]
+    # the evictions are kept after a reopen
+    assert ResultStore(path).stats()["entries"] == 1
+
+
+def test_server_matches_predict(model, images):
+    expected = [model.predict(image, prompt) for image, prompt in zip(images, PROMPTS)]
+    server = ModelServer(model, port=0, max_batch_size=4, max_wait=0.05).start()
+    url = f"http://127.0.0.1:{server.address[1]}"
+    results = {}
+
+    def client(row):
+        # concurrent requests of several clients are merged into one batch by the server
+        remote = RemoteQwenVLModel(url, max_new_tokens=model.max_new_tokens)
+        results[row] = remote.predict(images[row], PROMPTS[row])
+
+    threads = [threading.Thread(target=client, args=(row,)) for row in range(len(images))]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.shutdown()
+    assert [results[row] for row in range(len(images))] == expected
+
+
+def sweep_shard(output_dir, num_shards, shard_id):
+    """One process of a prompt sweep over synthetic images, writing the outputs of its shard"""
+    model = tiny_qwen_vl_model(max_new_tokens=8, num_threads=1)
+    dataset = [(synthetic_image(*IMAGE_SIZES[i % len(IMAGE_SIZES)], seed=i), i % len(SWEEP_CATEGORIES))
+               for i in range(10)]
+    # constrained to the category names, so that some answers are correct
+    labels = [category.replace("_", " ") for category in SWEEP_CATEGORIES]
+    states = run_sweep(model, dataset, SWEEP_CATEGORIES, SWEEP_PROMPTS, shard_range(len(dataset), num_shards, shard_id),
+                       batch_size=2, labels=labels)
+    save_outputs(output_dir, SWEEP_PROMPTS, states, num_shards, shard_id)
+
+
+def test_merged_shards_match_single_process(tmp_path):
+    num_shards = 3
+    single_dir, sharded_dir = tmp_path / "single", tmp_path / "sharded"
+    single_dir.mkdir()
+    sharded_dir.mkdir()
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=sweep_shard, args=(str(single_dir), 1, 0))] + [
+        context.Process(target=sweep_shard, args=(str(sharded_dir), num_shards, shard_id))
+        for shard_id in range(num_shards)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0] * len(processes)
+    merge_outputs(str(sharded_dir), SWEEP_PROMPTS, num_shards)
+    outputs = sorted(path.name for path in single_dir.iterdir())
+    assert "accuracy_summary.txt" in outputs and "category_outputs_all.json" in outputs
+    for name in outputs:
+        assert (sharded_dir / name).read_bytes() == (single_dir / name).read_bytes(), name
+    # some answers are right, so the merged counts are not zero by chance
+    assert "prompt1: 0/10" not in (single_dir / "accuracy_summary.txt").read_text()
+
+
+def evaluation_output(path):
+    """Lines of an evaluate_dataset output file, without its date and the timing-dependent ones"""
+    with open(path) as f:
+        lines = f.read().splitlines()[1:]
+    return [line for line in lines if not any(word in line for word in ("throughput", "pipeline", "bucketing"))]
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptedDataset:
+    """samples, but the job is killed when sample stop is loaded"""
+    def __init__(self, samples, stop):
+        self.samples = samples
+        self.stop = stop
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, i):
+        if i == self.stop:
+            raise Interrupted
+        return self.samples[i]
+
+
+def test_resumed_evaluation_matches_uninterrupted(model, samples, tmp_path):
+    prompt = f"{PREFIX}:\n\n" + "\n".join(EVAL_CLASSES.values())
+    expected = evaluate_dataset(samples, "Test", str(tmp_path / "uninterrupted.txt"), prompt, model, EVAL_CLASSES,
+                                constrained=True)
+    output_file = str(tmp_path / "resumed.txt")
+    # a checkpoint after every sample
+    checkpointing = CheckpointOptions(resume=True, interval=0.0)
+    with pytest.raises(Interrupted):
+        evaluate_dataset(InterruptedDataset(samples, 4), "Test", output_file, prompt, model, EVAL_CLASSES,
+                         constrained=True, checkpointing=checkpointing)
+    # the job was killed while writing a sample after the last checkpoint
+    with open(output_file, "a") as f:
+        f.write("Sample 4:\nGround truth: Laysan Albatross\nPrediction: " + "Laysan " * 1000)
+    assert evaluate_dataset(samples, "Test", output_file, prompt, model, EVAL_CLASSES, constrained=True,
+                            checkpointing=checkpointing) == expected
+    assert evaluation_output(output_file) == evaluation_output(str(tmp_path / "uninterrupted.txt"))
+    assert expected[0] > 0
+
+
+def test_bucketed_evaluation_matches_dataset_order(model, samples, tmp_path):
+    counts = [model.image_token_count(*sample["image"].size) for sample in samples]
+    batching = BatchingOptions(batch_size=3, image_token_counts=counts, bucket_window=4)
+    # the samples are reordered by size within each window
+    assert any(batch != sorted(batch) for batch in bucket_batches(range(len(samples)), counts, 3, window=4))
+    expected = evaluate_dataset(samples, "Test", str(tmp_path / "consecutive.txt"), PROMPTS[0], model, EVAL_CLASSES,
+                                batching=batching._replace(image_token_counts=None))
+    assert evaluate_dataset(samples, "Test", str(tmp_path / "bucketed.txt"), PROMPTS[0], model, EVAL_CLASSES,
+                            batching=batching) == expected
+    assert evaluation_output(str(tmp_path / "bucketed.txt")) == evaluation_output(str(tmp_path / "consecutive.txt"))
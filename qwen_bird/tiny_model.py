@@ -0,0 +1,88 @@
+import numpy as np
+import torch
+from PIL import Image
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import (Qwen2_5_VLConfig, Qwen2_5_VLForConditionalGeneration, Qwen2_5_VLProcessor,
+                          Qwen2TokenizerFast, Qwen2VLImageProcessor, Qwen2VLVideoProcessor)
+from model import QwenVLModel
+
+# The Qwen2.5-VL chat template, reduced to single-turn image + text conversations
+CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "{% if loop.first and message['role'] != 'system' %}<|im_start|>system\nYou are a helpful assistant.<|im_end|>\n"
+    "{% endif %}<|im_start|>{{ message['role'] }}\n"
+    "{% if message['content'] is string %}{{ message['content'] }}<|im_end|>\n"
+    "{% else %}{% for content in message['content'] %}"
+    "{% if content['type'] == 'image' or 'image' in content %}<|vision_start|><|image_pad|><|vision_end|>"
+    "{% elif 'text' in content %}{{ content['text'] }}{% endif %}{% endfor %}<|im_end|>\n{% endif %}"
+    "{% endfor %}{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+SPECIAL_TOKENS = ["<|endoftext|>", "<|im_start|>", "<|im_end|>", "<|vision_start|>", "<|vision_end|>",
+                  "<|image_pad|>", "<|video_pad|>"]
+# text the tokenizer is trained on, so that the evaluation prompts tokenize to a realistic length
+CORPUS = [
+    "Please identify the bird species in this image. Choose from the following list of bird species",
+    "Black footed Albatross Laysan Albatross Sooty Albatross Groove billed Ani Crested Auklet Least Auklet",
+    "Provide your answer as the species name. <answer> </answer> system user assistant helpful",
+]
+
+
+def build_tiny_processor(vocab_size=1000, min_pixels=4 * 28 * 28, max_pixels=256 * 28 * 28):
+    """A Qwen2.5-VL processor with a small BPE tokenizer trained on the spot (nothing is downloaded)"""
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=SPECIAL_TOKENS,
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(CORPUS * 20, trainer)
+    tokenizer = Qwen2TokenizerFast(tokenizer_object=tokenizer, eos_token="<|im_end|>", pad_token="<|endoftext|>",
+                                   additional_special_tokens=SPECIAL_TOKENS[1:])
+    tokenizer.image_token = "<|image_pad|>"
+    tokenizer.video_token = "<|video_pad|>"
+    return Qwen2_5_VLProcessor(
+        image_processor=Qwen2VLImageProcessor(min_pixels=min_pixels, max_pixels=max_pixels), tokenizer=tokenizer,
+        video_processor=Qwen2VLVideoProcessor(), chat_template=CHAT_TEMPLATE,
+    )
+
+
+def build_tiny_model(processor, hidden_size=128, num_layers=4, vision_depth=2, seed=0):
+    """A randomly initialized, scaled-down Qwen2_5_VLForConditionalGeneration for processor's tokenizer.
+
+    It keeps the architecture of the real model (windowed vision attention,
+    2x2 patch merge, multimodal rope) at a fraction of its size, so it runs
+    the same code paths on CPU in milliseconds. Weights depend on seed only.
+    """
+    tokenizer = processor.tokenizer
+    torch.manual_seed(seed)
+    config = Qwen2_5_VLConfig(
+        vision_config=dict(depth=vision_depth, hidden_size=64, intermediate_size=128, num_heads=2,
+                           out_hidden_size=hidden_size, fullatt_block_indexes=[vision_depth - 1], window_size=112,
+                           patch_size=14, spatial_merge_size=2, temporal_patch_size=2),
+        text_config=dict(hidden_size=hidden_size, intermediate_size=2 * hidden_size, num_hidden_layers=num_layers,
+                         num_attention_heads=4, num_key_value_heads=2, vocab_size=len(tokenizer),
+                         max_position_embeddings=8192, eos_token_id=tokenizer.eos_token_id,
+                         pad_token_id=tokenizer.pad_token_id,
+                         rope_scaling={"type": "mrope", "mrope_section": [4, 6, 6]}),
+        image_token_id=tokenizer.convert_tokens_to_ids("<|image_pad|>"),
+        video_token_id=tokenizer.convert_tokens_to_ids("<|video_pad|>"),
+        vision_start_token_id=tokenizer.convert_tokens_to_ids("<|vision_start|>"),
+        vision_end_token_id=tokenizer.convert_tokens_to_ids("<|vision_end|>"),
+    )
+    model = Qwen2_5_VLForConditionalGeneration(config).eval()
+    # the top-level config has no token ids of its own on every transformers version, the tokenizer does
+    model.generation_config.eos_token_id = tokenizer.eos_token_id
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    return model
+
+
+def tiny_qwen_vl_model(max_new_tokens=32, seed=0, **kwargs):
+    """QwenVLModel around a tiny random model on CPU (float32); kwargs go to QwenVLModel"""
+    processor = build_tiny_processor()
+    return QwenVLModel(model=build_tiny_model(processor, seed=seed), processor=processor,
+                       max_new_tokens=max_new_tokens, device="cpu", dtype=torch.float32, **kwargs)
+
+
+def synthetic_image(width, height, seed=0):
+    """Random RGB noise of a given size"""
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
@@ -0,0 +1,97 @@
+import os
+import time
+import torch
+from collections import OrderedDict
+
+
+class VisionFeatureCache:
+    """On-disk LRU cache of vision-tower outputs.
+
+    Each entry is one torch file holding the merged visual embeddings of an
+    image and its image_grid_thw. Keys are computed by the caller (see
+    QwenVLModel._vision_cache_key). When the files exceed max_bytes the least
+    recently used ones are deleted. Recency survives restarts through the
+    file modification times.
+
+    total_bytes only counts the entries this process has seen: it is read
+    from the directory when the cache is opened, then updated by this
+    process's own puts and evictions. Processes sharing one cache_dir (e.g.
+    the shards of a run, see sharding.py) each keep their own count, so
+    together they can go over max_bytes.
+    """
+    def __init__(self, cache_dir, max_bytes=20 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # key -> file size, least recently used first
+        self._entries = OrderedDict()
+        files = []
+        for filename in os.listdir(cache_dir):
+            if filename.endswith(".pt"):
+                stat = os.stat(os.path.join(cache_dir, filename))
+                files.append((stat.st_mtime, filename[:-3], stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+        self.total_bytes = sum(self._entries.values())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def get(self, key, image_grid_thw=None):
+        """Cached image embeddings for key, or None on a miss"""
+        if key in self._entries:
+            try:
+                entry = torch.load(self._path(key), map_location="cpu")
+            except (OSError, RuntimeError, EOFError):
+                # deleted by another process or truncated
+                self._remove(key)
+                entry = None
+            if entry is not None and (
+                image_grid_thw is None or torch.equal(entry["image_grid_thw"], image_grid_thw.cpu())
+            ):
+                self.hits += 1
+                self._entries.move_to_end(key)
+                now = time.time()
+                os.utime(self._path(key), (now, now))
+                return entry["image_embeds"]
+        self.misses += 1
+        return None
+
+    def put(self, key, image_embeds, image_grid_thw):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(
+            {"image_embeds": image_embeds.detach().cpu(), "image_grid_thw": image_grid_thw.detach().cpu()},
+            tmp_path,
+        )
+        os.replace(tmp_path, path)
+        if key in self._entries:
+            self.total_bytes -= self._entries.pop(key)
+        self._entries[key] = os.path.getsize(path)
+        self.total_bytes += self._entries[key]
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        self.total_bytes -= self._entries.pop(key)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+        }
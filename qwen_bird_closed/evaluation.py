@@ -0,0 +1,349 @@
+# Evaluation loop of baseline.py, importable without running the CUB-200 evaluation
+from pipeline import PipelinedRunner
+from scheduler import ContinuousBatcher
+from checkpoint import Checkpoint, sync_file
+from bucketing import bucket_batches, padding_report, in_index_order
+from candidates import class_list
+from collections import deque, namedtuple
+import os
+import datetime
+import re
+
+
+def index_batches(num_samples, batch_size, first=0):
+    """Lists of up to batch_size consecutive sample indices, starting at first"""
+    return [
+        list(range(start, min(start + batch_size, num_samples))) for start in range(first, num_samples, batch_size)
+    ]
+
+# How samples are grouped into model calls: batch_size images per call, decoded and
+# preprocessed by num_workers threads up to prefetch batches ahead, refilled row by row
+# with continuous_batching, or grouped by size with image_token_counts (see bucketing.py)
+BatchingOptions = namedtuple(
+    "BatchingOptions",
+    ["batch_size", "num_workers", "prefetch", "continuous_batching", "image_token_counts", "bucket_window"],
+    defaults=[1, 0, 8, False, None, 512],
+)
+# KV caching across samples: prefix_cache computes the prompt's once
+CachingOptions = namedtuple("CachingOptions", ["prefix_cache"], defaults=[False])
+# Progress saved every interval seconds, and whether to restart from it
+CheckpointOptions = namedtuple("CheckpointOptions", ["resume", "interval"], defaults=[False, 60.0])
+
+
+def evaluate_dataset(dataset, dataset_name, output_file, prompt, model, class_names_dict, is_reasoning=False,
+                     score_classes=False, top_k=5, constrained=False, early_stop=False, prompt_lookup_tokens=None,
+                     index_offset=0, candidates=None, hierarchy=None, followup_prompt=None,
+                     batching=BatchingOptions(), caching=CachingOptions(), checkpointing=CheckpointOptions()):
+    """Evaluate a dataset and save results to file.
+
+    With caching.prefix_cache the whole prompt is placed before the image and
+    its KV cache is computed once, so only the image tokens are prefilled for
+    each sample.
+
+    With score_classes (ignored for reasoning prompts) nothing is generated: every
+    class name is scored by its log-likelihood as the answer, the best one is the
+    prediction and top-k accuracy is reported as well.
+
+    With constrained (ignored for reasoning prompts) generation is restricted to
+    the class names, so every prediction is a valid label.
+
+    With early_stop reasoning generations stop right after </answer>; the tokens
+    saved this way are reported at the end of the output file.
+
+    With batching.num_workers > 0 images are decoded and preprocessed in that
+    many worker threads, up to batching.prefetch batches ahead of the model.
+    The utilization of both stages is reported at the end of the output file.
+
+    With batching.continuous_batching (ignored with score_classes or
+    constrained) up to batching.batch_size samples are decoded together and
+    a new sample takes the place of every finished one, so short answers do
+    not wait for long reasoning.
+
+    With prompt_lookup_tokens (ignored with score_classes, constrained or
+    continuous batching) samples are decoded one at a time with prompt-lookup
+    speculative decoding and the draft acceptance rate is reported.
+
+    Every checkpointing.interval seconds the output file is synced to disk and
+    the progress (samples done, running counts and generation stats) is saved
+    to output_file + ".checkpoint". With checkpointing.resume the evaluation
+    restarts from that checkpoint: whatever was written to output_file after
+    it is dropped and only the remaining samples are evaluated. A finished
+    evaluation is not run again.
+
+    With batching.image_token_counts (the visual tokens of every sample, see
+    bucketing.token_counts; ignored with continuous batching or batch size 1)
+    samples are batched with others of similar size within windows of
+    batching.bucket_window samples, so less padding is computed. Results are
+    still written in dataset order and the padding saved is reported (after
+    a resume, for the samples evaluated since the checkpoint only).
+
+    index_offset is added to the sample numbers written, so that the outputs
+    of consecutive shards of a dataset (see sharding.py) can be concatenated.
+
+    With candidates (one list of class indices per sample, see candidates.py)
+    prompt is a template whose {class_list} is replaced, for every sample,
+    by its candidate classes only, and score_classes only ranks those.
+    The prefix cache is then ignored, since the prompts differ between samples.
+
+    With hierarchy (a dict from group names to the class indices in each
+    group, see hierarchy.py; ignored for reasoning prompts) prompt asks for
+    the group, constrained to the group names, and followup_prompt then asks
+    for the class in the same conversation, its {group} and {class_list}
+    filled with the group answered and its classes (constrained to those with
+    constrained). The second turn reuses the KV cache of the first, so the
+    image is encoded once; groups of one class need no second turn. Samples
+    run one at a time and score_classes, the prefix cache, continuous batching
+    and prompt_lookup_tokens are ignored.
+
+    The prompt and generated tokens per sample are reported at the end of
+    the output file, to compare the prompting modes.
+
+    If the model has a profiler, the profile of the evaluation is saved next
+    to output_file, with .profile.json in place of its extension.
+    """
+    correct = 0
+    total = 0
+    correct_top_k = 0
+    hierarchical = hierarchy is not None and not is_reasoning
+    score_classes = score_classes and not is_reasoning and not hierarchical
+    class_names = [class_names_dict[i] for i in range(len(class_names_dict))]
+    labels = class_names if constrained and not is_reasoning else None
+    batch_size, prefix_cache = batching.batch_size, caching.prefix_cache
+    continuous_batching, image_token_counts = batching.continuous_batching, batching.image_token_counts
+    stop_strings = ["</answer>"] if early_stop and is_reasoning else None
+    model.reset_generation_stats()
+    profiler = getattr(model, "profiler", None)
+    if profiler is not None:
+        profiler.reset()
+    if candidates is not None or hierarchical:
+        prefix_cache = False
+    if hierarchical:
+        # the turns of a conversation run one sample at a time
+        continuous_batching = False
+        prompt_lookup_tokens = None
+        batch_size = 1
+    generate_prompt, prefix = ("", prompt) if prefix_cache else (prompt, None)
+    if score_classes or labels is not None or continuous_batching:
+        prompt_lookup_tokens = None
+    if prompt_lookup_tokens:
+        # drafts are verified one sample at a time
+        batch_size = 1
+
+    checkpoint = Checkpoint(f"{output_file}.checkpoint", interval=checkpointing.interval)
+    state = checkpoint.load() if checkpointing.resume else None
+    if state is not None:
+        if state["finished"]:
+            print(f"{dataset_name}: already evaluated in {output_file}")
+            return state["correct"], state["total"]
+        correct, total, correct_top_k = state["correct"], state["total"], state["correct_top_k"]
+        model.generation_stats.update(state["generation_stats"])
+        print(f"{dataset_name}: resuming at sample {total}")
+    # samples evaluated by this call, the others come from the checkpoint
+    first_sample = total
+
+    def candidate_prompt(i):
+        """prompt listing the candidate classes of sample i"""
+        return prompt.format(class_list=class_list(class_names_dict, candidates[i]))
+
+    def classify_hierarchically(inputs):
+        """The group of one prepared sample, then its class within the group"""
+        def next_round(answers):
+            members = hierarchy.get(answers[0].strip(), [])
+            if len(answers) > 1 or len(members) < 2:
+                return None
+            return (followup_prompt.format(group=answers[0].strip(), class_list=class_list(class_names_dict, members)),
+                    [class_names[index] for index in members] if constrained else None)
+
+        answers = model.predict_rounds_prepared(inputs, labels=list(hierarchy), next_round=next_round)
+        members = hierarchy.get(answers[0].strip(), [])
+        if len(answers) == 1 and len(members) == 1:
+            return class_names[members[0]]
+        return answers[-1]
+
+    def prepare(indices):
+        """Decode and preprocess one batch of samples"""
+        batch = [dataset[i] for i in indices]
+        if score_classes:
+            return batch, None
+        prompts = generate_prompt if candidates is None else [candidate_prompt(i) for i in indices]
+        return batch, model.prepare_batch([sample["image"] for sample in batch], prompts, prefix=prefix)
+
+    def predict(indices, prepared):
+        """Predictions (and class rankings with score_classes) of one prepared batch"""
+        batch, inputs = prepared
+        if score_classes:
+            if candidates is None:
+                rankings = [model.score_classes(sample["image"], prompt, class_names) for sample in batch]
+            else:
+                rankings = [
+                    model.score_classes(sample["image"], candidate_prompt(i),
+                                        [class_names[index] for index in candidates[i]])
+                    for i, sample in zip(indices, batch)
+                ]
+            return batch, [ranking[0][0] for ranking in rankings], rankings
+        if hierarchical:
+            return batch, [classify_hierarchically(inputs)], None
+        return batch, model.predict_prepared(
+            inputs, labels=labels, stop_strings=stop_strings, prompt_lookup_tokens=prompt_lookup_tokens
+        ), None
+
+    batcher = None
+    buckets = None
+    if continuous_batching and not score_classes and labels is None:
+        batcher = ContinuousBatcher(model, max_batch_size=batch_size)
+        runner = PipelinedRunner(prepare, lambda indices, prepared: prepared, num_workers=batching.num_workers,
+                                 prefetch=batching.prefetch)
+        # request ids follow the submission order
+        samples = deque()
+
+        def requests():
+            for indices, (batch, inputs) in runner.run(index_batches(len(dataset), 1, total)):
+                samples.append(batch[0])
+                yield inputs, None, stop_strings
+
+        def in_order(finished):
+            """Samples finish out of order, yield them back in dataset order"""
+            predictions = {}
+            next_idx = 0
+            for request_id, prediction in finished:
+                predictions[request_id] = prediction
+                while next_idx in predictions:
+                    yield [samples.popleft()], [predictions.pop(next_idx)], None
+                    next_idx += 1
+
+        results = in_order(batcher.run(requests()))
+    elif image_token_counts is not None and batch_size > 1:
+        buckets = bucket_batches(range(total, len(dataset)), image_token_counts, batch_size, window=batching.bucket_window)
+        runner = PipelinedRunner(prepare, predict, num_workers=batching.num_workers, prefetch=batching.prefetch)
+        results = in_index_order(runner.run(buckets), total)
+    else:
+        runner = PipelinedRunner(prepare, predict, num_workers=batching.num_workers, prefetch=batching.prefetch)
+        results = (result for _, result in runner.run(index_batches(len(dataset), batch_size, total)))
+    
+    def normalize_text(text):
+        """Normalize text by replacing punctuation with spaces and converting to lowercase"""
+        # Replace punctuation with spaces, then normalize multiple spaces to single spaces
+        text = re.sub(r'[^a-zA-Z\s]', ' ', text.lower())
+        return ' '.join(text.split())  # Remove extra whitespace
+    
+    def extract_answer_from_tags(text):
+        """Extract text between <answer></answer> tags"""
+        match = re.search(r'<answer>(.*?)</answer>', text, re.DOTALL | re.IGNORECASE)
+        return match.group(1).strip() if match else None
+    
+    def check_accuracy(ground_truth, prediction):
+        """Check if prediction contains the ground truth with simple logic"""
+        normalized_gt = normalize_text(ground_truth)
+        normalized_pred = normalize_text(prediction)
+        
+        # Simple substring check
+        return normalized_gt in normalized_pred
+
+    with open(output_file, "w" if state is None else "r+") as f:
+        if state is None:
+            f.write(f"{dataset_name} Dataset Predictions - {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+            f.write("=" * 60 + "\n\n")
+        else:
+            # drop the samples written after the checkpoint, they are evaluated again
+            f.seek(state["output_position"])
+            f.truncate()
+
+        def save_checkpoint(finished=False):
+            sync_file(f)
+            checkpoint.save({
+                "finished": finished,
+                "correct": correct,
+                "total": total,
+                "correct_top_k": correct_top_k,
+                "top_k": top_k if score_classes else None,
+                "output_position": f.tell(),
+                "generation_stats": model.generation_stats,
+            })
+        
+        idx = index_offset + total
+        for batch, predictions, rankings in results:
+            for i, (sample, prediction) in enumerate(zip(batch, predictions)):
+                ground_truth = class_names_dict[sample['label']]
+            
+                # Extract answer from tags if using reasoning prompt
+                if is_reasoning:
+                    prediction_for_check = extract_answer_from_tags(prediction)
+                    # If no answer tags found, mark as incorrect
+                    if prediction_for_check is None:
+                        is_correct = False
+                    else:
+                        is_correct = check_accuracy(ground_truth, prediction_for_check)
+                else:
+                    prediction_for_check = prediction
+                    is_correct = check_accuracy(ground_truth, prediction_for_check)
+            
+                if is_correct:
+                    correct += 1
+                total += 1
+                if score_classes:
+                    top_k_names = [name for name, _ in rankings[i][:top_k]]
+                    if ground_truth in top_k_names:
+                        correct_top_k += 1
+            
+                current_accuracy = correct / total
+
+                print(f"Sample {idx}: Ground truth: {ground_truth}")
+                print(f"Sample {idx}: Prediction: {prediction}")
+                print(f"Sample {idx}: Correct: {is_correct}")
+                print(f"Sample {idx}: Running accuracy: {current_accuracy:.4f}")
+                print("---")
+            
+                f.write(f"Sample {idx}:\n")
+                f.write(f"Ground truth: {ground_truth}\n")
+                f.write(f"Prediction: {prediction}\n")
+                if score_classes:
+                    f.write(f"Top-{top_k}: {', '.join(top_k_names)}\n")
+                f.write(f"Correct: {is_correct}\n")
+                f.write(f"Running accuracy: {current_accuracy:.4f}\n")
+                f.write("-" * 40 + "\n\n")
+                idx += 1
+                if checkpoint.due():
+                    save_checkpoint()
+        
+        f.write(f"\n{dataset_name} dataset accuracy: {correct}/{total} = {correct/total:.4f}\n")
+        if score_classes:
+            f.write(f"{dataset_name} dataset top-{top_k} accuracy: {correct_top_k}/{total} = {correct_top_k/total:.4f}\n")
+        stats = model.generation_stats
+        f.write(f"{dataset_name} generated tokens: {stats['generated_tokens']}, "
+                f"saved by early stopping: at most {stats['tokens_saved']} ({stats['stopped_early']} sequences)\n")
+        f.write(f"{dataset_name} per sample: {stats['prompt_tokens'] / total:.1f} prompt tokens, "
+                f"{stats['generated_tokens'] / total:.1f} generated tokens\n")
+        throughput = model.throughput()
+        f.write(f"{dataset_name} throughput: {throughput['images_per_second']:.2f} images/s, "
+                f"{throughput['tokens_per_second']:.1f} generated tokens/s\n")
+        if prompt_lookup_tokens:
+            acceptance = stats["accepted_tokens"] / stats["draft_tokens"] if stats["draft_tokens"] else 0.0
+            f.write(f"{dataset_name} prompt lookup: acceptance rate {acceptance:.4f} "
+                    f"({stats['accepted_tokens']}/{stats['draft_tokens']} draft tokens), "
+                    f"{stats['generated_tokens'] / max(stats['decode_steps'] + stats['sequences'], 1):.2f} tokens per forward pass\n")
+        if buckets is not None:
+            padding = padding_report(buckets, image_token_counts, batch_size)
+            # only the batches of this call are known, not those before the checkpoint
+            resumed = f" (samples {first_sample}-{len(dataset) - 1}, after resuming)" if first_sample else ""
+            f.write(f"{dataset_name} bucketing{resumed}: {padding['padding_tokens']} padding tokens instead of "
+                    f"{padding['consecutive_padding_tokens']} ({padding['saved_tokens']} saved), "
+                    f"padding waste {padding['waste']:.4f} instead of {padding['consecutive_waste']:.4f}\n")
+        if batcher is None:
+            pipeline = runner.stats()
+            f.write(f"{dataset_name} pipeline: preprocessing utilization {pipeline['prepare_utilization']:.2f}, "
+                    f"model utilization {pipeline['model_utilization']:.2f}\n")
+        else:
+            scheduler = batcher.stats()
+            f.write(f"{dataset_name} continuous batching: {scheduler['samples_per_second']:.2f} samples/s, "
+                    f"{scheduler['tokens_per_second']:.1f} tokens/s, mean batch size {scheduler['mean_batch_size']:.2f}\n")
+        save_checkpoint(finished=True)
+    if profiler is not None:
+        # e.g. predictions_original_<timestamp>.profile.json
+        profiler.save(f"{os.path.splitext(output_file)[0]}.profile.json")
+    print(f"{dataset_name} generation stats: {model.generation_stats}")
+    print(f"{dataset_name} throughput: {model.throughput()}")
+    print(f"{dataset_name} pipeline: {runner.stats()}")
+    if batcher is not None:
+        print(f"{dataset_name} continuous batching: {batcher.stats()}")
+    
+    return correct, total
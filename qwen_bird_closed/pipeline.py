@@ -0,0 +1,91 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+_EXHAUSTED = object()
+
+
+class PipelinedRunner:
+    """Overlap CPU preprocessing with model compute.
+
+    prepare(job) runs in a pool of worker threads (image decode, chat template,
+    resizing, processor call; see QwenVLModel.prepare_batch) and consume(job,
+    prepared) runs on the calling thread (the model). At most prefetch jobs are
+    prepared ahead of the one the model is working on, and results are yielded
+    as (job, result) in the order of jobs. With num_workers=0 both stages run
+    inline, one after the other.
+
+    stats() reports how busy each stage was: preprocessing utilization is the
+    busy time of the workers over num_workers times the wall time, and
+    model_wait_seconds is the time the model stage spent waiting for input.
+    """
+    def __init__(self, prepare, consume, num_workers=4, prefetch=8):
+        self.prepare = prepare
+        self.consume = consume
+        self.num_workers = num_workers
+        self.prefetch = max(prefetch, 1)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.batches = 0
+        self.wall_seconds = 0.0
+        self.prepare_seconds = 0.0
+        self.model_seconds = 0.0
+        self.model_wait_seconds = 0.0
+
+    def _timed_prepare(self, job):
+        begin = time.perf_counter()
+        prepared = self.prepare(job)
+        return prepared, time.perf_counter() - begin
+
+    def _consume(self, job, prepared, begin):
+        model_begin = time.perf_counter()
+        result = self.consume(job, prepared)
+        self.model_seconds += time.perf_counter() - model_begin
+        self.batches += 1
+        self.wall_seconds = time.perf_counter() - begin
+        return result
+
+    def run(self, jobs):
+        begin = time.perf_counter()
+        if self.num_workers == 0:
+            for job in jobs:
+                prepared, prepare_seconds = self._timed_prepare(job)
+                self.prepare_seconds += prepare_seconds
+                yield job, self._consume(job, prepared, begin)
+            return
+        jobs = iter(jobs)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            def submit_next():
+                job = next(jobs, _EXHAUSTED)
+                if job is not _EXHAUSTED:
+                    pending.append((job, pool.submit(self._timed_prepare, job)))
+
+            for _ in range(self.prefetch + 1):
+                submit_next()
+            try:
+                while pending:
+                    job, future = pending.popleft()
+                    wait_begin = time.perf_counter()
+                    prepared, prepare_seconds = future.result()
+                    self.model_wait_seconds += time.perf_counter() - wait_begin
+                    self.prepare_seconds += prepare_seconds
+                    # keep the queue full while the model works on this job
+                    submit_next()
+                    yield job, self._consume(job, prepared, begin)
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
+    def stats(self):
+        wall = self.wall_seconds
+        return {
+            "batches": self.batches,
+            "wall_seconds": wall,
+            "prepare_seconds": self.prepare_seconds,
+            "prepare_utilization": self.prepare_seconds / (max(self.num_workers, 1) * wall) if wall else 0.0,
+            "model_seconds": self.model_seconds,
+            "model_utilization": self.model_seconds / wall if wall else 0.0,
+            "model_wait_seconds": self.model_wait_seconds,
+        }
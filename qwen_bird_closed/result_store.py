@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+
+class ResultStore:
+    """Memoized generations in a local SQLite file.
+
+    Keys are content hashes computed by the caller (see
+    QwenVLModel._result_key): the image, the prompt tokens, the generation
+    parameters and the model. Values are any JSON-serializable result. When
+    the stored values exceed max_bytes the least recently used entries are
+    deleted; compact() gives the freed pages back to the file system.
+    Several processes can share one store. The size of the stored values is
+    kept as a running total of this process's writes and evictions, and only
+    summed over the table again when that total goes over max_bytes.
+
+    Lookups are counted per kind (e.g. "greedy" or "sampled"), see stats().
+    """
+    def __init__(self, path, max_bytes=2 * 1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.counts = {}  # kind -> [hits, misses]
+        self.evictions = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(key TEXT PRIMARY KEY, kind TEXT, value TEXT, size INTEGER, created REAL, accessed REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        self._total_bytes = self.total_bytes()
+
+    def get(self, key, kind="greedy"):
+        """Stored result for key, or None on a miss"""
+        with self._lock:
+            row = self._db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            counts = self.counts.setdefault(kind, [0, 0])
+            if row is None:
+                counts[1] += 1
+                return None
+            counts[0] += 1
+            self._db.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, value, kind="greedy"):
+        data = json.dumps(value)
+        now = time.time()
+        with self._lock:
+            replaced = self._db.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)", (key, kind, data, len(data), now, now)
+            )
+            self._total_bytes += len(data) - (replaced[0] if replaced else 0)
+            self._evict()
+
+    def _evict(self):
+        """Delete least recently used entries until the values fit in max_bytes"""
+        if self._total_bytes <= self.max_bytes:
+            return
+        # other processes may have written or evicted since, so count the table again
+        self._total_bytes = self.total_bytes()
+        excess = self._total_bytes - self.max_bytes
+        while excess > 0:
+            rows = self._db.execute("SELECT key, size FROM results ORDER BY accessed LIMIT 64").fetchall()
+            if len(rows) <= 1:
+                break
+            evicted = []
+            for key, size in rows[:-1]:
+                evicted.append((key,))
+                excess -= size
+                self._total_bytes -= size
+                if excess <= 0:
+                    break
+            self._db.executemany("DELETE FROM results WHERE key = ?", evicted)
+            self.evictions += len(evicted)
+
+    def total_bytes(self):
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def compact(self, max_bytes=None):
+        """Evict down to max_bytes (default: the store's) and shrink the file; returns the bytes freed"""
+        with self._lock:
+            before = self.file_bytes()
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+            # in WAL mode VACUUM writes the rebuilt file to the log, so checkpoint after it
+            self._db.execute("VACUUM")
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._total_bytes = self.total_bytes()
+            return before - self.file_bytes()
+
+    def file_bytes(self):
+        return sum(os.path.getsize(path) for path in (self.path, f"{self.path}-wal") if os.path.exists(path))
+
+    def stats(self):
+        hits = sum(counts[0] for counts in self.counts.values())
+        lookups = hits + sum(counts[1] for counts in self.counts.values())
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            total_bytes = self.total_bytes()
+        return {
+            "hits": hits,
+            "misses": lookups - hits,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "hit_rate_by_kind": {
+                kind: counts[0] / (counts[0] + counts[1]) for kind, counts in self.counts.items()
+            },
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": total_bytes,
+            "file_bytes": self.file_bytes(),
+        }
+
+    def close(self):
+        self._db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect, shrink or compact a result store")
+    parser.add_argument("path")
+    parser.add_argument("--max-mb", type=float, default=None,
+                        help="Evict least recently used results down to this many MB")
+    parser.add_argument("--compact", action="store_true", help="Give the freed space back to the file system")
+    args = parser.parse_args()
+
+    # nothing is evicted unless --max-mb is given
+    store = ResultStore(args.path, max_bytes=float("inf"))
+    if args.compact or args.max_mb is not None:
+        max_bytes = int(args.max_mb * 2**20) if args.max_mb is not None else None
+        print(f"Freed {store.compact(max_bytes) / 2**20:.1f} MB")
+    with store._lock:
+        by_kind = store._db.execute("SELECT kind, COUNT(*), SUM(size) FROM results GROUP BY kind").fetchall()
+    for kind, entries, size in by_kind:
+        print(f"{kind}: {entries} results, {size / 2**20:.1f} MB")
+    print(store.stats())
+    store.close()
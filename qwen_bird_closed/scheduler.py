@@ -0,0 +1,278 @@
+import time
+from collections import deque
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+from model import _greedy_token, _concat_rows
+
+
+class _Sequence:
+    """Decoding state of one admitted request"""
+    def __init__(self, request_id, prompt_ids, processors, next_position, budget, stop_strings):
+        self.request_id = request_id
+        self.prompt_ids = prompt_ids
+        self.processors = processors
+        self.tokens = []
+        self.next_position = next_position
+        self.budget = budget
+        self.stop_strings = list(stop_strings or [])
+        self.stopped_early = False
+
+    def next_token(self, logits):
+        """Greedy token after this row's logits, the generation_config processors seeing its own history"""
+        return _greedy_token(self.processors, self.prompt_ids + self.tokens, logits)
+
+
+class ContinuousBatcher:
+    """Continuous batching of greedy generations on top of a QwenVLModel.
+
+    Requests are queued with submit() and decoded together one token per step.
+    Like generate(), the logits go through the processors of the model's
+    generation_config (e.g. repetition_penalty), each row with its own history.
+    A request is admitted as soon as a row is free: it is prefilled on its own
+    and its KV cache is left-padded into the shared batch cache, while
+    finished rows are dropped right away. Short answers therefore never wait
+    for the longest reasoning trace of their batch.
+
+    collect() runs decode steps until at least one request finishes and
+    returns the finished (request_id, text) pairs in completion order.
+    Constrained decoding (labels) and sampling are not supported here, use
+    QwenVLModel.predict_batch for those.
+    """
+    def __init__(self, model, max_batch_size=8):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.eos_ids = model._eos_ids()
+        self.pad_id = model.processor.tokenizer.pad_token_id
+        self._waiting = deque()
+        self._active = []
+        self._cache = None  # DynamicCache with one left-padded row per active sequence
+        self._attention_mask = None
+        self._next_id = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.steps = 0
+        self.finished = 0
+        self.generated_tokens = 0
+        self.active_rows = 0
+        self.seconds = 0.0
+
+    def submit(self, image, prompt, max_new_tokens=None, stop_strings=None, prefix=None):
+        """Queue one (image, prompt) request and return its request id"""
+        return self.submit_prepared(
+            self.model.prepare_batch([image], [prompt], prefix=prefix), max_new_tokens, stop_strings
+        )
+
+    def submit_prepared(self, prepared, max_new_tokens=None, stop_strings=None):
+        """Queue a single-image PreparedBatch (see QwenVLModel.prepare_batch).
+
+        Request ids are assigned in submission order, starting at 0.
+        """
+        if len(prepared.images) != 1:
+            raise ValueError(f"Requests hold exactly one image, got {len(prepared.images)}")
+        request_id = self._next_id
+        self._next_id += 1
+        budget = self.model.max_new_tokens if max_new_tokens is None else max_new_tokens
+        self._waiting.append((request_id, prepared, budget, stop_strings))
+        return request_id
+
+    def num_waiting(self):
+        return len(self._waiting)
+
+    def pending(self):
+        """Number of requests not collected yet"""
+        return len(self._waiting) + len(self._active)
+
+    def collect(self):
+        """Decode until at least one request finishes, return [(request_id, text)]"""
+        finished = []
+        begin = time.perf_counter()
+        while not finished and self.pending():
+            finished.extend(self._admit())
+            if self._active:
+                finished.extend(self._step())
+        seconds = time.perf_counter() - begin
+        self.seconds += seconds
+        self.model.generation_stats["seconds"] += seconds
+        self.finished += len(finished)
+        return finished
+
+    def run(self, requests):
+        """Yield (request_id, text) for an iterable of (prepared, max_new_tokens, stop_strings).
+
+        Requests are pulled lazily, keeping one batch worth of them queued.
+        """
+        requests = iter(requests)
+        exhausted = False
+        while True:
+            while not exhausted and len(self._waiting) < self.max_batch_size:
+                request = next(requests, None)
+                if request is None:
+                    exhausted = True
+                else:
+                    self.submit_prepared(*request)
+            if not self.pending():
+                return
+            yield from self.collect()
+
+    def stats(self):
+        seconds = self.seconds
+        return {
+            "steps": self.steps,
+            "finished": self.finished,
+            "generated_tokens": self.generated_tokens,
+            "mean_batch_size": self.active_rows / self.steps if self.steps else 0.0,
+            "tokens_per_second": self.generated_tokens / seconds if seconds else 0.0,
+            "samples_per_second": self.finished / seconds if seconds else 0.0,
+        }
+
+    @torch.no_grad()
+    def _admit(self):
+        """Prefill waiting requests into the free rows; returns those already finished.
+
+        Consecutive waiting requests with the same prefix are prefilled as one
+        batch, and all admitted rows join the batch cache in a single copy.
+        """
+        finished, admitted = [], []
+        free = self.max_batch_size - len(self._active)
+        while self._waiting and free:
+            group = [self._waiting.popleft()]
+            while self._waiting and len(group) < free and self._waiting[0][1].prefix == group[0][1].prefix:
+                group.append(self._waiting.popleft())
+            free -= len(group)
+            prepared = _concat_rows([prepared for _, prepared, _, _ in group], self.pad_id)
+            inputs = prepared.inputs.to(self._device(), non_blocking=True)
+            image_embeds = None
+            if self.model.vision_cache is not None:
+                image_embeds = self.model._image_features(prepared.images, inputs)
+            generate_inputs, position_ids, outputs = self.model._prefill(
+                inputs, prefix=prepared.prefix, image_embeds=image_embeds, prefill_last=True
+            )
+            # time is accounted for by collect()
+            self.model._record_images(inputs, 0.0)
+            sequences, rows = [], []
+            for row, (request_id, _, budget, stop_strings) in enumerate(group):
+                # the prompt of the row without its left padding
+                prompt_ids = inputs.input_ids[row, inputs.input_ids.shape[1] - int(inputs.attention_mask[row].sum()):]
+                sequence = _Sequence(
+                    request_id, prompt_ids.tolist(), self.model._logits_processors(prompt_ids[None]),
+                    int(position_ids[0, row, -1]) + 1, budget, stop_strings,
+                )
+                sequence.tokens.append(sequence.next_token(outputs.logits[row, -1]))
+                if self._is_finished(sequence):
+                    finished.append(self._finish(sequence))
+                    free += 1
+                else:
+                    sequences.append(sequence)
+                    rows.append(row)
+            if rows:
+                admitted.append((sequences, outputs.past_key_values, generate_inputs["attention_mask"], rows))
+        if admitted:
+            self._add_rows(admitted)
+        return finished
+
+    def _add_rows(self, admitted):
+        """Append the rows of admitted prefills to the batch cache in one copy, left-padding the shorter ones.
+
+        admitted holds the (sequences, cache, attention mask, rows kept) of every prefill.
+        """
+        parts = [(cache, mask, torch.tensor(rows, device=mask.device)) for _, cache, mask, rows in admitted]
+        if self._cache is not None:
+            parts.insert(0, (self._cache, self._attention_mask, None))
+        target = max(mask.shape[1] for _, mask, _ in parts)
+
+        def rows_of(tensor, index, length):
+            return _left_pad(tensor if index is None else tensor[index], length)
+
+        self._cache = DynamicCache(ddp_cache_data=[
+            (
+                torch.cat([rows_of(cache.layers[i].keys, index, target) for cache, _, index in parts]),
+                torch.cat([rows_of(cache.layers[i].values, index, target) for cache, _, index in parts]),
+            )
+            for i in range(len(parts[0][0].layers))
+        ])
+        self._attention_mask = torch.cat([
+            F.pad(mask if index is None else mask[index], (target - mask.shape[1], 0)) for _, mask, index in parts
+        ])
+        for sequences, _, _, _ in admitted:
+            self._active.extend(sequences)
+
+    def _device(self):
+        return self.model.model.device
+
+    def _drop_rows(self, keep):
+        """Keep only the given rows and trim columns that are padding in every row"""
+        if not keep:
+            self._cache, self._attention_mask = None, None
+            return
+        index = torch.tensor(keep, device=self._attention_mask.device)
+        mask = self._attention_mask[index]
+        start = int(mask.any(0).nonzero()[0])
+        self._attention_mask = mask[:, start:]
+        self._cache = DynamicCache(ddp_cache_data=[
+            (layer.keys[index][:, :, start:], layer.values[index][:, :, start:]) for layer in self._cache.layers
+        ])
+
+    @torch.no_grad()
+    def _step(self):
+        """Decode one token for every active row; returns the requests that finished"""
+        device = self._attention_mask.device
+        num_rows, length = self._attention_mask.shape
+        input_ids = torch.tensor([[sequence.tokens[-1]] for sequence in self._active], device=device)
+        positions = torch.tensor([sequence.next_position for sequence in self._active], device=device)
+        attention_mask = torch.cat([self._attention_mask, self._attention_mask.new_ones(num_rows, 1)], dim=1)
+        outputs = self.model.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=positions.view(1, -1, 1).expand(3, -1, -1),
+            past_key_values=self._cache,
+            cache_position=torch.tensor([length], device=device),
+            use_cache=True,
+        )
+        self._attention_mask = attention_mask
+        logits = outputs.logits[:, -1]
+        self.steps += 1
+        self.active_rows += num_rows
+
+        finished, keep = [], []
+        for row, sequence in enumerate(self._active):
+            sequence.tokens.append(sequence.next_token(logits[row]))
+            sequence.next_position += 1
+            if self._is_finished(sequence):
+                finished.append(self._finish(sequence))
+            else:
+                keep.append(row)
+        if finished:
+            self._active = [self._active[row] for row in keep]
+            self._drop_rows(keep)
+        return finished
+
+    def _is_finished(self, sequence):
+        if sequence.tokens[-1] in self.eos_ids or len(sequence.tokens) >= sequence.budget:
+            return True
+        if sequence.stop_strings:
+            window = max(len(stop) for stop in sequence.stop_strings) + 1
+            tail = self.model.processor.tokenizer.decode(sequence.tokens[-window:], skip_special_tokens=True)
+            if any(stop in tail for stop in sequence.stop_strings):
+                sequence.stopped_early = True
+                return True
+        return False
+
+    def _finish(self, sequence):
+        stats = self.model.generation_stats
+        stats["sequences"] += 1
+        stats["generated_tokens"] += len(sequence.tokens)
+        if sequence.stopped_early:
+            stats["stopped_early"] += 1
+            stats["tokens_saved"] += sequence.budget - len(sequence.tokens)
+        self.generated_tokens += len(sequence.tokens)
+        text = self.model.processor.tokenizer.decode(
+            sequence.tokens, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
+        return sequence.request_id, text
+
+
+def _left_pad(tensor, length):
+    """Left-pad a (batch, heads, seq, dim) cache tensor to length along seq"""
+    return F.pad(tensor, (0, 0, length - tensor.shape[-2], 0))
@@ -0,0 +1,27 @@
+import os
+
+
+def shard_range(num_samples, num_shards=1, shard_id=0):
+    """Contiguous slice of the sample indices evaluated by shard shard_id of num_shards.
+
+    Shard sizes differ by at most one and, taken in shard order, the slices
+    cover every index exactly once, so concatenating the shard outputs gives
+    the single-process order.
+    """
+    if not 0 <= shard_id < num_shards:
+        raise ValueError(f"shard_id must be in [0, {num_shards}), got {shard_id}")
+    return range(num_samples * shard_id // num_shards, num_samples * (shard_id + 1) // num_shards)
+
+
+def shard_path(path, num_shards=1, shard_id=0):
+    """path of one shard's output, e.g. predictions_X_shard2of4.txt; unchanged without sharding"""
+    if num_shards == 1:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}_shard{shard_id}of{num_shards}{extension}"
+
+
+def shard_paths(path, num_shards):
+    """Outputs of every shard of a run, in shard order"""
+    return [shard_path(path, num_shards, shard_id) for shard_id in range(num_shards)]
+
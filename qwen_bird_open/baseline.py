@@ -1,46 +1,124 @@
 # Test qwen2.5VL 2b model on the Caltech-UCSD Birds 200-2011 dataset
 from dataset import CUB200Dataset
 from model import QwenVLModel
+from server import RemoteQwenVLModel
+from result_store import ResultStore
+from sharding import shard_range, shard_path, shard_paths
+from profiler import Profiler
 import os
+import sys
 import datetime
 import json
+import argparse
 
 # Base path configuration
 BASE_PATH = "/home/samuele.angheben/vision-reasoning/qwen_bird_open"
 
+parser = argparse.ArgumentParser()
+parser.add_argument("--early-stop", action="store_true",
+                    help="Stop each answer at the first newline or period")
+parser.add_argument("--device", default=None,
+                    help="auto, cuda, cuda:N or cpu (default: auto when a GPU is visible, else cpu)")
+parser.add_argument("--dtype", default="auto", help="auto, bfloat16, float16 or float32 (auto is bfloat16 on CPU)")
+parser.add_argument("--quantize", choices=["int8"], default=None,
+                    help="Dynamically quantize the linear layers (CPU only)")
+parser.add_argument("--num-threads", type=int, default=None, help="CPU threads (default: all available cores)")
+parser.add_argument("--result-store", default=None,
+                    help="SQLite file memoizing generations across runs (greedy results, and sampled ones with a seed)")
+parser.add_argument("--server", default=None,
+                    help="URL of a running server.py (e.g. http://127.0.0.1:8765) to use instead of loading the "
+                         "model here; the model options are then those of the server")
+parser.add_argument("--profile", action="store_true",
+                    help="Record the time spent in each stage of every model call (templating, preprocessing, "
+                         "prefill, decoding, ...) and save percentiles next to the predictions")
+parser.add_argument("--num-shards", type=int, default=1,
+                    help="Split the dataset into this many contiguous shards, one per process")
+parser.add_argument("--shard-id", type=int, default=0, help="Shard evaluated by this process (0-based)")
+parser.add_argument("--run-id", default=None,
+                    help="Name shared by the shards of a run, used in the output file names instead of the start "
+                         "time (e.g. $SLURM_ARRAY_JOB_ID)")
+parser.add_argument("--merge", action="store_true",
+                    help="Combine the outputs of the --num-shards shards of --run-id instead of evaluating")
+args = parser.parse_args()
+if not 0 <= args.shard_id < args.num_shards:
+    parser.error(f"--shard-id must be in [0, {args.num_shards})")
+if args.num_shards > 1 and args.run_id is None:
+    parser.error("--num-shards needs a --run-id shared by every shard")
+if args.merge and (args.run_id is None or args.num_shards == 1):
+    parser.error("--merge needs the --run-id and --num-shards of the sharded run")
+
+outputs_dir = os.path.join(BASE_PATH, "outputs_test")
+
+def group_by_class(results):
+    """Predictions grouped by ground truth class, in dataset order"""
+    class_predictions = {}
+    for result in results:
+        if result["ground_truth"] not in class_predictions:
+            class_predictions[result["ground_truth"]] = []
+        class_predictions[result["ground_truth"]].append(result["prediction"])
+    return class_predictions
+
+def save_results(results, timestamp, num_shards=1, shard_id=0):
+    """Write the predictions and the class-wise predictions of a run (or of one of its shards)"""
+    output_path = shard_path(os.path.join(outputs_dir, f"predictions_{timestamp}.json"), num_shards, shard_id)
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2)
+
+    # Save class-wise predictions
+    class_pred_path = shard_path(
+        os.path.join(outputs_dir, f"perclass_predictions_{timestamp}.json"), num_shards, shard_id
+    )
+    with open(class_pred_path, "w") as f:
+        json.dump(group_by_class(results), f, indent=2)
+
+if args.merge:
+    # the shards hold consecutive slices of the dataset
+    results = []
+    for path in shard_paths(os.path.join(outputs_dir, f"predictions_{args.run_id}.json"), args.num_shards):
+        with open(path) as f:
+            results.extend(json.load(f))
+    save_results(results, args.run_id)
+    print(f"Merged {args.num_shards} shards ({len(results)} samples) of run {args.run_id}")
+    sys.exit()
+
+# The answer is a 1-3 word label, nothing after the first line or sentence is used
+stop_strings = ["\n", "."] if args.early_stop else None
+
 CUB200Dataset = CUB200Dataset(split='test')
 dataset = CUB200Dataset.get_dataset()
 class_names_dict = CUB200Dataset.class_names_dict
 
-model = QwenVLModel()
+result_store = ResultStore(args.result_store) if args.result_store and not args.server else None
+profiler = Profiler() if args.profile and not args.server else None
+if args.server:
+    model = RemoteQwenVLModel(args.server)
+else:
+    model = QwenVLModel(device=args.device, dtype=args.dtype, quantize=args.quantize,
+                        num_threads=args.num_threads, result_store=result_store, profiler=profiler)
 prompt = "Analyze the given image and predict the most specific and accurate label possible for the primary object or scene depicted. Use scientific or technical terms when applicable to enhance specificity. If there is uncertainty about the exact label, provide a more general category or abstain from making a prediction. Ensure that all predictions are accurate and avoid guessing. The response should only contain the possible classification label, limited to a maximum of 1-3 words."
 
-outputs_dir = os.path.join(BASE_PATH, "outputs_test")
 os.makedirs(outputs_dir, exist_ok=True)
-timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+timestamp = args.run_id or datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 
 results = []
-class_predictions = {}
 
-for idx, sample in enumerate(dataset):
-    prediction = model.predict(sample["image"], prompt)
+# This process evaluates one contiguous slice of the dataset
+for idx in shard_range(len(dataset), args.num_shards, args.shard_id):
+    sample = dataset[idx]
+    prediction = model.predict(sample["image"], prompt, stop_strings=stop_strings)
     ground_truth = class_names_dict[sample['label']]
     results.append({
         "index": idx,
         "prediction": prediction,
         "ground_truth": ground_truth
     })
-    # Group predictions by ground truth class
-    if ground_truth not in class_predictions:
-        class_predictions[ground_truth] = []
-    class_predictions[ground_truth].append(prediction)
-
-output_path = os.path.join(outputs_dir, f"predictions_{timestamp}.json")
-with open(output_path, "w") as f:
-    json.dump(results, f, indent=2)
 
-# Save class-wise predictions
-class_pred_path = os.path.join(outputs_dir, f"perclass_predictions_{timestamp}.json")
-with open(class_pred_path, "w") as f:
-    json.dump(class_predictions, f, indent=2)
+save_results(results, timestamp, args.num_shards, args.shard_id)
+if profiler is not None:
+    profiler.save(shard_path(os.path.join(outputs_dir, f"predictions_{timestamp}.profile.json"), args.num_shards,
+                             args.shard_id))
 
+print(f"Generation stats: {model.generation_stats}")
+print(f"Throughput: {model.throughput()}")
+if result_store is not None:
+    print(f"Result store: {result_store.stats()}")
@@ -1,38 +1,210 @@
 # Test qwen2.5VL 2b model on the Caltech-UCSD Birds 200-2011 dataset
 from dataset import CUB200Dataset
 from model import QwenVLModel
+from server import RemoteQwenVLModel
+from result_store import ResultStore
+from checkpoint import Checkpoint, latest_timestamp, sync_file
+from pipeline import PipelinedRunner
+from sharding import shard_range, shard_path, shard_paths
+from profiler import Profiler
+from collections import Counter
 import os
+import sys
+import re
 import datetime
 import json
+import argparse
 
 # Base path configuration
 BASE_PATH = "/home/samuele.angheben/vision-reasoning/qwen_bird_open"
 
+parser = argparse.ArgumentParser()
+parser.add_argument("--early-stop", action="store_true",
+                    help="Stop each answer at the first newline or period")
+parser.add_argument("--num-workers", type=int, default=0,
+                    help="Threads decoding and preprocessing images ahead of the model (0 runs everything inline)")
+parser.add_argument("--prefetch", type=int, default=8, help="Images prepared ahead of the model")
+parser.add_argument("--num-samples", type=int, default=100,
+                    help="Labels sampled per image (the maximum with --min-samples)")
+parser.add_argument("--min-samples", type=int, default=None,
+                    help="Sample adaptively: draw at least this many labels, then stop once new labels are unlikely")
+parser.add_argument("--round-size", type=int, default=10, help="Labels drawn per round when sampling adaptively")
+parser.add_argument("--new-label-threshold", type=float, default=0.05,
+                    help="Stop when the Good-Turing probability that the next label is a new one falls below this")
+parser.add_argument("--seed", type=int, default=None,
+                    help="Seed of the label sampling (needed to reuse sampled labels from --result-store)")
+parser.add_argument("--sample-memory-mb", type=int, default=None,
+                    help="Decode the samples of an image in chunks whose decode state fits in this many MB")
+parser.add_argument("--device", default=None,
+                    help="auto, cuda, cuda:N or cpu (default: auto when a GPU is visible, else cpu)")
+parser.add_argument("--dtype", default="auto", help="auto, bfloat16, float16 or float32 (auto is bfloat16 on CPU)")
+parser.add_argument("--quantize", choices=["int8"], default=None,
+                    help="Dynamically quantize the linear layers (CPU only)")
+parser.add_argument("--num-threads", type=int, default=None, help="CPU threads (default: all available cores)")
+parser.add_argument("--resume", nargs="?", const="latest", default=None, metavar="TIMESTAMP",
+                    help="Continue an interrupted run (default: the latest one) from its checkpoint")
+parser.add_argument("--checkpoint-interval", type=float, default=60.0,
+                    help="Seconds between checkpoints of the collected labels")
+parser.add_argument("--result-store", default=None,
+                    help="SQLite file memoizing generations across runs (greedy results, and sampled ones with a seed)")
+parser.add_argument("--server", default=None,
+                    help="URL of a running server.py (e.g. http://127.0.0.1:8765) to use instead of loading the "
+                         "model here; the model options are then those of the server")
+parser.add_argument("--profile", action="store_true",
+                    help="Record the time spent in each stage of every model call (templating, preprocessing, "
+                         "prefill, decoding, ...) and save percentiles next to the predictions")
+parser.add_argument("--num-shards", type=int, default=1,
+                    help="Split the dataset into this many contiguous shards, one per process")
+parser.add_argument("--shard-id", type=int, default=0, help="Shard evaluated by this process (0-based)")
+parser.add_argument("--run-id", default=None,
+                    help="Name shared by the shards of a run, used in the output file names instead of the start "
+                         "time (e.g. $SLURM_ARRAY_JOB_ID)")
+parser.add_argument("--merge", action="store_true",
+                    help="Combine the outputs of the --num-shards shards of --run-id instead of sampling")
+args = parser.parse_args()
+if not 0 <= args.shard_id < args.num_shards:
+    parser.error(f"--shard-id must be in [0, {args.num_shards})")
+if args.num_shards > 1 and args.run_id is None:
+    parser.error("--num-shards needs a --run-id shared by every shard")
+if args.merge and (args.run_id is None or args.num_shards == 1):
+    parser.error("--merge needs the --run-id and --num-shards of the sharded run")
+
+outputs_dir = os.path.join(BASE_PATH, "outputs_train")
+
+def group_by_class(results):
+    """Sampled labels grouped by ground truth class, in dataset order"""
+    class_predictions = {}
+    for result in results:
+        if result["ground_truth"] not in class_predictions:
+            class_predictions[result["ground_truth"]] = []
+        class_predictions[result["ground_truth"]].extend(result["predictions"])
+    return class_predictions
+
+def save_results(results, timestamp, num_shards=1, shard_id=0):
+    """Write the sampled labels and the class-wise labels of a run (or of one of its shards)"""
+    output_path = shard_path(os.path.join(outputs_dir, f"predictions_{timestamp}.json"), num_shards, shard_id)
+    print(f"Saving all predictions to {output_path}")
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2)
+
+    # Save class-wise predictions
+    class_pred_path = shard_path(
+        os.path.join(outputs_dir, f"perclass_predictions_{timestamp}.json"), num_shards, shard_id
+    )
+    print(f"Saving class-wise predictions to {class_pred_path}")
+    with open(class_pred_path, "w") as f:
+        json.dump(group_by_class(results), f, indent=2)
+
+if args.merge:
+    # the shards hold consecutive slices of the dataset
+    results = []
+    for path in shard_paths(os.path.join(outputs_dir, f"predictions_{args.run_id}.json"), args.num_shards):
+        with open(path) as f:
+            results.extend(json.load(f))
+    save_results(results, args.run_id)
+    print(f"Merged {args.num_shards} shards ({len(results)} samples) of run {args.run_id}")
+    sys.exit()
+
+# The answer is a 1-3 word label, nothing after the first line or sentence is used
+stop_strings = ["\n", "."] if args.early_stop else None
+
 CUB200Dataset = CUB200Dataset(split='train')
 dataset = CUB200Dataset.get_dataset()
 class_names_dict = CUB200Dataset.class_names_dict
 
-model = QwenVLModel()
+result_store = ResultStore(args.result_store) if args.result_store and not args.server else None
+profiler = Profiler() if args.profile and not args.server else None
+if args.server:
+    model = RemoteQwenVLModel(args.server)
+else:
+    model = QwenVLModel(device=args.device, dtype=args.dtype, quantize=args.quantize,
+                        num_threads=args.num_threads, result_store=result_store, profiler=profiler)
 prompt = "For open world classification task, analyze the given image and predict the most specific and accurate label possible for the primary object or scene depicted. Use scientific or technical terms when applicable to enhance specificity. If there is uncertainty about the exact label, provide a more general category or abstain from making a prediction. Avoid wrong predictions. Ensure that all predictions are accurate and avoid guessing. The response should only contain the possible classification label, limited to a maximum of 1-3 words."
 
-outputs_dir = os.path.join(BASE_PATH, "outputs_train")
 os.makedirs(outputs_dir, exist_ok=True)
 timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+if args.run_id is not None:
+    timestamp = args.run_id
+elif args.resume == "latest":
+    timestamp = latest_timestamp(outputs_dir)
+    if timestamp is None:
+        parser.error(f"No checkpoint to resume in {outputs_dir}")
+elif args.resume is not None:
+    timestamp = args.resume
+print(f"Run {timestamp}")
 
+# Results are appended to a JSON lines file as they come; the checkpoint holds
+# how much of it is synced to disk
+partial_path = shard_path(
+    os.path.join(outputs_dir, f"predictions_{timestamp}.partial.jsonl"), args.num_shards, args.shard_id
+)
+checkpoint = Checkpoint(shard_path(
+    os.path.join(outputs_dir, f"predictions_{timestamp}.checkpoint"), args.num_shards, args.shard_id
+), interval=args.checkpoint_interval)
+state = checkpoint.load() if args.resume is not None else None
+partial_file = open(partial_path, "w" if state is None else "r+")
 results = []
-class_predictions = {}
+if state is not None:
+    # drop the results written after the checkpoint, they are sampled again
+    partial_file.truncate(state["output_position"])
+    results = [json.loads(line) for line in partial_file.read().splitlines()]
+    model.generation_stats.update(state["generation_stats"])
+    print(f"Resuming at sample {len(results)}")
 
-for idx, sample in enumerate(dataset):
+def save_checkpoint():
+    sync_file(partial_file)
+    checkpoint.save({"output_position": partial_file.tell(), "generation_stats": model.generation_stats})
+
+def prepare(idx):
+    """Decode and preprocess one sample"""
+    sample = dataset[idx]
+    return sample, model.prepare_batch([sample["image"]], prompt)
+
+sampling = dict(
+    do_sample=True,
+    top_k=100,
+    top_p=0.95,
+    temperature=1.3,
+    max_new_tokens=64,
+    stop_strings=stop_strings,
+    max_sample_memory=args.sample_memory_mb * 2 ** 20 if args.sample_memory_mb else None,
+    seed=args.seed
+)
+
+def normalize_label(text):
+    """Normalize a label by replacing punctuation with spaces and converting to lowercase"""
+    text = re.sub(r'[^a-zA-Z\s]', ' ', text.lower())
+    return ' '.join(text.split())
+
+def new_label_probability(counts):
+    """Good-Turing estimate of the probability that the next draw is an unseen label:
+    the fraction of draws whose label was seen exactly once"""
+    return sum(1 for count in counts.values() if count == 1) / sum(counts.values())
+
+def sample_labels(idx, prepared):
+    """Sample candidate labels for one prepared sample"""
+    sample, inputs = prepared
+    if args.min_samples is None:
+        return sample, model.predict_multiple_prepared(inputs, num_return_sequences=args.num_samples, **sampling)
+    predictions = []
+    counts = Counter()
+    rounds = model.predict_multiple_rounds(inputs, round_size=args.round_size, **sampling)
+    for texts in rounds:
+        texts = texts[:args.num_samples - len(predictions)]
+        predictions.extend(texts)
+        counts.update(normalize_label(text) for text in texts)
+        if len(predictions) >= args.num_samples:
+            break
+        if len(predictions) >= args.min_samples and new_label_probability(counts) < args.new_label_threshold:
+            break
+    rounds.close()
+    return sample, predictions
+
+# This process samples one contiguous slice of the dataset
+shard = shard_range(len(dataset), args.num_shards, args.shard_id)
+runner = PipelinedRunner(prepare, sample_labels, num_workers=args.num_workers, prefetch=args.prefetch)
+for idx, (sample, predictions) in runner.run(range(shard.start + len(results), shard.stop)):
     print(f"Processing sample {idx} / {len(dataset)}")
-    predictions = model.predict_multiple(
-        sample["image"], prompt,
-        do_sample=True,
-        top_k=100,
-        top_p=0.95,
-        temperature=1.3,
-        num_return_sequences=100,
-        max_new_tokens=64
-    )
     print(f"Predictions for sample {idx}: {predictions}")
     ground_truth = class_names_dict[sample['label']]
     print(f"Ground truth for sample {idx}: {ground_truth}")
@@ -41,18 +213,24 @@ for idx, sample in enumerate(dataset):
         "predictions": predictions,
         "ground_truth": ground_truth
     })
-    # Group predictions by ground truth class
-    if ground_truth not in class_predictions:
-        class_predictions[ground_truth] = []
-    class_predictions[ground_truth].extend(predictions)
-
-output_path = os.path.join(outputs_dir, f"predictions_{timestamp}.json")
-print(f"Saving all predictions to {output_path}")
-with open(output_path, "w") as f:
-    json.dump(results, f, indent=2)
-
-# Save class-wise predictions
-class_pred_path = os.path.join(outputs_dir, f"perclass_predictions_{timestamp}.json")
-print(f"Saving class-wise predictions to {class_pred_path}")
-with open(class_pred_path, "w") as f:
-    json.dump(class_predictions, f, indent=2)
\ No newline at end of file
+    partial_file.write(json.dumps(results[-1]) + "\n")
+    if checkpoint.due():
+        save_checkpoint()
+partial_file.close()
+
+save_results(results, timestamp, args.num_shards, args.shard_id)
+if profiler is not None:
+    # only the samples drawn by this process, a resumed run does not profile the earlier ones
+    profiler.save(shard_path(os.path.join(outputs_dir, f"predictions_{timestamp}.profile.json"), args.num_shards,
+                             args.shard_id))
+
+# the run is complete, nothing is left to resume
+checkpoint.remove()
+os.remove(partial_path)
+
+print(f"Generation stats: {model.generation_stats}")
+print(f"Labels sampled per image: {model.generation_stats['sequences'] / max(len(results), 1):.1f}")
+print(f"Throughput: {model.throughput()}")
+if result_store is not None:
+    print(f"Result store: {result_store.stats()}")
+print(f"Pipeline: {runner.stats()}")
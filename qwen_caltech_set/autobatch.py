@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import hashlib
+import platform
+import torch
+from PIL import Image
+from model import is_out_of_memory
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "qwen_vl", "batch_sizes.json")
+
+
+def hardware_fingerprint(model):
+    """The devices a QwenVLModel runs on, their memory, and the torch build"""
+    devices = sorted({str(parameter.device) for parameter in model.model.parameters()})
+    if any(device.startswith("cuda") for device in devices):
+        hardware = [
+            [torch.cuda.get_device_name(i), torch.cuda.get_device_properties(i).total_memory]
+            for i in range(torch.cuda.device_count())
+        ]
+    else:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        hardware = [[_cpu_name(), torch.get_num_threads(), memory]]
+    return {"devices": devices, "hardware": hardware, "torch": torch.__version__}
+
+
+def _cpu_name():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+class BatchSizeTuner:
+    """Largest batch size a QwenVLModel can run without running out of memory.
+
+    probe() generates for batches of a worst-case sample: copies of an image
+    of image_size (default: the largest the image budget allows) and a
+    generation forced to run for all of max_new_tokens. The batch size is
+    doubled until a batch runs out of memory, then bisected; headroom keeps a
+    margin below the largest batch that fit. Results are cached in a JSON file
+    per hardware fingerprint, model, image budget, image size, prompt length
+    and max_new_tokens, so later runs on the same kind of node start right
+    away. QwenVLModel still halves a batch that runs out of memory anyway.
+    """
+    def __init__(self, model, cache_path=DEFAULT_CACHE, max_batch_size=64, headroom=0.9):
+        self.model = model
+        self.cache_path = cache_path
+        self.max_batch_size = max_batch_size
+        self.headroom = headroom
+        self.probes = []  # (batch_size, fits) of the last probe
+
+    def batch_size(self, prompt, max_new_tokens=None, image_size=None):
+        """The cached batch size for this configuration, probed first if there is none"""
+        max_new_tokens = self.model.max_new_tokens if max_new_tokens is None else max_new_tokens
+        image_size = self._largest_image_size() if image_size is None else tuple(image_size)
+        configuration = self.configuration(prompt, max_new_tokens, image_size)
+        key = hashlib.sha256(json.dumps(configuration, sort_keys=True).encode()).hexdigest()
+        cache = self._load()
+        if key not in cache:
+            begin = time.perf_counter()
+            batch_size = self.probe(prompt, max_new_tokens, image_size)
+            cache = self._load()
+            cache[key] = {
+                "batch_size": batch_size,
+                "probes": self.probes,
+                "probe_seconds": time.perf_counter() - begin,
+                "configuration": configuration,
+            }
+            self._save(cache)
+        return cache[key]["batch_size"]
+
+    def configuration(self, prompt, max_new_tokens, image_size):
+        model = self.model
+        prompt_length = len(model.processor.tokenizer(prompt).input_ids)
+        return {
+            "hardware": hardware_fingerprint(model),
+            "model": [model.model_name, str(model.model.dtype), model.quantize],
+            "pixels": [model.min_pixels, model.max_pixels],
+            "image_tokens": model.image_token_count(*image_size),
+            "prompt_tokens": prompt_length,
+            "max_new_tokens": max_new_tokens,
+            "max_batch_size": self.max_batch_size,
+            "headroom": self.headroom,
+        }
+
+    def probe(self, prompt, max_new_tokens, image_size):
+        """Largest batch size (times headroom) that fits, up to max_batch_size"""
+        image = Image.new("RGB", image_size, (127, 127, 127))
+        self.probes = []
+        fits, too_large = 0, None
+        batch_size = 1
+        while too_large is None:
+            if self._fits(batch_size, image, prompt, max_new_tokens):
+                fits = batch_size
+                if batch_size == self.max_batch_size:
+                    break
+                batch_size = min(2 * batch_size, self.max_batch_size)
+            else:
+                too_large = batch_size
+        if fits == 0:
+            raise RuntimeError(f"A single {image_size[0]}x{image_size[1]} sample does not fit in memory")
+        if too_large is None:
+            return fits
+        while too_large - fits > 1:
+            batch_size = (fits + too_large) // 2
+            if self._fits(batch_size, image, prompt, max_new_tokens):
+                fits = batch_size
+            else:
+                too_large = batch_size
+        return max(1, int(fits * self.headroom))
+
+    @torch.no_grad()
+    def _fits(self, batch_size, image, prompt, max_new_tokens):
+        model = self.model
+        inputs = model.prepare_batch([image] * batch_size, prompt).inputs.to(model.model.device)
+        try:
+            model.model.generate(**inputs, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens)
+            fits = True
+        except RuntimeError as error:
+            if not is_out_of_memory(error):
+                raise
+            fits = False
+        del inputs
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        self.probes.append([batch_size, fits])
+        return fits
+
+    def _largest_image_size(self):
+        """A square image at the model's largest image budget"""
+        max_pixels = self.model.max_pixels or self.model.processor.image_processor.size["longest_edge"]
+        side = int(max_pixels ** 0.5)
+        return side, side
+
+    def _load(self):
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save(self, cache):
+        if os.path.dirname(self.cache_path):
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, self.cache_path)
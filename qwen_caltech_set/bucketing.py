@@ -0,0 +1,89 @@
+import io
+from PIL import Image
+
+
+def image_sizes(dataset):
+    """(width, height) of every image of a dataset, read from the file headers without decoding.
+
+    Works with Hugging Face datasets with an "image" column (CUB200Dataset.get_dataset
+    and get_dataset_cropped), Caltech101 (images) and Flowers102 (_image_files).
+    """
+    if hasattr(dataset, "cast_column"):
+        from datasets import Image as ImageFeature
+        encoded = dataset.select_columns(["image"]).cast_column("image", ImageFeature(decode=False))
+        return [_header_size(io.BytesIO(row["image"]["bytes"]) if row["image"]["bytes"] else row["image"]["path"])
+                for row in encoded]
+    if hasattr(dataset, "images"):
+        return [_header_size(path) for path in dataset.images]
+    if hasattr(dataset, "_image_files"):
+        return [_header_size(path) for path in dataset._image_files]
+    raise TypeError(f"Cannot read the image sizes of a {type(dataset).__name__}")
+
+
+def _header_size(file):
+    # PIL parses only the header on open, pixels are decoded on first access
+    with Image.open(file) as image:
+        return image.size
+
+
+def token_counts(model, dataset):
+    """Visual tokens of every image of a dataset, see QwenVLModel.image_token_count"""
+    return [model.image_token_count(width, height) for width, height in image_sizes(dataset)]
+
+
+def bucket_batches(indices, token_counts, batch_size, window=512):
+    """Batches of the given indices with similar visual token counts.
+
+    Indices are sorted by token count within consecutive windows of window
+    samples and then cut into batches, so a batch is padded to little more
+    than its shortest sequence while results can be put back in dataset order
+    (see in_index_order) holding at most one window of them.
+    """
+    indices = list(indices)
+    batches = []
+    for start in range(0, len(indices), window):
+        ordered = sorted(indices[start:start + window], key=lambda idx: token_counts[idx])
+        batches.extend(ordered[i:i + batch_size] for i in range(0, len(ordered), batch_size))
+    return batches
+
+
+def padding_tokens(batches, token_counts):
+    """Pad tokens added to left-pad every batch to its longest image"""
+    return sum(
+        len(batch) * max(token_counts[idx] for idx in batch) - sum(token_counts[idx] for idx in batch)
+        for batch in batches
+    )
+
+
+def padding_report(batches, token_counts, batch_size):
+    """Padding of the bucketed batches against consecutive batches of the same indices"""
+    indices = sorted(idx for batch in batches for idx in batch)
+    consecutive = [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+    padded = padding_tokens(batches, token_counts)
+    consecutive_padded = padding_tokens(consecutive, token_counts)
+    image_tokens = sum(token_counts[idx] for idx in indices)
+    return {
+        "image_tokens": image_tokens,
+        "padding_tokens": padded,
+        "consecutive_padding_tokens": consecutive_padded,
+        "saved_tokens": consecutive_padded - padded,
+        "waste": padded / (image_tokens + padded) if image_tokens else 0.0,
+        "consecutive_waste": consecutive_padded / (image_tokens + consecutive_padded) if image_tokens else 0.0,
+    }
+
+
+def in_index_order(results, first=0):
+    """Yield per-sample results of bucketed batches back in index order.
+
+    results yields (indices, values) with values a tuple of per-sample lists
+    (or None); every sample comes out as a tuple of one-element lists, starting
+    at index first.
+    """
+    pending = {}
+    next_idx = first
+    for indices, values in results:
+        for i, idx in enumerate(indices):
+            pending[idx] = tuple(None if value is None else [value[i]] for value in values)
+        while next_idx in pending:
+            yield pending.pop(next_idx)
+            next_idx += 1
@@ -0,0 +1,68 @@
+import os
+import json
+import hashlib
+import torch
+from model import TEXT_EMBED_PROMPT
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "qwen_vl", "class_embeddings")
+# text embedded for every class name of CUB-200
+CLASS_TEMPLATE = "A photo of a {}, a type of bird."
+
+
+def class_embeddings(model, class_names, cache_dir=DEFAULT_CACHE, template=CLASS_TEMPLATE):
+    """Embedding matrix of class_names (one normalized row per class), each filled into template.
+
+    Computed once per model name, dtype, template and class list.
+    """
+    key = hashlib.sha256(json.dumps({
+        "model": model.model_name,
+        "dtype": str(model.model.dtype),
+        "prompt": TEXT_EMBED_PROMPT,
+        "template": template,
+        "classes": list(class_names),
+    }, sort_keys=True).encode()).hexdigest()
+    path = os.path.join(cache_dir, f"{key}.pt")
+    if os.path.exists(path):
+        return torch.load(path)
+    embeddings = model.embed_texts([template.format(name) for name in class_names])
+    os.makedirs(cache_dir, exist_ok=True)
+    torch.save(embeddings, path)
+    return embeddings
+
+
+class CandidateFilter:
+    """Retrieval of the classes an image most likely belongs to.
+
+    Images and class names are embedded by the Qwen model itself (see
+    QwenVLModel.embed_images and embed_texts) and ranked by cosine
+    similarity. A closed-set prompt then only needs to list the top-k
+    candidates of each image (see class_list) instead of every class; how
+    often the true class survives is recall_at_k of the rankings. template
+    is the text embedded for each class name (e.g. "A photo of a {}.").
+    """
+    def __init__(self, model, class_names_dict, cache_dir=DEFAULT_CACHE, template=CLASS_TEMPLATE):
+        self.model = model
+        self.class_names = [class_names_dict[i] for i in range(len(class_names_dict))]
+        self.class_embeddings = class_embeddings(model, self.class_names, cache_dir, template)
+
+    def rank(self, dataset, batch_size=8):
+        """Class indices of every sample from most to least similar, and the labels of the samples"""
+        rankings = []
+        labels = []
+        for start in range(0, len(dataset), batch_size):
+            batch = [dataset[i] for i in range(start, min(start + batch_size, len(dataset)))]
+            embeddings = self.model.embed_images([sample["image"] for sample in batch], batch_size=batch_size)
+            similarity = embeddings @ self.class_embeddings.T
+            rankings.extend(similarity.argsort(dim=-1, descending=True).tolist())
+            labels.extend(sample["label"] for sample in batch)
+        return rankings, labels
+
+
+def recall_at_k(rankings, labels, ks):
+    """Number of samples whose label is among their top k classes, for every k in ks"""
+    return {k: sum(label in ranking[:k] for ranking, label in zip(rankings, labels)) for k in ks}
+
+
+def class_list(class_names_dict, indices):
+    """Numbered list of some classes, in the format of CUB200Dataset.prompt_class_list"""
+    return "\n".join(f"{i + 1}. {class_names_dict[index]}" for i, index in enumerate(sorted(indices)))
@@ -1,44 +1,1560 @@
+import os
+import copy
+import time
+import hashlib
+import itertools
+import threading
+import contextlib
 import torch
-from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor
+import torch.nn.functional as F
+from collections import Counter, namedtuple
+from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, StoppingCriteria, StoppingCriteriaList
+from transformers import Cache
+from transformers import BatchFeature
+from transformers.cache_utils import DynamicLayer
+from transformers.models.qwen2_vl.image_processing_qwen2_vl import smart_resize
 from qwen_vl_utils import process_vision_info
+from qwen_vl_utils import vision_process
+
+
+# Output of QwenVLModel.prepare_batch: processor outputs on CPU, the resized
+# images fed to the processor and the prefix the prompts were templated with
+PreparedBatch = namedtuple("PreparedBatch", ["inputs", "images", "prefix"])
+
+# Bounds on the image area process_vision_info resizes within when the message sets none
+# (qwen-vl-utils 0.0.12 replaced MIN_PIXELS/MAX_PIXELS with token counts of 28x28 pixels)
+if hasattr(vision_process, "MIN_PIXELS"):
+    VISION_MIN_PIXELS, VISION_MAX_PIXELS = vision_process.MIN_PIXELS, vision_process.MAX_PIXELS
+else:
+    VISION_MIN_PIXELS = vision_process.IMAGE_MIN_TOKEN_NUM * 28 * 28
+    VISION_MAX_PIXELS = vision_process.IMAGE_MAX_TOKEN_NUM * 28 * 28
+
+
+class TokenTrie:
+    """Prefix tree over the token ids of a fixed set of labels.
+
+    Node 0 is the root; every other node stores the token leading to it, its
+    parent and depth. Labels sharing leading tokens share the same nodes.
+    """
+    def __init__(self, sequences):
+        self.token = [None]
+        self.parent = [-1]
+        self.depth = [0]
+        self.children = [{}]
+        self.label_node = []
+        for sequence in sequences:
+            node = 0
+            for token in sequence:
+                if token not in self.children[node]:
+                    self.token.append(token)
+                    self.parent.append(node)
+                    self.depth.append(self.depth[node] + 1)
+                    self.children.append({})
+                    self.children[node][token] = len(self.token) - 1
+                node = self.children[node][token]
+            self.label_node.append(node)
+
+    def __len__(self):
+        return len(self.token)
+
+    def subtree(self, node):
+        """Nodes below node (excluding it) in depth-first order"""
+        nodes = []
+        stack = list(reversed(self.children[node].values()))
+        while stack:
+            child = stack.pop()
+            nodes.append(child)
+            stack.extend(reversed(self.children[child].values()))
+        return nodes
+
+
+class StopCriteria(StoppingCriteria):
+    """Per-sequence stopping on stop strings and per-row token budgets.
+
+    A row stops as soon as its generated text contains one of its stop strings
+    or it has generated budgets[row] tokens; the other rows of the batch keep
+    going. stop_strings holds one list of strings per row (or None) and
+    stopped_at maps each row ended by a stop string to the number of tokens
+    it had generated at that point.
+    """
+    def __init__(self, tokenizer, prompt_length, stop_strings, budgets=None):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.stop_strings = [list(stops or []) for stops in stop_strings]
+        # every token decodes to at least one character, so this many trailing
+        # tokens always cover a stop string that was just completed
+        self.window = max((len(stop) for stops in self.stop_strings for stop in stops), default=0) + 1
+        self.budgets = budgets
+        self.stopped_at = {}
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids[:, self.prompt_length:]
+        num_generated = generated.shape[1]
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if self.budgets is not None:
+            done |= torch.tensor(self.budgets, device=input_ids.device) <= num_generated
+        if any(self.stop_strings):
+            tails = self.tokenizer.batch_decode(generated[:, -self.window:], skip_special_tokens=True)
+            for row, text in enumerate(tails):
+                # num_return_sequences rows share the stop strings of their prompt
+                stops = self.stop_strings[row * len(self.stop_strings) // len(tails)]
+                if any(stop in text for stop in stops):
+                    done[row] = True
+                    self.stopped_at.setdefault(row, num_generated)
+        return done
+
+
+class SharedPrefixLayer(DynamicLayer):
+    """Cache layer whose prompt part is a single row shared read-only by the whole batch.
+
+    Only the tokens decoded after the prompt are stored per row. The prompt
+    keys and values are broadcast to the batch inside update(), so the
+    expanded copy only lives while its own layer runs attention.
+    """
+    def __init__(self, keys, values):
+        super().__init__()
+        self.prefix_keys = keys
+        self.prefix_values = values
+
+    def update(self, key_states, value_states, cache_kwargs=None):
+        keys, values = super().update(key_states, value_states, cache_kwargs)
+        batch_size = keys.shape[0]
+        return (
+            torch.cat([self.prefix_keys.expand(batch_size, -1, -1, -1), keys], dim=-2),
+            torch.cat([self.prefix_values.expand(batch_size, -1, -1, -1), values], dim=-2),
+        )
+
+    def get_seq_length(self):
+        return self.prefix_keys.shape[-2] + super().get_seq_length()
+
+    def batch_select_indices(self, indices):
+        if self.is_initialized:
+            self.keys = self.keys[indices]
+            self.values = self.values[indices]
+
+
+def _lookup_draft(tokens, num_tokens, max_ngram):
+    """Tokens that followed the most recent earlier occurrence of the last n-gram of tokens"""
+    if num_tokens <= 0:
+        return []
+    ids = torch.tensor(tokens)
+    for n in range(min(max_ngram, len(tokens) - 1), 0, -1):
+        # every window except the trailing n-gram itself
+        windows = ids.unfold(0, n, 1)[:-1]
+        matches = (windows == ids[-n:]).all(dim=1).nonzero()
+        if len(matches):
+            start = int(matches[-1]) + n
+            return tokens[start:start + num_tokens]
+    return []
+
+
+def _greedy_token(processors, token_ids, logits):
+    """Greedy choice for one row: argmax of its logits after processors, given its tokens so far (prompt included)"""
+    if not processors:
+        return int(logits.argmax())
+    scores = processors(torch.tensor([token_ids], device=logits.device), logits[None].float())
+    return int(scores[0].argmax())
+
+
+def _round_seed(seed, round_index):
+    """Seed of one round of predict_multiple_rounds; round 0 uses seed itself.
+
+    Hashed rather than offset, since CPU generators only keep 32 bits of a seed.
+    """
+    if seed is None or round_index == 0:
+        return seed
+    return int(hashlib.sha256(f"{seed}/{round_index}".encode()).hexdigest()[:8], 16)
+
+
+def _select_rows(prepared, rows):
+    """PreparedBatch with only the given rows, dropping the padding no remaining row needs"""
+    inputs = prepared.inputs
+    index = torch.tensor(rows)
+    attention_mask = inputs.attention_mask[index]
+    start = int(attention_mask.any(0).nonzero()[0])
+    patch_offsets = [0] + inputs.image_grid_thw.prod(-1).cumsum(0).tolist()
+    selected = copy.copy(inputs)
+    selected["input_ids"] = inputs.input_ids[index, start:]
+    selected["attention_mask"] = attention_mask[:, start:]
+    selected["pixel_values"] = torch.cat([inputs.pixel_values[patch_offsets[i]:patch_offsets[i + 1]] for i in rows])
+    selected["image_grid_thw"] = inputs.image_grid_thw[index]
+    return PreparedBatch(selected, [prepared.images[i] for i in rows], prepared.prefix)
+
+
+def _concat_rows(prepared_batches, pad_token_id):
+    """One PreparedBatch of the rows of several with the same prefix, left-padded to the longest"""
+    length = max(prepared.inputs.input_ids.shape[1] for prepared in prepared_batches)
+    inputs = copy.copy(prepared_batches[0].inputs)
+    inputs["input_ids"] = torch.cat([
+        F.pad(prepared.inputs.input_ids, (length - prepared.inputs.input_ids.shape[1], 0), value=pad_token_id)
+        for prepared in prepared_batches
+    ])
+    inputs["attention_mask"] = torch.cat([
+        F.pad(prepared.inputs.attention_mask, (length - prepared.inputs.attention_mask.shape[1], 0))
+        for prepared in prepared_batches
+    ])
+    inputs["pixel_values"] = torch.cat([prepared.inputs.pixel_values for prepared in prepared_batches])
+    inputs["image_grid_thw"] = torch.cat([prepared.inputs.image_grid_thw for prepared in prepared_batches])
+    images = [image for prepared in prepared_batches for image in prepared.images]
+    return PreparedBatch(inputs, images, prepared_batches[0].prefix)
+
+
+# shared by every stage when no profiler is set
+_NOT_PROFILED = contextlib.nullcontext()
+
+# prompts whose token ids (and prompts seen once) are kept by QwenVLModel._compiled_prompt
+_MAX_COMPILED_PROMPTS = 4096
+
+# Prompts of embed_images/embed_texts: the hidden state of the last prompt token,
+# asked for a one-word summary, embeds images and texts in a shared space
+IMAGE_EMBED_PROMPT = "Summarize the above image in one word:"
+TEXT_EMBED_PROMPT = "{}\nSummarize the above sentence in one word:"
+
+
+class _FirstTokenTimer(StoppingCriteria):
+    """Never stops generation, tells the profiler when the prefill ended (the first token is out)"""
+    def __init__(self, profiler, begin):
+        self.profiler = profiler
+        self.begin = begin
+        self.first_token = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_token is None:
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            self.first_token = time.perf_counter()
+            self.profiler.add_seconds("prefill", self.first_token - self.begin)
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+    def finish(self):
+        """Account the time since the first token as decoding"""
+        if self.first_token is not None:
+            self.profiler.add_seconds("decode", time.perf_counter() - self.first_token)
+
+
+def is_out_of_memory(error):
+    """Whether an exception is a failed allocation (CUDA, or the CPU allocator)"""
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    # DefaultCPUAllocator: "not enough memory" or "can't allocate memory"
+    return isinstance(error, RuntimeError) and any(
+        message in str(error) for message in ("out of memory", "not enough memory", "can't allocate memory")
+    )
+
 
 class QwenVLModel:
-    def __init__(self, model_name="Qwen/Qwen2.5-VL-3B-Instruct"):
-        self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-            model_name, torch_dtype="auto", device_map="auto"
-        )
-        self.processor = AutoProcessor.from_pretrained(model_name)
-    
-    def predict(self, image, prompt):
-        messages = [
+    def __init__(self, model_name="Qwen/Qwen2.5-VL-3B-Instruct", max_new_tokens=64, model=None, processor=None,
+                 vision_cache=None, min_pixels=None, max_pixels=None, image_tokens=None, device=None, dtype="auto",
+                 quantize=None, num_threads=None, result_store=None, profiler=None):
+        # model/processor can be passed in directly (e.g. a tiny randomly initialized
+        # Qwen2.5-VL for CPU tests) instead of being loaded from model_name.
+        # vision_cache is an optional VisionFeatureCache reused across prompts and runs.
+        # min_pixels/max_pixels/image_tokens set the visual token budget, see set_image_budget.
+        # device is "auto" (spread over the visible GPUs), "cuda", "cuda:N" or "cpu", and
+        # defaults to "cpu" when no GPU is visible. On CPU, dtype defaults to bfloat16,
+        # quantize="int8" replaces the linear layers by dynamically quantized int8 ones
+        # (on float32 weights) and num_threads defaults to the cores this process may use.
+        # result_store is an optional ResultStore memoizing generations across runs.
+        # profiler is an optional Profiler recording the time spent in each stage of every call.
+        if device is None:
+            device = "auto" if torch.cuda.is_available() else "cpu"
+        if quantize not in (None, "int8"):
+            raise ValueError(f"Unsupported quantization {quantize!r}, only 'int8' is available")
+        if quantize is not None and device != "cpu":
+            raise ValueError("Dynamic int8 quantization only runs on CPU, use device='cpu'")
+        if device == "cpu":
+            if num_threads is None:
+                num_threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+            torch.set_num_threads(num_threads)
+            if dtype == "auto":
+                dtype = torch.float32 if quantize else torch.bfloat16
+        if isinstance(dtype, str) and dtype != "auto":
+            dtype = getattr(torch, dtype)
+        if model is None:
+            model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+                model_name, torch_dtype=dtype, device_map=device
+            )
+        if quantize == "int8":
+            model = torch.ao.quantization.quantize_dynamic(model.float(), {torch.nn.Linear}, dtype=torch.qint8)
+        if processor is None:
+            processor = AutoProcessor.from_pretrained(model_name)
+        self.model_name = model_name
+        self.model = model
+        self.processor = processor
+        self.vision_cache = vision_cache
+        self.result_store = result_store
+        self.profiler = profiler
+        self.quantize = quantize
+        self.max_new_tokens = max_new_tokens
+        self.min_pixels = None
+        self.max_pixels = None
+        if min_pixels is not None or max_pixels is not None or image_tokens is not None:
+            self.set_image_budget(min_pixels, max_pixels, image_tokens)
+        # Decoder-only generation needs left padding so that every row of a batch
+        # ends at the same position; a single prompt is not affected.
+        self.processor.tokenizer.padding_side = "left"
+        # per-thread copies of the processor for prepare_batch in worker threads
+        self._thread_local = threading.local()
+        # prefix text -> (prefix input_ids, past_key_values), see predict_batch(prefix=...)
+        self._prefix_caches = {}
+        # tuple of label strings -> TokenTrie, see _label_trie
+        self._label_tries = {}
+        # (prompt, prefix) -> token ids around the image pad tokens, and the
+        # (prompt, prefix) seen once, not compiled yet; see _compiled_prompt
+        self._compiled_prompts = {}
+        self._seen_prompts = {}
+        self._compiled_prompts_lock = threading.Lock()
+        self.reset_generation_stats()
+
+    def reset_generation_stats(self):
+        """Counters of generated tokens, tokens saved by early stopping and visual tokens"""
+        self.generation_stats = {
+            "sequences": 0,
+            "generated_tokens": 0,
+            "stopped_early": 0,
+            # budget minus tokens generated of every row ended by a stop string: an upper bound, as the
+            # model might have emitted its end token before the budget anyway
+            "tokens_saved": 0,
+            "images": 0,
+            "image_tokens": 0,
+            # prompt tokens (visual ones included) the model was given, see predict_rounds_prepared
+            "prompt_tokens": 0,
+            "seconds": 0.0,
+            # prompt-lookup decoding, see _prompt_lookup_decode
+            "decode_steps": 0,
+            "draft_tokens": 0,
+            "accepted_tokens": 0,
+            # batches split in two after running out of memory, see _generate_rows
+            "oom_splits": 0,
+        }
+
+    def throughput(self):
+        """Images and generated tokens per second since the last reset_generation_stats"""
+        seconds = self.generation_stats["seconds"]
+        return {
+            "images_per_second": self.generation_stats["images"] / seconds if seconds else 0.0,
+            "tokens_per_second": self.generation_stats["generated_tokens"] / seconds if seconds else 0.0,
+        }
+
+    def set_image_budget(self, min_pixels=None, max_pixels=None, image_tokens=None):
+        """Bound the number of visual tokens per image.
+
+        Images are resized (keeping their aspect ratio) so that their area lies
+        in [min_pixels, max_pixels]; every 28x28 pixel block becomes one visual
+        token after the 2x2 patch merge. image_tokens instead resizes every image
+        to about that many tokens. None keeps the processor's own bound.
+        """
+        if image_tokens is not None:
+            if min_pixels is not None or max_pixels is not None:
+                raise ValueError("Pass either image_tokens or min_pixels/max_pixels")
+            min_pixels = max_pixels = image_tokens * self.pixels_per_token()
+        image_processor = self.processor.image_processor
+        if min_pixels is None:
+            min_pixels = image_processor.size["shortest_edge"]
+        if max_pixels is None:
+            max_pixels = image_processor.size["longest_edge"]
+        if min_pixels > max_pixels:
+            raise ValueError(f"min_pixels={min_pixels} is larger than max_pixels={max_pixels}")
+        # the processor resizes again after process_vision_info, so both get the bounds
+        image_processor.min_pixels = min_pixels
+        image_processor.max_pixels = max_pixels
+        image_processor.size = {"shortest_edge": min_pixels, "longest_edge": max_pixels}
+        self.min_pixels = min_pixels
+        self.max_pixels = max_pixels
+        # worker threads copy the processor again with the new bounds
+        self._thread_local = threading.local()
+
+    def pixels_per_token(self):
+        """Image area covered by one visual token"""
+        image_processor = self.processor.image_processor
+        return (image_processor.patch_size * image_processor.merge_size) ** 2
+
+    def image_grid_thw(self, width, height):
+        """The (t, h, w) patch grid prepare_batch gives an image of this size, without decoding it"""
+        image_processor = self.processor.image_processor
+        # process_vision_info resizes to multiples of 28 first (its own default bounds unless
+        # set_image_budget was called), then the processor resizes again within its bounds
+        height, width = vision_process.smart_resize(
+            height, width, 28,
+            VISION_MIN_PIXELS if self.min_pixels is None else self.min_pixels,
+            VISION_MAX_PIXELS if self.max_pixels is None else self.max_pixels,
+        )
+        height, width = smart_resize(
+            height, width, image_processor.patch_size * image_processor.merge_size,
+            image_processor.size["shortest_edge"], image_processor.size["longest_edge"],
+        )
+        return 1, height // image_processor.patch_size, width // image_processor.patch_size
+
+    def image_token_count(self, width, height):
+        """Visual tokens of an image of this size after the patch merge"""
+        t, h, w = self.image_grid_thw(width, height)
+        return t * h * w // self.processor.image_processor.merge_size ** 2
+
+    def _build_messages(self, image, prompt, prefix=None):
+        content = [{"type": "image", "image": image}]
+        if self.min_pixels is not None:
+            content[0]["min_pixels"] = self.min_pixels
+            content[0]["max_pixels"] = self.max_pixels
+        if prefix is not None:
+            content.insert(0, {"type": "text", "text": prefix})
+        if prompt or prefix is None:
+            content.append({"type": "text", "text": prompt})
+        return [
             {
                 "role": "user",
-                "content": [
-                    {"type": "image", "image": image},
-                    {"type": "text", "text": prompt},
-                ],
+                "content": content,
             }
         ]
-        
+
+    def _profile_call(self, kind):
+        """Profiler record of one call (see profiler.Profiler.call), a no-op without profiler"""
+        if self.profiler is None:
+            return _NOT_PROFILED
+        return self.profiler.call(kind)
+
+    def _stage(self, name, synchronize=False):
+        if self.profiler is None:
+            return _NOT_PROFILED
+        return self.profiler.stage(name, synchronize)
+
+    def _count_tokens(self, name, tokens):
+        if self.profiler is not None:
+            self.profiler.count(name, tokens)
+
+    def _thread_processor(self):
+        """The processor to use on the calling thread.
+
+        HF fast tokenizers fail ("Already borrowed") when one instance is used
+        from several threads at once, so other threads get their own copy.
+        """
+        if threading.current_thread() is threading.main_thread():
+            return self.processor
+        if not hasattr(self._thread_local, "processor"):
+            self._thread_local.processor = copy.deepcopy(self.processor)
+        return self._thread_local.processor
+
+    def prepare_batch(self, images, prompts, prefix=None):
+        """CPU side of a generate call: template, resize, preprocess and tokenize.
+
+        prompts is a single prompt or one prompt per image. Only the processor
+        is used, so this can run in worker threads (see pipeline.PipelinedRunner)
+        while the model works on another batch. Returns a PreparedBatch for
+        predict_prepared or predict_multiple_prepared.
+        """
+        images = list(images)
+        if isinstance(prompts, str):
+            prompts = [prompts] * len(images)
+        else:
+            prompts = list(prompts)
+        if len(prompts) != len(images):
+            raise ValueError(f"Got {len(images)} images but {len(prompts)} prompts")
+        with self._profile_call("prepare"):
+            processor = self._thread_processor()
+            image_inputs = []
+            for image, prompt in zip(images, prompts):
+                with self._stage("vision_info"):
+                    sample_images, _ = process_vision_info(self._build_messages(image, prompt, prefix=prefix))
+                image_inputs.extend(sample_images)
+            counts = Counter(prompts)
+            compiled = [self._compiled_prompt(processor, prompt, prefix, repeated=counts[prompt] > 1)
+                        for prompt in prompts]
+            if all(token_ids is not None for token_ids in compiled):
+                inputs = self._splice_image_tokens(processor, compiled, image_inputs)
+            else:
+                texts = []
+                for image, prompt in zip(images, prompts):
+                    with self._stage("chat_template"):
+                        texts.append(processor.apply_chat_template(
+                            self._build_messages(image, prompt, prefix=prefix), tokenize=False,
+                            add_generation_prompt=True
+                        ))
+                with self._stage("processor"):
+                    inputs = processor(
+                        text=texts,
+                        images=image_inputs,
+                        videos=None,
+                        padding=True,
+                        return_tensors="pt",
+                    )
+            if self.model.device.type == "cuda":
+                # page-locked memory lets the copy to the GPU run asynchronously
+                with self._stage("pin_memory"):
+                    for key, value in inputs.items():
+                        inputs[key] = value.pin_memory()
+            return PreparedBatch(inputs, image_inputs, prefix)
+
+    def _compiled_prompt(self, processor, prompt, prefix=None, repeated=False):
+        """Token ids of the templated prompt before and after its image pad tokens.
+
+        The chat template and the tokenizer give the same ids around the image
+        for every sample of a prompt, only the number of pad tokens depends on
+        the image, so they are computed once per (prompt, prefix). Compiling
+        costs more than templating a single sample, so a prompt is compiled
+        only once it is used again (repeated: it is used by other samples of
+        the same batch); prompts made for one sample, like those listing its
+        candidate classes, never are. None for a prompt not compiled or whose
+        ids do not split cleanly at the image (then prepare_batch templates and
+        tokenizes every sample as before). Safe to call from several threads.
+        """
+        key = (prompt, prefix)
+        with self._compiled_prompts_lock:
+            if key in self._compiled_prompts:
+                return self._compiled_prompts[key]
+            if not repeated and key not in self._seen_prompts:
+                self._seen_prompts[key] = None
+                if len(self._seen_prompts) > _MAX_COMPILED_PROMPTS:
+                    self._seen_prompts.pop(next(iter(self._seen_prompts)))
+                return None
+            self._seen_prompts.pop(key, None)
+        tokenizer = processor.tokenizer
+        text = processor.apply_chat_template(
+            self._build_messages(None, prompt, prefix=prefix), tokenize=False, add_generation_prompt=True
+        )
+        compiled = None
+        if text.count(processor.image_token) == 1:
+            before, after = text.split(processor.image_token)
+            before_ids = tokenizer(before, add_special_tokens=False).input_ids
+            after_ids = tokenizer(after, add_special_tokens=False).input_ids
+            # the processor tokenizes the whole text, special tokens included
+            if tokenizer(text).input_ids == before_ids + [processor.image_token_id] + after_ids:
+                compiled = (before_ids, after_ids)
+        with self._compiled_prompts_lock:
+            if key not in self._compiled_prompts and len(self._compiled_prompts) >= _MAX_COMPILED_PROMPTS:
+                self._compiled_prompts.pop(next(iter(self._compiled_prompts)))
+            self._compiled_prompts[key] = compiled
+        return compiled
+
+    def _splice_image_tokens(self, processor, compiled, image_inputs):
+        """The processor outputs for compiled prompts: only the images go through the processor"""
+        with self._stage("image_processor"):
+            image_features = processor.image_processor(images=image_inputs, return_tensors="pt")
+        with self._stage("splice_tokens"):
+            merge_length = processor.image_processor.merge_size ** 2
+            rows = [
+                before_ids + [processor.image_token_id] * (int(grid_thw.prod()) // merge_length) + after_ids
+                for (before_ids, after_ids), grid_thw in zip(compiled, image_features["image_grid_thw"])
+            ]
+            length = max(len(row) for row in rows)
+            pad_token_id = processor.tokenizer.pad_token_id
+            input_ids = torch.full((len(rows), length), pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(rows), length), dtype=torch.long)
+            left = processor.tokenizer.padding_side == "left"
+            for i, row in enumerate(rows):
+                columns = slice(length - len(row), None) if left else slice(len(row))
+                input_ids[i, columns] = torch.tensor(row)
+                attention_mask[i, columns] = 1
+        return BatchFeature(data={"input_ids": input_ids, "attention_mask": attention_mask, **image_features})
+
+    def _prepare_inputs(self, images, prompts, prefix=None, return_images=False):
+        """Template, preprocess and tokenize a list of (image, prompt) pairs into one padded batch on the model device.
+
+        With return_images the resized images fed to the processor are returned too.
+        """
+        prepared = self.prepare_batch(images, prompts, prefix=prefix)
+        inputs = prepared.inputs.to(self.model.device, non_blocking=True)
+        if return_images:
+            return inputs, prepared.images
+        return inputs
+
+    def _decode(self, inputs, generated_ids):
+        # With left padding every prompt ends at the same column
+        generated_ids_trimmed = generated_ids[:, inputs.input_ids.shape[1]:]
+        return self.processor.batch_decode(
+            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
+
+    def _chat_prefix(self, prefix):
+        """Templated text of a conversation up to the image placeholder"""
         text = self.processor.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
-        )
-        image_inputs, video_inputs = process_vision_info(messages)
-        inputs = self.processor(
-            text=[text],
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
-        )
-        inputs = inputs.to("cuda")
-        
-        generated_ids = self.model.generate(**inputs, max_new_tokens=64)
-        generated_ids_trimmed = [
-            out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
+            self._build_messages(None, "", prefix=prefix), tokenize=False, add_generation_prompt=True
+        )
+        return text[:text.index("<|vision_start|>")]
+
+    @torch.no_grad()
+    def _get_prefix_cache(self, prefix):
+        """Prefill the static text in front of the image once and keep its KV cache"""
+        if prefix not in self._prefix_caches:
+            prefix_ids = self.processor.tokenizer(
+                self._chat_prefix(prefix), return_tensors="pt"
+            ).input_ids.to(self.model.device)
+            outputs = self.model(input_ids=prefix_ids, use_cache=True)
+            self._prefix_caches[prefix] = (prefix_ids[0], outputs.past_key_values)
+        return self._prefix_caches[prefix]
+
+    def clear_prefix_cache(self):
+        self._prefix_caches = {}
+
+    def _vision_cache_key(self, image):
+        """Content hash of a (resized) image together with the model and resolution settings"""
+        image_processor = self.processor.image_processor
+        settings = (
+            self.model_name,
+            getattr(image_processor, "min_pixels", None),
+            getattr(image_processor, "max_pixels", None),
+            image_processor.patch_size,
+            image_processor.merge_size,
+        )
+        digest = hashlib.sha256(repr(settings).encode())
+        digest.update(f"{image.mode}{image.size}".encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    @torch.no_grad()
+    def _image_features(self, image_inputs, inputs):
+        """Merged visual embeddings of a batch.
+
+        Identical images in the batch are encoded once, and with a vision cache
+        the vision tower only runs on cache misses.
+        """
+        grid_thw = inputs.image_grid_thw
+        patch_offsets = [0] + grid_thw.prod(-1).cumsum(0).tolist()
+        keys = [self._vision_cache_key(image) for image in image_inputs]
+        features = {}
+        missing = []
+        for i, key in enumerate(keys):
+            if key in features or any(keys[j] == key for j in missing):
+                continue
+            cached = None
+            if self.vision_cache is not None:
+                cached = self.vision_cache.get(key, grid_thw[i])
+            if cached is None:
+                missing.append(i)
+            else:
+                features[key] = cached
+        if missing:
+            pixel_values = torch.cat([
+                inputs.pixel_values[patch_offsets[i]:patch_offsets[i + 1]] for i in missing
+            ])
+            image_embeds = self.model.model.get_image_features(pixel_values, grid_thw[missing])
+            for i, embeds in zip(missing, image_embeds):
+                features[keys[i]] = embeds
+                if self.vision_cache is not None:
+                    self.vision_cache.put(keys[i], embeds, grid_thw[i])
+        return torch.cat([features[key].to(self.model.device, self.model.dtype) for key in keys])
+
+    def _relayout_for_prefix(self, inputs, prefix):
+        """Move the left padding of a batch behind the cached prefix.
+
+        The processor left-pads the batch, so each row is re-laid out as
+        [prefix][padding][image + suffix]: the prefix then sits at the same
+        positions in every row and its cache can simply be repeated over the
+        batch.
+        """
+        prefix_ids, prefix_cache = self._get_prefix_cache(prefix)
+        num_prefix = len(prefix_ids)
+        input_ids = inputs.input_ids.clone()
+        attention_mask = inputs.attention_mask.clone()
+        for row in range(input_ids.shape[0]):
+            tokens = inputs.input_ids[row][inputs.attention_mask[row].bool()]
+            if not torch.equal(tokens[:num_prefix], prefix_ids):
+                raise ValueError("Prompt does not start with the cached prefix tokens")
+            num_pad = input_ids.shape[1] - len(tokens)
+            input_ids[row, :num_prefix] = prefix_ids
+            input_ids[row, num_prefix:num_prefix + num_pad] = self.processor.tokenizer.pad_token_id
+            input_ids[row, num_prefix + num_pad:] = tokens[num_prefix:]
+            attention_mask[row] = 1
+            attention_mask[row, num_prefix:num_prefix + num_pad] = 0
+        cache = copy.deepcopy(prefix_cache)
+        cache.batch_repeat_interleave(input_ids.shape[0])
+        return input_ids, attention_mask, num_prefix, cache
+
+    @torch.no_grad()
+    def _prefill(self, inputs, prefix=None, image_embeds=None, prefill_last=False):
+        """Prefill a batch by hand instead of inside generate().
+
+        With prefix the rows start from the cached prefix KV (see
+        _relayout_for_prefix); with image_embeds the precomputed visual
+        embeddings are scattered into the image placeholders instead of running
+        the vision tower. Everything up to the last prompt token is prefilled,
+        so the returned inputs and cache can be handed straight to generate().
+        With prefill_last the last token is prefilled as well and the model
+        outputs (with its logits) are returned alongside.
+        """
+        input_ids, attention_mask = inputs.input_ids, inputs.attention_mask
+        start, cache = 0, None
+        if prefix is not None:
+            input_ids, attention_mask, start, cache = self._relayout_for_prefix(inputs, prefix)
+        position_ids, rope_deltas = self.model.model.get_rope_index(
+            input_ids, inputs.image_grid_thw, attention_mask=attention_mask
+        )
+        end = input_ids.shape[1] if prefill_last else input_ids.shape[1] - 1
+        segment = input_ids[:, start:end]
+        if image_embeds is not None:
+            inputs_embeds = self.model.get_input_embeddings()(segment)
+            image_mask = (segment == self.model.config.image_token_id).unsqueeze(-1).expand_as(inputs_embeds)
+            model_inputs = {"inputs_embeds": inputs_embeds.masked_scatter(image_mask, image_embeds)}
+        else:
+            model_inputs = {
+                "input_ids": segment,
+                "pixel_values": inputs.pixel_values,
+                "image_grid_thw": inputs.image_grid_thw,
+            }
+        outputs = self.model(
+            **model_inputs,
+            attention_mask=attention_mask[:, :end],
+            position_ids=position_ids[:, :, start:end],
+            past_key_values=cache,
+            cache_position=torch.arange(start, end, device=input_ids.device),
+            use_cache=True,
+            logits_to_keep=1,
+        )
+        # generate() only runs the last prompt token and derives decode positions
+        # from rope_deltas when the cache is not empty
+        self.model.model.rope_deltas = rope_deltas
+        generate_inputs = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "past_key_values": outputs.past_key_values,
+        }
+        if prefill_last:
+            return generate_inputs, position_ids, outputs
+        return generate_inputs
+
+    def _eos_ids(self):
+        """Token ids that end a generation"""
+        eos = self.model.generation_config.eos_token_id
+        eos_ids = set(eos if isinstance(eos, list) else [eos] if eos is not None else [])
+        eos_ids.add(self.processor.tokenizer.convert_tokens_to_ids("<|im_end|>"))
+        return eos_ids
+
+    @torch.no_grad()
+    def _prompt_lookup_decode(self, inputs, prefix, image_embeds, budget, stop_strings, num_draft_tokens,
+                              max_ngram=3):
+        """Greedy decoding of a single row with drafts looked up in its own prompt.
+
+        The last max_ngram (down to 1) tokens are searched for in the prompt and
+        the text generated so far, and the tokens that followed the most recent
+        match form the draft. The current token and the draft go through the
+        model in one forward pass, and the draft is kept up to the first token
+        greedy decoding would not have produced. The verified logits go through
+        the generation_config processors (repetition_penalty, ...) like in
+        generate(), so the output is that of greedy generate(), but answers
+        copied from the prompt (e.g. a name from prompt_class_list) take a few
+        forward passes instead of one per token.
+
+        Returns the generated token ids (ending with the end token if reached).
+        """
+        _, position_ids, outputs = self._prefill(inputs, prefix=prefix, image_embeds=image_embeds, prefill_last=True)
+        cache = outputs.past_key_values
+        processors = self._logits_processors(inputs.input_ids)
+        tokens = inputs.input_ids[0].tolist()
+        num_prompt = len(tokens)
+        length = num_prompt
+        position = int(position_ids[0, 0, -1]) + 1
+        eos_ids = self._eos_ids()
+        stops = list(stop_strings or [])
+        window = max((len(stop) for stop in stops), default=0) + 1
+        tokenizer = self.processor.tokenizer
+        stats = self.generation_stats
+
+        def finished():
+            generated = tokens[num_prompt:]
+            if generated[-1] in eos_ids or len(generated) >= budget:
+                return True
+            if stops and any(stop in tokenizer.decode(generated[-window:], skip_special_tokens=True) for stop in stops):
+                stats["stopped_early"] += 1
+                stats["tokens_saved"] += budget - len(generated)
+                return True
+            return False
+
+        tokens.append(_greedy_token(processors, tokens, outputs.logits[0, -1]))
+        done = finished()
+        while not done:
+            draft = _lookup_draft(tokens, min(num_draft_tokens, budget - (len(tokens) - num_prompt)), max_ngram)
+            step_ids = torch.tensor([tokens[-1:] + draft], device=self.model.device)
+            num_step = step_ids.shape[1]
+            step_positions = position + torch.arange(num_step, device=self.model.device)
+            logits = self.model(
+                input_ids=step_ids,
+                position_ids=step_positions.view(1, 1, -1).expand(3, 1, -1),
+                past_key_values=cache,
+                cache_position=torch.arange(length, length + num_step, device=self.model.device),
+                use_cache=True,
+            ).logits[0]
+            # the greedy token after the current one and each accepted draft token
+            next_token = _greedy_token(processors, tokens, logits[0])
+            accepted = 0
+            while accepted < len(draft) and draft[accepted] == next_token:
+                accepted += 1
+                next_token = _greedy_token(processors, tokens + draft[:accepted], logits[accepted])
+            # the cache keeps the current token and the accepted draft tokens
+            cache.crop(length + 1 + accepted)
+            length += 1 + accepted
+            position += 1 + accepted
+            stats["decode_steps"] += 1
+            stats["draft_tokens"] += len(draft)
+            stats["accepted_tokens"] += accepted
+            for token in draft[:accepted] + [next_token]:
+                tokens.append(token)
+                done = finished()
+                if done:
+                    break
+        generated = tokens[num_prompt:]
+        stats["sequences"] += 1
+        stats["generated_tokens"] += len(generated)
+        return generated
+
+    def _logits_processors(self, prompt_ids, **generate_kwargs):
+        """The logits processors generate(**generate_kwargs) applies after prompt_ids.
+
+        They come from the model's generation_config (e.g. the
+        repetition_penalty of the Qwen2.5-VL Instruct checkpoints) updated with
+        generate_kwargs, and include the sampling warpers when do_sample is set.
+        """
+        generation_config = copy.deepcopy(self.model.generation_config)
+        generation_config.update(**generate_kwargs)
+        self.model._prepare_special_tokens(generation_config, device=prompt_ids.device)
+        return self.model._get_logits_processor(
+            generation_config=generation_config, input_ids_seq_length=prompt_ids.shape[-1],
+            encoder_input_ids=prompt_ids, device=prompt_ids.device, model_kwargs={},
+        )
+
+    def _trie_constraint(self, trie, prompt_length):
+        """prefix_allowed_tokens_fn for generate() that keeps every row inside trie"""
+        end_id = self.processor.tokenizer.convert_tokens_to_ids("<|im_end|>")
+
+        def allowed_tokens(batch_id, input_ids):
+            node = 0
+            for token in input_ids[prompt_length:].tolist():
+                node = trie.children[node].get(token)
+                if node is None:
+                    break
+            if node is None or not trie.children[node]:
+                # finished rows only ever produce padding
+                return [end_id]
+            return list(trie.children[node])
+
+        return allowed_tokens
+
+    def _stop_criteria(self, inputs, stop_strings, budgets):
+        """StopCriteria for a batch, or None when there is nothing to enforce"""
+        if not any(stop_strings) and budgets is None:
+            return None
+        return StopCriteria(self.processor.tokenizer, inputs.input_ids.shape[1], stop_strings, budgets)
+
+    def _record_images(self, inputs, seconds):
+        """Count the images of a processed batch and the time spent on it"""
+        self.generation_stats["images"] += inputs.image_grid_thw.shape[0]
+        self.generation_stats["prompt_tokens"] += int(inputs.attention_mask.sum())
+        self.generation_stats["image_tokens"] += int(inputs.image_grid_thw.prod(-1).sum()) // (
+            self.processor.image_processor.merge_size ** 2
+        )
+        self.generation_stats["seconds"] += seconds
+
+    def _record_generation(self, inputs, generated_ids, criteria, budgets, seconds):
+        """Update generation_stats after a generate call"""
+        self._record_images(inputs, seconds)
+        generated = generated_ids[:, inputs.input_ids.shape[1]:]
+        self.generation_stats["sequences"] += generated.shape[0]
+        num_generated = int((generated != self.processor.tokenizer.pad_token_id).sum())
+        self.generation_stats["generated_tokens"] += num_generated
+        self._count_tokens("generated", num_generated)
+        if criteria is not None:
+            for row, num_generated in criteria.stopped_at.items():
+                self.generation_stats["stopped_early"] += 1
+                self.generation_stats["tokens_saved"] += budgets[row] - num_generated
+
+    def predict(self, image, prompt, max_new_tokens=None, prefix=None, labels=None, stop_strings=None,
+                prompt_lookup_tokens=None):
+        return self.predict_batch(
+            [image], [prompt], batch_size=1, max_new_tokens=max_new_tokens, prefix=prefix, labels=labels,
+            stop_strings=stop_strings, prompt_lookup_tokens=prompt_lookup_tokens
+        )[0]
+
+    def predict_batch(self, images, prompts, batch_size=8, max_new_tokens=None, prefix=None, labels=None,
+                      dedupe_images=False, stop_strings=None, prompt_lookup_tokens=None):
+        """Run generation on a list of images, batch_size samples per generate call.
+
+        prompts is either a single prompt shared by all images or a list with one
+        prompt per image. Outputs are returned in the same order as images.
+
+        If prefix is given it is placed before the image in the user turn and its
+        KV cache is computed once and reused for every sample, so only the image
+        and prompt tokens are prefilled per call. Use prompt="" to put the whole
+        static prompt in the prefix.
+
+        If labels is given (e.g. CUB200Dataset.class_names_dict values,
+        Caltech101.categories or Flowers102.classes) decoding is constrained to a
+        token trie of the labels: only continuations of some label are allowed
+        and generation ends with the name, so every output is one of labels.
+
+        With dedupe_images, identical images within a batch (e.g. one image asked
+        several prompts) go through the vision tower only once. This is always
+        the case when a vision cache is set.
+
+        max_new_tokens can also be a list with one token budget per prompt, and
+        each sequence stops on its own as soon as its text contains one of
+        stop_strings (e.g. ["</answer>"], or one such list per prompt). The
+        output keeps the stop string.
+
+        With prompt_lookup_tokens, samples are decoded one at a time with
+        prompt-lookup speculative decoding (see _prompt_lookup_decode), drafting
+        up to that many tokens per step. The outputs are those of greedy
+        decoding, and acceptance counts go to generation_stats.
+        """
+        images = list(images)
+        if isinstance(prompts, str):
+            prompts = [prompts] * len(images)
+        else:
+            prompts = list(prompts)
+        if len(prompts) != len(images):
+            raise ValueError(f"Got {len(images)} images but {len(prompts)} prompts")
+        budgets, stop_strings, trie = self._generation_plan(len(images), max_new_tokens, labels, stop_strings)
+        if prompt_lookup_tokens:
+            batch_size = 1
+
+        outputs = []
+        for start in range(0, len(images), batch_size):
+            begin = time.perf_counter()
+            with self._profile_call("generate"):
+                prepared = self.prepare_batch(
+                    images[start:start + batch_size], prompts[start:start + batch_size], prefix=prefix
+                )
+                outputs.extend(self._generate_prepared(
+                    prepared, budgets[start:start + batch_size], stop_strings[start:start + batch_size], trie,
+                    dedupe_images, begin, prompt_lookup_tokens
+                ))
+        return outputs
+
+    def predict_prepared(self, prepared, max_new_tokens=None, labels=None, dedupe_images=False, stop_strings=None,
+                         prompt_lookup_tokens=None):
+        """predict_batch on one batch already built by prepare_batch (e.g. in a worker thread)"""
+        budgets, stop_strings, trie = self._generation_plan(
+            len(prepared.images), max_new_tokens, labels, stop_strings
+        )
+        with self._profile_call("generate"):
+            return self._generate_prepared(
+                prepared, budgets, stop_strings, trie, dedupe_images, time.perf_counter(), prompt_lookup_tokens
+            )
+
+    def _generation_plan(self, num_prompts, max_new_tokens, labels, stop_strings):
+        """Per-prompt token budgets and stop strings, and the label trie if decoding is constrained"""
+        if max_new_tokens is None:
+            max_new_tokens = self.max_new_tokens
+        if isinstance(max_new_tokens, int):
+            budgets = [max_new_tokens] * num_prompts
+        else:
+            budgets = list(max_new_tokens)
+        if not stop_strings or isinstance(stop_strings[0], str):
+            stop_strings = [stop_strings] * num_prompts
+        trie = None
+        if labels is not None:
+            trie = self._label_trie(labels)
+            budgets = [min(budget, max(trie.depth)) for budget in budgets]
+        return budgets, stop_strings, trie
+
+    def _generate_prepared(self, prepared, budgets, stop_strings, trie, dedupe_images, begin,
+                           prompt_lookup_tokens=None):
+        """Generate for one prepared batch; begin is when work on the batch started.
+
+        With a result store, rows generated before with the same image, prompt,
+        budget, stop strings and labels are not generated again. Prompt-lookup
+        decoding gives the greedy output, so it shares their results.
+        """
+        if self.result_store is None:
+            return self._generate_rows(
+                prepared, budgets, stop_strings, trie, dedupe_images, begin, prompt_lookup_tokens
+            )
+        labels = None if trie is None else hashlib.sha256(repr((trie.token, trie.parent)).encode()).hexdigest()
+        keys = [
+            self._result_key(prepared, row, budget=budget, stop_strings=stops, labels=labels)
+            for row, (budget, stops) in enumerate(zip(budgets, stop_strings))
         ]
-        output_text = self.processor.batch_decode(
-            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        outputs = [self.result_store.get(key, "greedy") for key in keys]
+        missing = [row for row, output in enumerate(outputs) if output is None]
+        if missing:
+            if len(missing) < len(outputs):
+                prepared = _select_rows(prepared, missing)
+            generated = self._generate_rows(
+                prepared, [budgets[row] for row in missing], [stop_strings[row] for row in missing], trie,
+                dedupe_images, begin, prompt_lookup_tokens
+            )
+            for row, output in zip(missing, generated):
+                outputs[row] = output
+                self.result_store.put(keys[row], output, "greedy")
+        return outputs
+
+    def _result_key(self, prepared, row, **params):
+        """Content hash of one request: image, prompt tokens, generation parameters and model"""
+        inputs = prepared.inputs
+        settings = (self.model_name, str(self.model.dtype), self.quantize, sorted(params.items()),
+                    self.model.generation_config.to_json_string(use_diff=True))
+        digest = hashlib.sha256(repr(settings).encode())
+        digest.update(self._vision_cache_key(prepared.images[row]).encode())
+        digest.update(inputs.input_ids[row][inputs.attention_mask[row].bool()].numpy().tobytes())
+        return digest.hexdigest()
+
+    def _generate_rows(self, prepared, budgets, stop_strings, trie, dedupe_images, begin, prompt_lookup_tokens):
+        """_generate_batch, halving the batch and retrying whenever it runs out of memory"""
+        num_rows = len(prepared.images)
+        try:
+            return self._generate_batch(
+                prepared, budgets, stop_strings, trie, dedupe_images, begin, prompt_lookup_tokens
+            )
+        except RuntimeError as error:
+            if not is_out_of_memory(error) or num_rows == 1:
+                raise
+        # outside the except block, so the failed attempt's tensors can be freed
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        self.generation_stats["oom_splits"] += 1
+        outputs = []
+        for rows in (range(num_rows // 2), range(num_rows // 2, num_rows)):
+            outputs.extend(self._generate_rows(
+                _select_rows(prepared, list(rows)), [budgets[row] for row in rows],
+                [stop_strings[row] for row in rows], trie, dedupe_images, time.perf_counter(), prompt_lookup_tokens
+            ))
+        return outputs
+
+    @torch.no_grad()
+    def _generate_batch(self, prepared, budgets, stop_strings, trie, dedupe_images, begin, prompt_lookup_tokens):
+        with self._stage("to_device", synchronize=True):
+            inputs = prepared.inputs.to(self.model.device, non_blocking=True)
+        self._count_input_tokens(inputs)
+        image_embeds = None
+        if self.vision_cache is not None or dedupe_images:
+            with self._stage("vision_encoder", synchronize=True):
+                image_embeds = self._image_features(prepared.images, inputs)
+        if prompt_lookup_tokens:
+            if len(prepared.images) != 1 or trie is not None:
+                raise ValueError("Prompt-lookup decoding runs one unconstrained sample at a time")
+            with self._stage("prompt_lookup_decode", synchronize=True):
+                generated = self._prompt_lookup_decode(
+                    inputs, prepared.prefix, image_embeds, budgets[0], stop_strings[0], prompt_lookup_tokens
+                )
+            self._record_images(inputs, time.perf_counter() - begin)
+            self._count_tokens("generated", len(generated))
+            with self._stage("batch_decode"):
+                return [self.processor.tokenizer.decode(
+                    generated, skip_special_tokens=True, clean_up_tokenization_spaces=False
+                )]
+        if prepared.prefix is not None or image_embeds is not None:
+            with self._stage("prefill", synchronize=True):
+                generate_inputs = self._prefill(inputs, prefix=prepared.prefix, image_embeds=image_embeds)
+        else:
+            generate_inputs = inputs
+        generate_kwargs = {}
+        if trie is not None:
+            generate_kwargs["prefix_allowed_tokens_fn"] = self._trie_constraint(trie, inputs.input_ids.shape[1])
+        criteria = self._stop_criteria(inputs, stop_strings, budgets if len(set(budgets)) > 1 else None)
+        stopping = [] if criteria is None else [criteria]
+        timer = None
+        if self.profiler is not None:
+            # splits generate into the prefill (up to the first token) and the decoding after it
+            timer = _FirstTokenTimer(self.profiler, time.perf_counter())
+            stopping.append(timer)
+        if stopping:
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList(stopping)
+        generated_ids = self.model.generate(**generate_inputs, max_new_tokens=max(budgets), **generate_kwargs)
+        if timer is not None:
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            timer.finish()
+        self._record_generation(inputs, generated_ids, criteria, budgets, time.perf_counter() - begin)
+        with self._stage("batch_decode"):
+            return self._decode(inputs, generated_ids)
+
+    def _count_input_tokens(self, inputs):
+        """Visual and prompt (text) token counts of a batch for the profiler"""
+        if self.profiler is None:
+            return
+        visual = int(inputs.image_grid_thw.prod(-1).sum()) // self.processor.image_processor.merge_size ** 2
+        self.profiler.count("visual", visual)
+        self.profiler.count("prompt", int(inputs.attention_mask.sum()) - visual)
+
+    def _turn_ids(self, prompt):
+        """Token ids closing an assistant answer and asking prompt in a new user turn"""
+        # the template around a placeholder answer, whatever the first turn was
+        conversation = [
+            {"role": "user", "content": [{"type": "text", "text": ""}]},
+            {"role": "assistant", "content": "\x00"},
+            {"role": "user", "content": [{"type": "text", "text": prompt}]},
+        ]
+        text = self.processor.apply_chat_template(conversation, tokenize=False, add_generation_prompt=True)
+        return self.processor.tokenizer(text[text.index("\x00") + 1:], add_special_tokens=False).input_ids
+
+    def predict_rounds(self, image, prompt, labels=None, next_round=None, max_new_tokens=None):
+        return self.predict_rounds_prepared(
+            self.prepare_batch([image], prompt), labels=labels, next_round=next_round, max_new_tokens=max_new_tokens
         )
-        
-        return output_text[0]
+
+    @torch.no_grad()
+    def predict_rounds_prepared(self, prepared, labels=None, next_round=None, max_new_tokens=None):
+        """Answer a conversation of several user turns about one prepared image.
+
+        The prepared prompt is answered first (constrained to labels if
+        given). next_round(answers) then returns the (prompt, labels) of the
+        next user turn, or None to end the conversation. Each turn keeps the
+        KV cache of the conversation so far and only prefills its own new
+        tokens, so the image is encoded and prefilled once.
+
+        Returns the answers of every turn. Their prompt and generated tokens
+        add up in generation_stats.
+        """
+        if len(prepared.images) != 1 or prepared.prefix is not None:
+            raise ValueError("predict_rounds_prepared runs one image at a time, without prefix")
+        begin = time.perf_counter()
+        end_id = self.processor.tokenizer.convert_tokens_to_ids("<|im_end|>")
+        with self._profile_call("rounds"):
+            with self._stage("to_device", synchronize=True):
+                inputs = prepared.inputs.to(self.model.device, non_blocking=True)
+            self._count_input_tokens(inputs)
+            image_embeds = None
+            if self.vision_cache is not None:
+                with self._stage("vision_encoder", synchronize=True):
+                    image_embeds = self._image_features(prepared.images, inputs)
+            with self._stage("prefill", synchronize=True):
+                generate_inputs = self._prefill(inputs, image_embeds=image_embeds)
+            answers = []
+            while True:
+                budgets, _, trie = self._generation_plan(1, max_new_tokens, labels, None)
+                generate_kwargs = {}
+                if trie is not None:
+                    generate_kwargs["prefix_allowed_tokens_fn"] = self._trie_constraint(
+                        trie, generate_inputs["input_ids"].shape[1]
+                    )
+                with self._stage("decode", synchronize=True):
+                    outputs = self.model.generate(
+                        **generate_inputs, max_new_tokens=budgets[0], return_dict_in_generate=True,
+                        **generate_kwargs
+                    )
+                generated = outputs.sequences[0, generate_inputs["input_ids"].shape[1]:]
+                self.generation_stats["sequences"] += 1
+                self.generation_stats["generated_tokens"] += generated.numel()
+                self._count_tokens("generated", generated.numel())
+                answers.append(self.processor.tokenizer.decode(
+                    generated, skip_special_tokens=True, clean_up_tokenization_spaces=False
+                ))
+                turn = next_round(answers) if next_round is not None else None
+                if turn is None:
+                    break
+                prompt, labels = turn
+                turn_ids = self._turn_ids(prompt)
+                if generated.numel() and generated[-1].item() == end_id and turn_ids[:1] == [end_id]:
+                    # the answer already ended its turn
+                    turn_ids = turn_ids[1:]
+                self.generation_stats["prompt_tokens"] += len(turn_ids)
+                self._count_tokens("prompt", len(turn_ids))
+                input_ids = torch.cat([
+                    outputs.sequences, torch.tensor([turn_ids], device=outputs.sequences.device)
+                ], dim=1)
+                # the cache holds everything but the last generated token, generate() prefills the rest
+                generate_inputs = {
+                    "input_ids": input_ids,
+                    "attention_mask": torch.ones_like(input_ids),
+                    "past_key_values": outputs.past_key_values,
+                }
+        self._record_images(inputs, time.perf_counter() - begin)
+        return answers
+
+    def predict_multiple(
+        self,
+        image,
+        prompt,
+        do_sample=True,
+        top_k=50,
+        top_p=0.9,
+        temperature=1.3,
+        num_return_sequences=10,
+        max_new_tokens=256,
+        stop_strings=None,
+        max_sample_memory=None,
+        seed=None
+    ):
+        """Sample num_return_sequences answers for one image.
+
+        The image and prompt are prefilled once and their KV cache is shared
+        read-only by all samples (see SharedPrefixLayer), so only the decoded
+        tokens are stored per sample. With max_sample_memory (in bytes) the
+        samples are decoded in chunks whose decode state fits in it, see
+        sample_row_bytes.
+
+        With seed the samples are drawn from their own generator, so the same
+        seed gives the same answers, and a result store can return them
+        without decoding. Without seed the global torch RNG is used and
+        sampled answers are never memoized.
+        """
+        begin = time.perf_counter()
+        return self._sample_prepared(
+            self.prepare_batch([image], [prompt]), begin, do_sample=do_sample, top_k=top_k, top_p=top_p,
+            temperature=temperature, num_return_sequences=num_return_sequences, max_new_tokens=max_new_tokens,
+            stop_strings=stop_strings, max_sample_memory=max_sample_memory, seed=seed
+        )
+
+    def predict_multiple_prepared(
+        self,
+        prepared,
+        do_sample=True,
+        top_k=50,
+        top_p=0.9,
+        temperature=1.3,
+        num_return_sequences=10,
+        max_new_tokens=256,
+        stop_strings=None,
+        max_sample_memory=None,
+        seed=None
+    ):
+        """predict_multiple on a single image already built by prepare_batch"""
+        return self._sample_prepared(
+            prepared, time.perf_counter(), do_sample=do_sample, top_k=top_k, top_p=top_p, temperature=temperature,
+            num_return_sequences=num_return_sequences, max_new_tokens=max_new_tokens, stop_strings=stop_strings,
+            max_sample_memory=max_sample_memory, seed=seed
+        )
+
+    def sample_row_bytes(self, prompt_length, max_new_tokens):
+        """Upper bound on the memory one sample needs while decoding.
+
+        That is its own keys and values for max_new_tokens tokens, the prompt
+        keys and values of one layer expanded for it during attention, and its
+        float32 logits.
+        """
+        config = getattr(self.model.config, "text_config", self.model.config)
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        token_bytes = 2 * config.num_key_value_heads * head_dim * torch.finfo(self.model.dtype).bits // 8
+        return (
+            token_bytes * config.num_hidden_layers * max_new_tokens
+            + token_bytes * (prompt_length + max_new_tokens)
+            + 4 * config.vocab_size
+        )
+
+    def predict_multiple_rounds(
+        self,
+        prepared,
+        round_size=10,
+        do_sample=True,
+        top_k=50,
+        top_p=0.9,
+        temperature=1.3,
+        max_new_tokens=256,
+        stop_strings=None,
+        max_sample_memory=None,
+        seed=None
+    ):
+        """Sample answers for a single prepared image in rounds of round_size.
+
+        Returns a generator that yields the texts of one more round each time
+        it is advanced, so the caller decides when it has drawn enough. The
+        prompt is prefilled once for all rounds, as in predict_multiple. With
+        seed every round has a seed of its own (derived from seed and the
+        round number) and is memoized on its own.
+        """
+        return self._sample_rounds(
+            prepared, time.perf_counter(), round_size, do_sample=do_sample, top_k=top_k, top_p=top_p,
+            temperature=temperature, max_new_tokens=max_new_tokens, stop_strings=stop_strings,
+            max_sample_memory=max_sample_memory, seed=seed
+        )
+
+    def _sample_prepared(self, prepared, begin, do_sample, top_k, top_p, temperature, num_return_sequences,
+                         max_new_tokens, stop_strings, max_sample_memory=None, seed=None):
+        rounds = self._sample_rounds(
+            prepared, begin, num_return_sequences, do_sample=do_sample, top_k=top_k, top_p=top_p,
+            temperature=temperature, max_new_tokens=max_new_tokens, stop_strings=stop_strings,
+            max_sample_memory=max_sample_memory, seed=seed
+        )
+        texts = next(rounds)
+        rounds.close()
+        return texts
+
+    @torch.no_grad()
+    def _sample_rounds(self, prepared, begin, round_size, do_sample, top_k, top_p, temperature, max_new_tokens,
+                       stop_strings, max_sample_memory, seed=None):
+        """Prefill one image, then yield round_size decoded samples per iteration.
+
+        The prefill only happens once a round is not found in the result store.
+        """
+        if len(prepared.images) != 1:
+            raise ValueError(f"predict_multiple samples from exactly one image, got {len(prepared.images)}")
+        prompt_length = prepared.inputs.input_ids.shape[1]
+        chunk_size = round_size
+        if max_sample_memory is not None:
+            row_bytes = self.sample_row_bytes(prompt_length, max_new_tokens)
+            chunk_size = max(1, min(chunk_size, max_sample_memory // row_bytes))
+        # the processors and warpers of generate(do_sample=..., top_k=..., ...) on the model's generation_config
+        sampling = {"do_sample": do_sample}
+        if do_sample:
+            sampling.update(top_k=top_k, top_p=top_p, temperature=temperature)
+        processors = self._logits_processors(prepared.inputs.input_ids, **sampling)
+        memoize = self.result_store is not None and (seed is not None or not do_sample)
+        kind = "sampled" if do_sample else "greedy"
+        prefill = None
+
+        for round_index in itertools.count():
+            round_seed = _round_seed(seed, round_index)
+            key = None
+            if memoize:
+                # the chunk size decides how the random draws are spread over the samples
+                key = self._result_key(
+                    prepared, 0, do_sample=do_sample, top_k=top_k, top_p=top_p, temperature=temperature,
+                    num_samples=round_size, chunk_size=chunk_size, budget=max_new_tokens, stop_strings=stop_strings,
+                    seed=round_seed if do_sample else None,
+                )
+            # one profiler record per round, closed before the round is handed out
+            with self._profile_call("sample"):
+                texts = self.result_store.get(key, kind) if key is not None else None
+                if texts is None:
+                    if prefill is None:
+                        with self._stage("prefill", synchronize=True):
+                            prefill = self._prefill_sampling(prepared)
+                    inputs, position_ids, outputs = prefill
+                    generator = None
+                    if do_sample and round_seed is not None:
+                        generator = torch.Generator(outputs.logits.device).manual_seed(round_seed)
+                    generated = []
+                    with self._stage("decode", synchronize=True):
+                        for start in range(0, round_size, chunk_size):
+                            generated.extend(self._sample_shared_prefix(
+                                outputs.past_key_values, outputs.logits[:, -1], inputs.input_ids,
+                                int(position_ids[0, 0, -1]) + 1, min(chunk_size, round_size - start), processors,
+                                do_sample, max_new_tokens, stop_strings, generator
+                            ))
+                    self._count_tokens("generated", sum(len(tokens) for tokens in generated))
+                    with self._stage("batch_decode"):
+                        texts = self.processor.batch_decode(
+                            generated, skip_special_tokens=True, clean_up_tokenization_spaces=False
+                        )
+                    if key is not None:
+                        self.result_store.put(key, texts, kind)
+                    # time spent by the caller between rounds is not ours
+                    self.generation_stats["seconds"] += time.perf_counter() - begin
+            yield texts
+            begin = time.perf_counter()
+
+    def _prefill_sampling(self, prepared):
+        inputs = prepared.inputs.to(self.model.device, non_blocking=True)
+        self._count_input_tokens(inputs)
+        image_embeds = None
+        if self.vision_cache is not None:
+            image_embeds = self._image_features(prepared.images, inputs)
+        _, position_ids, outputs = self._prefill(
+            inputs, prefix=prepared.prefix, image_embeds=image_embeds, prefill_last=True
+        )
+        self._record_images(inputs, 0.0)
+        return inputs, position_ids, outputs
+
+    def _sample_shared_prefix(self, prompt_cache, logits, prompt_ids, position, num_rows, processors, do_sample,
+                              budget, stop_strings, generator=None):
+        """Decode num_rows samples on top of a single-row prompt cache.
+
+        logits are those of the last of prompt_ids and position the rope
+        position of the first generated token. Finished rows are dropped from
+        the batch right away. Returns the generated token ids of every row
+        (ending with the end token if reached). The logits go through
+        processors (see _logits_processors), then the next token is sampled,
+        or the argmax without do_sample. generator is the RNG of the sampled
+        tokens (default: the global one).
+        """
+        prompt_length = prompt_ids.shape[1]
+        cache = Cache(layers=[SharedPrefixLayer(layer.keys, layer.values) for layer in prompt_cache.layers])
+        eos_ids = self._eos_ids()
+        stops = list(stop_strings or [])
+        window = max((len(stop) for stop in stops), default=0) + 1
+        tokenizer = self.processor.tokenizer
+        stats = self.generation_stats
+
+        def finished(generated):
+            if generated[-1] in eos_ids or len(generated) >= budget:
+                return True
+            if stops and any(stop in tokenizer.decode(generated[-window:], skip_special_tokens=True) for stop in stops):
+                stats["stopped_early"] += 1
+                stats["tokens_saved"] += budget - len(generated)
+                return True
+            return False
+
+        tokens = [[] for _ in range(num_rows)]
+        rows = list(range(num_rows))
+        logits = logits.expand(num_rows, -1)
+        # prompt and generated tokens of the remaining rows, as the processors see them
+        sequence_ids = prompt_ids.expand(num_rows, -1)
+        step = 0
+        while True:
+            scores = processors(sequence_ids, logits.float())
+            if do_sample:
+                next_tokens = torch.multinomial(
+                    torch.softmax(scores, dim=-1), num_samples=1, generator=generator
+                )[:, 0]
+            else:
+                next_tokens = scores.argmax(-1)
+            keep = []
+            for i, (row, token) in enumerate(zip(rows, next_tokens.tolist())):
+                tokens[row].append(token)
+                if not finished(tokens[row]):
+                    keep.append(i)
+            if not keep:
+                break
+            if len(keep) < len(rows):
+                index = torch.tensor(keep, device=next_tokens.device)
+                cache.batch_select_indices(index)
+                next_tokens = next_tokens[index]
+                sequence_ids = sequence_ids[index]
+                rows = [rows[i] for i in keep]
+            sequence_ids = torch.cat([sequence_ids, next_tokens[:, None]], dim=1)
+            logits = self.model(
+                input_ids=next_tokens[:, None],
+                position_ids=torch.full((3, len(rows), 1), position + step, device=next_tokens.device),
+                past_key_values=cache,
+                cache_position=torch.tensor([prompt_length + step], device=next_tokens.device),
+                use_cache=True,
+            ).logits[:, -1]
+            step += 1
+            stats["decode_steps"] += 1
+        stats["sequences"] += num_rows
+        stats["generated_tokens"] += sum(len(generated) for generated in tokens)
+        return tokens
+
+    def _label_trie(self, labels):
+        """Token trie of the labels as complete assistant answers (followed by <|im_end|>)"""
+        key = tuple(labels)
+        if key not in self._label_tries:
+            tokenizer = self.processor.tokenizer
+            end_id = tokenizer.convert_tokens_to_ids("<|im_end|>")
+            self._label_tries[key] = TokenTrie([
+                tokenizer(label, add_special_tokens=False).input_ids + [end_id] for label in labels
+            ])
+        return self._label_tries[key]
+
+    @torch.no_grad()
+    def score_classes(self, image, prompt, class_names, length_normalize=False, max_tree_tokens=1024):
+        """Rank class_names by their log-likelihood as the answer to prompt.
+
+        The image and prompt are prefilled once. The candidate names are merged
+        into a token trie and all trie nodes are then scored in a single forward
+        pass over the prompt cache, using a tree attention mask so each node only
+        sees the prompt and its own ancestors. Nodes are processed in chunks of
+        at most max_tree_tokens whole subtrees.
+
+        Returns a list of (class_name, log_likelihood) sorted from most to least
+        likely. With length_normalize the log-likelihood is divided by the
+        number of answer tokens.
+        """
+        begin = time.perf_counter()
+        trie = self._label_trie(class_names)
+        inputs, image_inputs = self._prepare_inputs([image], [prompt], return_images=True)
+        image_embeds = None
+        if self.vision_cache is not None:
+            image_embeds = self._image_features(image_inputs, inputs)
+        _, position_ids, outputs = self._prefill(inputs, image_embeds=image_embeds, prefill_last=True)
+        cache = outputs.past_key_values
+        prompt_length = inputs.input_ids.shape[1]
+        last_position = position_ids[0, 0, -1]
+
+        # log-probability of each node given its parent; children of the root
+        # are scored with the logits of the last prompt token
+        node_logprob = torch.zeros(len(trie), device=self.model.device)
+        root_logprobs = torch.log_softmax(outputs.logits[0, -1].float(), dim=-1)
+        for token, child in trie.children[0].items():
+            node_logprob[child] = root_logprobs[token]
+
+        # group whole subtrees of the root into chunks; leaves never need a
+        # forward pass of their own
+        chunks = [[]]
+        for child in trie.children[0].values():
+            nodes = [node for node in [child] + trie.subtree(child) if trie.children[node]]
+            if chunks[-1] and len(chunks[-1]) + len(nodes) > max_tree_tokens:
+                chunks.append([])
+            chunks[-1].extend(nodes)
+
+        dtype = self.model.dtype
+        for nodes in chunks:
+            if not nodes:
+                continue
+            index = {node: i for i, node in enumerate(nodes)}
+            num_nodes = len(nodes)
+            allowed = torch.zeros(num_nodes, prompt_length + num_nodes, dtype=torch.bool)
+            allowed[:, :prompt_length] = True
+            for i, node in enumerate(nodes):
+                while node > 0:
+                    allowed[i, prompt_length + index[node]] = True
+                    node = trie.parent[node]
+            attention_mask = torch.full(allowed.shape, torch.finfo(dtype).min, dtype=dtype)
+            attention_mask = attention_mask.masked_fill(allowed, 0.0)[None, None].to(self.model.device)
+            node_positions = last_position + torch.tensor(
+                [trie.depth[node] for node in nodes], device=self.model.device
+            )
+            hidden = self.model.model(
+                input_ids=torch.tensor([[trie.token[node] for node in nodes]], device=self.model.device),
+                attention_mask=attention_mask,
+                position_ids=node_positions.view(1, 1, -1).expand(3, 1, -1),
+                past_key_values=cache,
+                cache_position=torch.arange(prompt_length, prompt_length + num_nodes, device=self.model.device),
+                use_cache=True,
+            ).last_hidden_state[0]
+            cache.crop(prompt_length)
+            # project to the vocabulary a few rows at a time, keeping only the
+            # log-probabilities of each node's children
+            for start in range(0, num_nodes, 64):
+                logprobs = torch.log_softmax(self.model.lm_head(hidden[start:start + 64]).float(), dim=-1)
+                for i, node in enumerate(nodes[start:start + 64]):
+                    for token, child in trie.children[node].items():
+                        node_logprob[child] = logprobs[i, token]
+
+        # accumulate along the paths; parents always come before their children
+        path_logprob = node_logprob.tolist()
+        for node in range(1, len(trie)):
+            path_logprob[node] += path_logprob[trie.parent[node]]
+        scores = []
+        for name, node in zip(class_names, trie.label_node):
+            score = path_logprob[node]
+            if length_normalize:
+                score /= trie.depth[node]
+            scores.append((name, score))
+        self._record_images(inputs, time.perf_counter() - begin)
+        return sorted(scores, key=lambda item: item[1], reverse=True)
+
+    @torch.no_grad()
+    def _last_token_states(self, inputs, image_embeds=None):
+        """Final hidden state of the last prompt token of every row (rows are left padded)"""
+        position_ids, _ = self.model.model.get_rope_index(
+            inputs.input_ids, inputs.get("image_grid_thw"), attention_mask=inputs.attention_mask
+        )
+        if image_embeds is not None:
+            inputs_embeds = self.model.get_input_embeddings()(inputs.input_ids)
+            image_mask = (inputs.input_ids == self.model.config.image_token_id).unsqueeze(-1).expand_as(inputs_embeds)
+            model_inputs = {"inputs_embeds": inputs_embeds.masked_scatter(image_mask, image_embeds)}
+        else:
+            model_inputs = {
+                key: inputs[key] for key in ("input_ids", "pixel_values", "image_grid_thw") if key in inputs
+            }
+        hidden = self.model.model(
+            **model_inputs, attention_mask=inputs.attention_mask, position_ids=position_ids, use_cache=False
+        ).last_hidden_state
+        return torch.nn.functional.normalize(hidden[:, -1].float(), dim=-1).cpu()
+
+    def embed_images(self, images, batch_size=8):
+        """L2-normalized embeddings of images, one row per image, comparable with embed_texts.
+
+        Each image is prefilled with IMAGE_EMBED_PROMPT and embedded by the
+        hidden state of the last prompt token. The vision features go through
+        the vision cache, so a later generate on the same images reuses them.
+        """
+        images = list(images)
+        embeddings = []
+        with self._profile_call("embed"):
+            for start in range(0, len(images), batch_size):
+                inputs, image_inputs = self._prepare_inputs(
+                    images[start:start + batch_size], IMAGE_EMBED_PROMPT, return_images=True
+                )
+                image_embeds = None
+                if self.vision_cache is not None:
+                    image_embeds = self._image_features(image_inputs, inputs)
+                with self._stage("embed", synchronize=True):
+                    embeddings.append(self._last_token_states(inputs, image_embeds))
+        return torch.cat(embeddings)
+
+    def embed_texts(self, texts, batch_size=32):
+        """L2-normalized embeddings of texts (e.g. class names), one row per text, see embed_images"""
+        texts = list(texts)
+        tokenizer = self.processor.tokenizer
+        embeddings = []
+        with self._profile_call("embed"):
+            for start in range(0, len(texts), batch_size):
+                prompts = [
+                    self.processor.apply_chat_template(
+                        [{"role": "user", "content": [{"type": "text", "text": TEXT_EMBED_PROMPT.format(text)}]}],
+                        tokenize=False, add_generation_prompt=True
+                    )
+                    for text in texts[start:start + batch_size]
+                ]
+                inputs = tokenizer(prompts, padding=True, return_tensors="pt").to(self.model.device)
+                with self._stage("embed", synchronize=True):
+                    embeddings.append(self._last_token_states(inputs))
+        return torch.cat(embeddings)
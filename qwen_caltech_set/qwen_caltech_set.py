@@ -1,22 +1,89 @@
 from model import QwenVLModel
+from vision_cache import VisionFeatureCache
+from result_store import ResultStore
+from server import RemoteQwenVLModel
+from profiler import Profiler
+from bucketing import image_sizes, token_counts
+from autobatch import BatchSizeTuner, DEFAULT_CACHE
+from candidates import CandidateFilter, recall_at_k, class_list, DEFAULT_CACHE as CLASS_EMBEDDING_CACHE
+from sharding import shard_range, shard_path, shard_paths
+from sweep import run_sweep, save_outputs, merge_outputs
 import json
 import os
-import re
-import random
-import string
+import sys
+import argparse
 from caltech101 import Caltech101
 
 
 DATASET_PATH = "/home/samuele.angheben/datasets"
 BASE_PATH = "/home/samuele.angheben/vision-reasoning/qwen_caltech_set"
 
-dataset = Caltech101(root=DATASET_PATH, download=True, split='test', transform=None)
-
-print("Loaded dataset with categories:", dataset.categories)
-
-model = QwenVLModel()
-print("Model loaded.")
-
+# k of the recall@k written for --candidates
+RECALL_KS = [1, 5, 10, 20, 50]
+# text embedded for every category name with --candidates
+CLASS_TEMPLATE = "A photo of a {}."
+
+def batch_size_arg(value):
+    return value if value == "auto" else int(value)
+
+parser = argparse.ArgumentParser(description="Open-world prompt sweep of Qwen2.5-VL on the Caltech101 test split")
+parser.add_argument("--batch-size", type=batch_size_arg, default=1,
+                    help="Number of images per generate call, or auto for the largest that fits in memory")
+parser.add_argument("--batch-size-cache", default=DEFAULT_CACHE,
+                    help="JSON file of the batch sizes found by --batch-size auto, per hardware and configuration")
+parser.add_argument("--vision-cache", default=None,
+                    help="Directory of an on-disk cache of vision-tower outputs shared across prompts and runs")
+parser.add_argument("--image-major", action="store_true",
+                    help="Answer all prompts for one image at a time instead of one dataset pass per prompt")
+parser.add_argument("--constrained", action="store_true",
+                    help="Constrain generation to the Caltech101 category names")
+parser.add_argument("--early-stop", action="store_true",
+                    help="Stop short answers at the first newline or period and reasoning answers after </answer>")
+parser.add_argument("--min-pixels", type=int, default=None, help="Lower bound on the resized image area")
+parser.add_argument("--max-pixels", type=int, default=None,
+                    help="Upper bound on the resized image area (one visual token per 28x28 pixels)")
+parser.add_argument("--image-tokens", type=int, default=None,
+                    help="Resize every image to about this many visual tokens (see pixel_sweep.py)")
+parser.add_argument("--candidates", type=int, default=None, metavar="K",
+                    help="Append to every prompt the K categories whose name embeddings are closest to the image's "
+                         "(see candidates.py); recall@k of this pre-filter is saved with the outputs")
+parser.add_argument("--class-embedding-cache", default=CLASS_EMBEDDING_CACHE,
+                    help="Directory of the category-name embeddings computed for --candidates")
+parser.add_argument("--num-workers", type=int, default=0,
+                    help="Threads decoding and preprocessing images ahead of the model (0 runs everything inline)")
+parser.add_argument("--prefetch", type=int, default=8, help="Batches prepared ahead of the model")
+parser.add_argument("--bucketing", action="store_true",
+                    help="Batch images with similar visual token counts together (results keep the dataset order)")
+parser.add_argument("--bucket-window", type=int, default=512,
+                    help="Samples sorted by size together with --bucketing")
+parser.add_argument("--device", default=None,
+                    help="auto, cuda, cuda:N or cpu (default: auto when a GPU is visible, else cpu)")
+parser.add_argument("--dtype", default="auto", help="auto, bfloat16, float16 or float32 (auto is bfloat16 on CPU)")
+parser.add_argument("--quantize", choices=["int8"], default=None,
+                    help="Dynamically quantize the linear layers (CPU only)")
+parser.add_argument("--num-threads", type=int, default=None, help="CPU threads (default: all available cores)")
+parser.add_argument("--result-store", default=None,
+                    help="SQLite file memoizing generations across runs (greedy results, and sampled ones with a seed)")
+parser.add_argument("--profile", action="store_true",
+                    help="Record the time spent in each stage of every model call (templating, preprocessing, "
+                         "prefill, decoding, ...) and save percentiles next to the predictions")
+parser.add_argument("--server", default=None,
+                    help="URL of a running server.py (e.g. http://127.0.0.1:8765) to use instead of loading the "
+                         "model here; the model options are then those of the server")
+parser.add_argument("--num-shards", type=int, default=1,
+                    help="Split the dataset into this many contiguous shards, one per process")
+parser.add_argument("--shard-id", type=int, default=0, help="Shard evaluated by this process (0-based)")
+parser.add_argument("--merge", action="store_true",
+                    help="Combine the outputs of the --num-shards shards instead of evaluating")
+args = parser.parse_args()
+if not 0 <= args.shard_id < args.num_shards:
+    parser.error(f"--shard-id must be in [0, {args.num_shards})")
+if args.server and args.batch_size == "auto":
+    parser.error("--batch-size auto probes the model's memory, it cannot be used with --server")
+if args.server and args.bucketing:
+    parser.error("--bucketing needs the model's image processor, it cannot be used with --server")
+if args.server and args.candidates:
+    parser.error("--candidates needs the model's hidden states, it cannot be used with --server")
 
 prompts = {
     "prompt1": ("Identify the object. Use 1 to 3 words.", False),
@@ -33,28 +100,91 @@ prompts = {
     "prompt11": ("What is that? Use 1 to 3 words.", False),
 }
 
-def normalize_text(text):
-    """Normalize text by replacing punctuation with spaces and converting to lowercase"""
-    # Replace punctuation with spaces, then normalize multiple spaces to single spaces
-    text = re.sub(r'[^a-zA-Z\s]', ' ', text.lower())
-    return ' '.join(text.split())  # Remove extra whitespace
-
-def label_in_prediction(label, prediction):
-    """Check if prediction contains the label words with simple matching logic"""
-    normalized_label = normalize_text(label)
-    normalized_prediction = normalize_text(prediction)
-    
-    # Split into words for better word boundary matching
-    label_words = normalized_label.split()
-    pred_words = normalized_prediction.split()
-    
-    # For single word labels, check if that word exists in prediction
-    if len(label_words) == 1:
-        return label_words[0] in pred_words
-    
-    # For multi-word labels, check if all words exist in prediction
-    return all(word in pred_words for word in label_words)
+os.makedirs(f"{BASE_PATH}/outputs", exist_ok=True)
+recall_file = f"{BASE_PATH}/outputs/candidate_recall.json"
+
+def write_recall(recall_file, recall):
+    """Print and save the recall@k of the candidate categories; recall holds the total and hits per k"""
+    for k, hits in sorted(recall["hits"].items(), key=lambda item: int(item[0])):
+        print(f"Candidate recall@{k}: {hits}/{recall['total']} = {hits / recall['total']:.4f}")
+    with open(recall_file, "w") as f:
+        json.dump(recall, f, indent=2)
+    print(f"Candidate recall saved to: {recall_file}")
+
+if args.merge:
+    if args.num_shards == 1:
+        parser.error("--merge needs the --num-shards of the sharded run")
+    try:
+        merge_outputs(f"{BASE_PATH}/outputs", prompts, args.num_shards)
+    except FileNotFoundError as error:
+        sys.exit(str(error))
+    if os.path.exists(shard_path(recall_file, args.num_shards, 0)):
+        shard_recalls = []
+        for shard_file in shard_paths(recall_file, args.num_shards):
+            with open(shard_file) as f:
+                shard_recalls.append(json.load(f))
+        write_recall(recall_file, {
+            "total": sum(recall["total"] for recall in shard_recalls),
+            "hits": {k: sum(recall["hits"][k] for recall in shard_recalls) for k in shard_recalls[0]["hits"]},
+        })
+    sys.exit()
+
+dataset = Caltech101(root=DATASET_PATH, download=True, split='test', transform=None)
+
+print("Loaded dataset with categories:", dataset.categories)
+
+vision_cache = VisionFeatureCache(args.vision_cache) if args.vision_cache and not args.server else None
+result_store = ResultStore(args.result_store) if args.result_store and not args.server else None
+profiler = Profiler() if args.profile and not args.server else None
+if args.server:
+    model = RemoteQwenVLModel(args.server)
+else:
+    model = QwenVLModel(vision_cache=vision_cache, min_pixels=args.min_pixels, max_pixels=args.max_pixels,
+                        image_tokens=args.image_tokens, device=args.device, dtype=args.dtype,
+                        quantize=args.quantize, num_threads=args.num_threads, result_store=result_store,
+                        profiler=profiler)
+print("Model loaded.")
+
+# Category names as the model would write them, used for constrained decoding and --candidates
+class_names_dict = {i: cat.replace('_', ' ') for i, cat in enumerate(dataset.categories)}
+labels = list(class_names_dict.values()) if args.constrained else None
+
 
+# Top categories of every image by embedding similarity, listed after the prompts with --candidates
+candidates = None
+
+def candidate_prompt(prompt_text, indices):
+    """prompt_text followed by the list of some categories"""
+    return f"{prompt_text} Choose from the following list of categories:\n\n{class_list(class_names_dict, indices)}"
+
+def sample_prompt(prompt_text, idx):
+    """prompt_text for image idx, followed by its candidate categories with --candidates"""
+    return prompt_text if candidates is None else candidate_prompt(prompt_text, candidates[idx])
+
+if args.batch_size == "auto":
+    # worst case: the largest image, the longest prompt and a generation using the whole budget
+    largest_image = max(image_sizes(dataset), key=lambda size: model.image_token_count(*size))
+    longest_prompt = max((prompt_text for prompt_text, _ in prompts.values()), key=len)
+    if args.candidates:
+        longest_names = sorted(class_names_dict, key=lambda i: len(class_names_dict[i]))[-args.candidates:]
+        longest_prompt = candidate_prompt(longest_prompt, longest_names)
+    args.batch_size = BatchSizeTuner(model, cache_path=args.batch_size_cache).batch_size(
+        longest_prompt, image_size=largest_image
+    )
+    print(f"Batch size: {args.batch_size}")
+
+class LabeledImages:
+    """Some samples of dataset as the {"image", "label"} dicts CandidateFilter.rank reads"""
+    def __init__(self, dataset, indices):
+        self.dataset = dataset
+        self.indices = list(indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        image, label = self.dataset[self.indices[i]]
+        return {"image": image, "label": label}
 
 # Initial step: test all prompts on 4 random images and print predictions
 """ print("\n=== Initial prompt testing on 4 random images ===")
@@ -76,72 +206,41 @@ for idx in sample_indices:
             print(f"[{prompt_name}] Prediction: {prediction}") """
 
 
-os.makedirs(f"{BASE_PATH}/outputs", exist_ok=True)
-
-category_outputs_all = {cat: set() for cat in dataset.categories}
-
-for prompt_name, (prompt_text, is_reasoning) in prompts.items():
-    print(f"Processing {prompt_name}: '{prompt_text}' (reasoning={is_reasoning})")
-    output_file = f"{BASE_PATH}/outputs/predictions_{prompt_name}.txt"
-    
-    category_outputs = {cat: set() for cat in dataset.categories}
-    invalid_count = 0  # Track invalid outputs for reasoning prompts
-    correct = 0
-    total = 0
-
-    with open(output_file, "w") as f:
-        for idx, (image, label) in enumerate(dataset):
-            prediction = model.predict(image, prompt_text)
-            if is_reasoning:
-                # Extract content inside <answer>...</answer>
-                match = re.search(r"<answer>(.*?)</answer>", prediction, re.DOTALL)
-                if match:
-                    prediction = match.group(1).strip()
-                else:
-                    prediction = ""
-                    invalid_count += 1
-                    print(f"[{prompt_name}] Invalid reasoning output at example {idx}")
-            ground_truth = dataset.categories[label]
-            # Add prediction to the set for the ground truth category
-            category_outputs[ground_truth].add(prediction)
-            # Add prediction to the global category_outputs_all
-            category_outputs_all[ground_truth].add(prediction)
-
-            # Accuracy calculation
-            total += 1
-            is_correct = label_in_prediction(ground_truth, prediction)
-            if is_correct:
-                correct += 1
-            
-            # Print with correctness indicator
-            status = "✓ CORRECT" if is_correct else "✗ WRONG"
-            print(f"[{prompt_name}] Example {idx}: label={dataset.categories[label]}, prediction={prediction} [{status}]")
-
-
-        # Convert sets to lists for JSON serialization
-        serializable_outputs = {cat: list(outputs) for cat, outputs in category_outputs.items()}
-        accuracy = correct / total if total > 0 else 0.0
-        if is_reasoning:
-            output_data = {
-                "category_outputs": serializable_outputs,
-                "invalid_count": invalid_count,
-                "accuracy": accuracy
-            }
-            json.dump(output_data, f, indent=2)
-        else:
-            output_data = {
-                "category_outputs": serializable_outputs,
-                "accuracy": accuracy
-            }
-            json.dump(output_data, f, indent=2)
-    print(f"Saved predictions to {output_file}")
-
-# After all prompts, save category_outputs_all to a file
-category_outputs_all_serializable = {cat: list(outputs) for cat, outputs in category_outputs_all.items()}
-all_output_file = f"{BASE_PATH}/outputs/category_outputs_all.json"
-with open(all_output_file, "w") as f:
-    json.dump(category_outputs_all_serializable, f, indent=2)
-print(f"Saved all category outputs to {all_output_file}")
-
-
-
+# This process evaluates one contiguous slice of the dataset
+shard = shard_range(len(dataset), args.num_shards, args.shard_id)
+if args.num_shards > 1:
+    print(f"Shard {args.shard_id} of {args.num_shards}: samples {shard.start} to {shard.stop - 1}")
+
+if args.candidates:
+    candidate_filter = CandidateFilter(model, class_names_dict, cache_dir=args.class_embedding_cache,
+                                       template=CLASS_TEMPLATE)
+    rankings, ranked_labels = candidate_filter.rank(LabeledImages(dataset, shard), batch_size=args.batch_size)
+    candidates = {idx: ranking[:args.candidates] for idx, ranking in zip(shard, rankings)}
+    write_recall(shard_path(recall_file, args.num_shards, args.shard_id), {
+        "total": len(ranked_labels),
+        "hits": recall_at_k(rankings, ranked_labels, sorted(
+            {k for k in RECALL_KS + [args.candidates] if k <= len(class_names_dict)}
+        )),
+    })
+
+states = run_sweep(
+    model, dataset, dataset.categories, prompts, shard, batch_size=args.batch_size, image_major=args.image_major,
+    labels=labels, early_stop=args.early_stop, sample_prompt=sample_prompt, num_workers=args.num_workers,
+    prefetch=args.prefetch, bucket_window=args.bucket_window,
+    # visual tokens per image, read from the image headers
+    image_token_counts=token_counts(model, dataset) if args.bucketing and args.batch_size > 1 else None,
+)
+save_outputs(f"{BASE_PATH}/outputs", prompts, states, args.num_shards, args.shard_id)
+if args.num_shards > 1:
+    print(f"Combine the shards with: --merge --num-shards {args.num_shards}")
+if profiler is not None:
+    profile_file = shard_path(f"{BASE_PATH}/outputs/profile.json", args.num_shards, args.shard_id)
+    profiler.save(profile_file)
+    print(f"Saved profile to {profile_file}")
+print(f"Generation stats: {model.generation_stats}")
+print(f"Throughput: {model.throughput()}")
+
+if vision_cache is not None:
+    print(f"Vision feature cache: {vision_cache.stats()}")
+if result_store is not None:
+    print(f"Result store: {result_store.stats()}")
@@ -0,0 +1,231 @@
+# Prompt sweep loop of qwen_caltech_set.py, importable without loading Caltech101
+from pipeline import PipelinedRunner
+from bucketing import bucket_batches, padding_report, in_index_order
+from sharding import shard_path, shard_paths
+import json
+import os
+import re
+
+
+def index_batches(indices, batch_size):
+    """Lists of up to batch_size consecutive sample indices"""
+    indices = list(indices)
+    return [indices[start:start + batch_size] for start in range(0, len(indices), batch_size)]
+
+def normalize_text(text):
+    """Normalize text by replacing punctuation with spaces and converting to lowercase"""
+    # Replace punctuation with spaces, then normalize multiple spaces to single spaces
+    text = re.sub(r'[^a-zA-Z\s]', ' ', text.lower())
+    return ' '.join(text.split())  # Remove extra whitespace
+
+def label_in_prediction(label, prediction):
+    """Check if prediction contains the label words with simple matching logic"""
+    normalized_label = normalize_text(label)
+    normalized_prediction = normalize_text(prediction)
+
+    # Split into words for better word boundary matching
+    label_words = normalized_label.split()
+    pred_words = normalized_prediction.split()
+
+    # For single word labels, check if that word exists in prediction
+    if len(label_words) == 1:
+        return label_words[0] in pred_words
+
+    # For multi-word labels, check if all words exist in prediction
+    return all(word in pred_words for word in label_words)
+
+def new_prompt_state(categories):
+    """Accumulators of one prompt over the dataset"""
+    return {
+        "category_outputs": {cat: set() for cat in categories},
+        "invalid_count": 0,  # Track invalid outputs for reasoning prompts
+        "correct": 0,
+        "total": 0,
+    }
+
+def record_prediction(prompt_name, is_reasoning, state, idx, ground_truth, prediction):
+    """Add one prediction of prompt_name for an image of category ground_truth to its accumulators"""
+    if is_reasoning:
+        # Extract content inside <answer>...</answer>
+        match = re.search(r"<answer>(.*?)</answer>", prediction, re.DOTALL)
+        if match:
+            prediction = match.group(1).strip()
+        else:
+            prediction = ""
+            state["invalid_count"] += 1
+            print(f"[{prompt_name}] Invalid reasoning output at example {idx}")
+    # Add prediction to the set for the ground truth category
+    state["category_outputs"][ground_truth].add(prediction)
+
+    # Accuracy calculation
+    state["total"] += 1
+    is_correct = label_in_prediction(ground_truth, prediction)
+    if is_correct:
+        state["correct"] += 1
+
+    # Print with correctness indicator
+    status = "✓ CORRECT" if is_correct else "✗ WRONG"
+    print(f"[{prompt_name}] Example {idx}: label={ground_truth}, prediction={prediction} [{status}]")
+
+def run_sweep(model, dataset, categories, prompts, indices, batch_size=1, image_major=False, labels=None,
+              early_stop=False, sample_prompt=None, num_workers=0, prefetch=8, image_token_counts=None,
+              bucket_window=512):
+    """Answer every prompt of prompts (name -> (text, is_reasoning)) for the samples indices of dataset.
+
+    dataset yields (image, label) with label an index into categories. By
+    default every prompt runs over the samples in batches of batch_size
+    (grouped by visual token count within windows of bucket_window samples
+    with image_token_counts, the counts of every sample of dataset); with
+    image_major all prompts are answered for one image at a time, so the
+    vision tower runs once per image. labels constrains generation to those
+    names; with early_stop short answers stop at the first newline or period
+    and reasoning ones after </answer>. sample_prompt(text, idx) gives the
+    prompt of sample idx (default: the text itself). Images are decoded and
+    preprocessed by num_workers threads, up to prefetch batches ahead.
+
+    Returns the accumulators of every prompt by name (see new_prompt_state).
+    """
+    if sample_prompt is None:
+        def sample_prompt(prompt_text, idx):
+            return prompt_text
+
+    def stopping_for(is_reasoning):
+        """Stop strings and token budget of a prompt type, (None, None) without early_stop"""
+        if not early_stop:
+            return None, None
+        if is_reasoning:
+            return ["</answer>"], model.max_new_tokens
+        # 1-3 word answers, nothing after the first line or sentence is used
+        return ["\n", "."], 16
+
+    indices = list(indices)
+    states = {prompt_name: new_prompt_state(categories) for prompt_name in prompts}
+    if image_major:
+        # Load each image once and answer all prompts for it in one batched generate;
+        # the vision tower runs once per image and outputs are routed per prompt
+        print(f"Processing {len(prompts)} prompts image by image")
+        prompt_names = list(prompts)
+        prompt_texts = [prompts[prompt_name][0] for prompt_name in prompt_names]
+        stopping = [stopping_for(prompts[prompt_name][1]) for prompt_name in prompt_names]
+        stop_strings = [stop for stop, _ in stopping] if early_stop else None
+        budgets = [budget for _, budget in stopping] if early_stop else None
+
+        def prepare(idx):
+            """Decode one image and preprocess it for every prompt"""
+            image, label = dataset[idx]
+            return label, model.prepare_batch(
+                [image] * len(prompt_texts), [sample_prompt(prompt_text, idx) for prompt_text in prompt_texts]
+            )
+
+        def predict(idx, prepared):
+            """Answer every prompt for one prepared image"""
+            label, inputs = prepared
+            return label, model.predict_prepared(
+                inputs, max_new_tokens=budgets, labels=labels, dedupe_images=True, stop_strings=stop_strings
+            )
+
+        runner = PipelinedRunner(prepare, predict, num_workers=num_workers, prefetch=prefetch)
+        for idx, (label, predictions) in runner.run(indices):
+            for prompt_name, prediction in zip(prompt_names, predictions):
+                record_prediction(prompt_name, prompts[prompt_name][1], states[prompt_name], idx, categories[label],
+                                  prediction)
+        print(f"Pipeline: {runner.stats()}")
+        return states
+
+    batches = index_batches(indices, batch_size)
+    if image_token_counts is not None and batch_size > 1:
+        batches = bucket_batches(indices, image_token_counts, batch_size, window=bucket_window)
+        print(f"Bucketing: {padding_report(batches, image_token_counts, batch_size)}")
+    for prompt_name, (prompt_text, is_reasoning) in prompts.items():
+        print(f"Processing {prompt_name}: '{prompt_text}' (reasoning={is_reasoning})")
+        stop_strings, budget = stopping_for(is_reasoning)
+
+        def prepare(batch_indices):
+            """Decode and preprocess one batch of images"""
+            batch = [dataset[i] for i in batch_indices]
+            return batch, model.prepare_batch(
+                [image for image, _ in batch], [sample_prompt(prompt_text, i) for i in batch_indices]
+            )
+
+        def predict(batch_indices, prepared):
+            """Predictions of one prepared batch"""
+            batch, inputs = prepared
+            return batch, model.predict_prepared(
+                inputs, max_new_tokens=budget, labels=labels, stop_strings=stop_strings
+            )
+
+        runner = PipelinedRunner(prepare, predict, num_workers=num_workers, prefetch=prefetch)
+        # bucketed batches come out of order
+        results = in_index_order(runner.run(batches), indices[0] if indices else 0)
+        for idx, ([(_, label)], [prediction]) in enumerate(results, indices[0] if indices else 0):
+            record_prediction(prompt_name, is_reasoning, states[prompt_name], idx, categories[label], prediction)
+        print(f"[{prompt_name}] Pipeline: {runner.stats()}")
+    return states
+
+def save_outputs(output_dir, prompts, states, num_shards=1, shard_id=0):
+    """Write the predictions of every prompt, the outputs of all prompts per category and the accuracy summary.
+
+    The outputs of each category are sorted, so the files depend only on the
+    predictions; shards of a run (see sharding.py) write their own files,
+    which merge_outputs combines into those of a single process.
+    """
+    for prompt_name, (prompt_text, is_reasoning) in prompts.items():
+        state = states[prompt_name]
+        output_file = shard_path(f"{output_dir}/predictions_{prompt_name}.txt", num_shards, shard_id)
+        with open(output_file, "w") as f:
+            # Convert sets to lists for JSON serialization
+            serializable_outputs = {cat: sorted(outputs) for cat, outputs in state["category_outputs"].items()}
+            accuracy = state["correct"] / state["total"] if state["total"] > 0 else 0.0
+            output_data = {"category_outputs": serializable_outputs}
+            if is_reasoning:
+                output_data["invalid_count"] = state["invalid_count"]
+            output_data.update(correct=state["correct"], total=state["total"], accuracy=accuracy)
+            json.dump(output_data, f, indent=2)
+        print(f"Saved predictions to {output_file}")
+
+    # the outputs of every prompt, per category
+    category_outputs_all = {}
+    for state in states.values():
+        for cat, outputs in state["category_outputs"].items():
+            category_outputs_all.setdefault(cat, set()).update(outputs)
+    all_output_file = shard_path(f"{output_dir}/category_outputs_all.json", num_shards, shard_id)
+    with open(all_output_file, "w") as f:
+        json.dump({cat: sorted(outputs) for cat, outputs in category_outputs_all.items()}, f, indent=2)
+    print(f"Saved all category outputs to {all_output_file}")
+
+    summary_file = shard_path(f"{output_dir}/accuracy_summary.txt", num_shards, shard_id)
+    with open(summary_file, "w") as f:
+        f.write("Caltech101 Open-World Prompt Sweep Accuracy\n")
+        f.write("=" * 40 + "\n\n")
+        for prompt_name, (prompt_text, is_reasoning) in prompts.items():
+            state = states[prompt_name]
+            accuracy = state["correct"] / state["total"] if state["total"] > 0 else 0.0
+            f.write(f"{prompt_name}: {state['correct']}/{state['total']} = {accuracy:.4f}")
+            if is_reasoning:
+                f.write(f", {state['invalid_count']} invalid")
+            f.write(f" ({prompt_text})\n")
+    print(f"Summary saved to: {summary_file}")
+
+def merge_outputs(output_dir, prompts, num_shards):
+    """Combine the outputs of the num_shards shards of a run into those a single process writes.
+
+    Returns the merged accumulators of every prompt, like run_sweep.
+    """
+    states = {}
+    for prompt_name in prompts:
+        state = None
+        for shard_file in shard_paths(f"{output_dir}/predictions_{prompt_name}.txt", num_shards):
+            if not os.path.exists(shard_file):
+                raise FileNotFoundError(f"{shard_file} is missing, run its shard first")
+            with open(shard_file) as f:
+                shard = json.load(f)
+            if state is None:
+                state = new_prompt_state(shard["category_outputs"])
+            for cat, outputs in shard["category_outputs"].items():
+                state["category_outputs"][cat].update(outputs)
+            for key in ("invalid_count", "correct", "total"):
+                state[key] += shard.get(key, 0)
+        states[prompt_name] = state
+    save_outputs(output_dir, prompts, states)
+    print(f"Merged {num_shards} shards into {output_dir}")
+    return states